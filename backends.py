@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+''' 进程内共享的数据库客户端
+
+uwsgi在master进程中import应用后再fork出worker，pymongo的MongoClient不是fork安全的，
+所以客户端在每个worker第一次使用时才创建（按pid判断），之后整个worker共用一个连接池。
+redis-py的连接池本身会在fork后按pid重建连接，可以直接在import时创建。
+'''
+import os
+import time
+import logging
+import threading
+from pymongo import MongoClient, monitoring
+from redis import StrictRedis, BlockingConnectionPool
+
+import settings
+import metrics
+
+logger = logging.getLogger('__main__.backends')
+
+local = settings.LOCAL_CONFIG
+
+_lock = threading.Lock()
+_mongo_client = None
+_mongo_pid = None
+_collections = {}
+
+# worker级别的累计计数
+stats = {
+    'mongo_clients': 0,
+    'mongo_connections': 0,
+}
+# 单个请求内的计数，gevent monkey patch后threading.local是greenlet级别的
+_request_stats = threading.local()
+
+class _InstrumentedRedis(StrictRedis):
+    ''' 把每个命令和每次pipeline往返的耗时记入metrics
+    '''
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super(_InstrumentedRedis, self).execute_command(*args, **options)
+        finally:
+            metrics.redis_call(args[0], time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(_InstrumentedRedis, self).pipeline(transaction, shard_hint)
+        execute = pipe.execute
+        def timed_execute(raise_on_error=True):
+            # 空pipeline不会访问redis
+            if not len(pipe):
+                return execute(raise_on_error)
+            start = time.perf_counter()
+            try:
+                return execute(raise_on_error)
+            finally:
+                metrics.redis_call('PIPELINE', time.perf_counter() - start)
+        pipe.execute = timed_execute
+        return pipe
+
+redis_db = _InstrumentedRedis(connection_pool=BlockingConnectionPool(
+    host=local['REDIS_HOST'], 
+    port=local['REDIS_PORT'], 
+    password=local['REDIS_PASSWORD'],
+    db=local['REDIS_DB'],
+    max_connections=settings.REDIS_MAX_CONNECTIONS,
+    timeout=settings.REDIS_POOL_TIMEOUT,
+))
+
+def _count_connection():
+    stats['mongo_connections'] += 1
+    _request_stats.mongo_connections = getattr(_request_stats, 'mongo_connections', 0) + 1
+
+class _PoolListener(monitoring.ConnectionPoolListener):
+    ''' 统计连接池建立的每一个连接（pymongo>=3.9）
+    '''
+    def connection_created(self, event):
+        _count_connection()
+    def pool_created(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+    def connection_checked_out(self, event): pass
+    def connection_checked_in(self, event): pass
+
+class _CommandListener(monitoring.CommandListener):
+    ''' 把每个mongo命令的耗时记入metrics
+    '''
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.mongo_call(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        metrics.mongo_call(event.command_name, event.duration_micros / 1e6, failed=True)
+
+def _get_mongo_client():
+    global _mongo_client, _mongo_pid, _collections
+    pid = os.getpid()
+    if _mongo_client is not None and _mongo_pid == pid:
+        return _mongo_client
+    with _lock:
+        if _mongo_client is None or _mongo_pid != pid:
+            # fork之后继承下来的客户端不能再用，直接丢弃
+            _mongo_client = MongoClient(
+                local['MONGO_URI'],
+                maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+                waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                connect=False,
+                event_listeners=[_PoolListener(), _CommandListener()],
+            )
+            _mongo_pid = pid
+            _collections = {}
+            stats['mongo_clients'] += 1
+            logger.info('MongoClient created in worker %s', pid)
+    return _mongo_client
+
+def mongoCollection(cname):
+    ''' 获取collection，同一个worker内复用同一个客户端和collection对象
+    '''
+    client = _get_mongo_client()
+    try:
+        return _collections[cname]
+    except KeyError:
+        collection = client[local['MONGO_DATABASE']][cname]
+        _collections[cname] = collection
+        return collection
+
+def begin_request():
+    ''' 请求开始时清零本请求的计数
+    '''
+    _request_stats.mongo_connections = 0
+
+def request_connections():
+    ''' 本请求内新建的Mongo连接数，正常情况下应该是0
+    '''
+    return getattr(_request_stats, 'mongo_connections', 0)
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    pass
+else:
+    @postfork
+    def _reset_after_fork():
+        global _mongo_client, _collections
+        _mongo_client = None
+        _collections = {}
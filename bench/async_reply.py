@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+''' 异步回复的端到端检查
+
+python -m bench.async_reply [--users 数量] [--latency 毫秒] [--fail 失败次数]
+在本地启动一个模拟客服消息接口的桩服务器（前--fail次发送返回系统繁忙），
+开启ASYNC_REPLY后每个用户发送"!"，检查webhook立即回复success、
+reply_worker最终给每个用户都发送了一条消息，出错时以状态码1退出。
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import datetime
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from urllib.parse import parse_qs
+
+from bench import fakes
+from bench.show_updates import seed
+
+TEXT_XML = '''<xml>
+<ToUserName><![CDATA[amwatcher]]></ToUserName>
+<FromUserName><![CDATA[%s]]></FromUserName>
+<CreateTime>%s</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[!]]></Content>
+<MsgId>%s</MsgId>
+</xml>'''
+
+class StubServer(object):
+    ''' 模拟微信的access_token和客服消息接口
+    '''
+    def __init__(self, fail):
+        self.fail = fail
+        self.delivered = {}
+        self.requests = 0
+
+    def __call__(self, environ, start_response):
+        self.requests += 1
+        path = environ['PATH_INFO']
+        if path == '/cgi-bin/token':
+            res = {'access_token': 'stub-token', 'expires_in': 7200}
+        elif path == '/cgi-bin/message/custom/send':
+            assert parse_qs(environ['QUERY_STRING'])['access_token'] == ['stub-token']
+            body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+            message = json.loads(body.decode('utf-8'))
+            if self.fail > 0:
+                self.fail -= 1
+                res = {'errcode': -1, 'errmsg': 'system error'}
+            else:
+                self.delivered.setdefault(message['touser'], []).append(message)
+                res = {'errcode': 0, 'errmsg': 'ok'}
+        else:
+            start_response('404 Not Found', [])
+            return [b'']
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps(res).encode('utf-8')]
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def run(users, latency, fail):
+    mongo_client, redis_db = fakes.install()
+    mongo_db = mongo_client[fakes.backends.local['MONGO_DATABASE']]
+    keyword_ids = seed(mongo_db, 50)
+
+    import settings
+    import dialogs
+    import summaries
+    import reply_worker
+    from wechat import bot, delivery
+    summaries.rebuild_all()
+    settings.ASYNC_REPLY = True
+    mongo_client.latency = redis_db.latency = latency / 1000.0
+
+    stub = StubServer(fail)
+    server = make_server('127.0.0.1', 0, stub, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = delivery.WeChatClient('http://127.0.0.1:%s' % server.server_port, 'appid', 'secret')
+    stop = threading.Event()
+    threading.Thread(target=reply_worker.run, args=(client, 20, stop), daemon=True).start()
+
+    errors = 0
+    start = time.time()
+    for i in range(users):
+        open_id = 'async-user-%s' % i
+        mongo_db['users'].insert_one({
+            'open_id': open_id,
+            'follow_keywords': keyword_ids[:10],
+            'last_check_time': datetime(2000, 1, 1),
+        })
+        res = bot.answer((TEXT_XML % (open_id, int(time.time()), i)).encode('utf-8'), dialogs).format()
+        if res not in ('success', b'success'):
+            errors += 1
+            print('NOT ASYNC %s: %s' % (open_id, res))
+    webhook_cost = (time.time() - start) * 1000 / users
+
+    deadline = time.time() + 30
+    while len(stub.delivered) < users and time.time() < deadline:
+        time.sleep(0.05)
+    total = time.time() - start
+    stop.set()
+
+    for i in range(users):
+        messages = stub.delivered.get('async-user-%s' % i, [])
+        if len(messages) != 1 or messages[0]['msgtype'] != 'text':
+            errors += 1
+            print('NOT DELIVERED async-user-%s: %s' % (i, messages))
+    print('webhook: %.2f ms/msg, all %s replies delivered in %.2fs, %s stub requests, %s errors' % (
+        webhook_cost, users, total, stub.requests, errors))
+    return errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default=50, type=int)
+    parser.add_argument('--latency', default=0.5, type=float, metavar='MS')
+    parser.add_argument('--fail', default=5, type=int)
+    args = parser.parse_args()
+    sys.exit(1 if run(args.users, args.latency, args.fail) else 0)
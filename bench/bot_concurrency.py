@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+''' wechat.bot并发会话检查
+
+大量用户在同一个worker的greenlet里同时进行多轮对话，检查每个用户收到的都是自己会话的回复。
+python -m bench.bot_concurrency [用户数] [每个用户的消息数]
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import time
+import gevent
+from gevent.pool import Pool
+
+import backends
+from bench.fakes import FakeRedis
+from wechat import bot
+
+ROUTER = {
+    'text': [
+        ('.*', 'echo'),
+    ],
+    'event': [
+        ('.*', 'echo'),
+    ],
+}
+
+def echo(to_user):
+    yield None
+    msg_content, is_replay = yield None
+    turn = 1
+    while True:
+        msg_content, is_replay = yield ('TextMsg', '%s|%s|%s' % (to_user, turn, msg_content))
+        turn += 1
+
+TEXT_XML = '''<xml>
+<ToUserName><![CDATA[amwatcher]]></ToUserName>
+<FromUserName><![CDATA[%s]]></FromUserName>
+<CreateTime>%s</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[%s]]></Content>
+<MsgId>%s</MsgId>
+</xml>'''
+
+def _talk(module, user, turns, errors):
+    for turn in range(1, turns + 1):
+        content = 'msg-%s' % turn
+        data = (TEXT_XML % (user, int(time.time()), content, '%s-%s' % (user, turn))).encode('utf-8')
+        try:
+            res = bot.answer(data, module).format()
+            if isinstance(res, bytes):
+                res = res.decode('utf-8')
+        except Exception as e:
+            errors.append((user, turn, repr(e)))
+            return
+        expected = '%s|%s|%s' % (user, turn, content)
+        if expected not in res or '<ToUserName><![CDATA[%s]]>' % user not in res:
+            errors.append((user, turn, res))
+        gevent.sleep(0)
+
+def run(users=300, turns=5):
+    backends.redis_db = FakeRedis()
+    module = sys.modules[__name__]
+    errors = []
+    pool = Pool(users)
+    start = time.time()
+    for i in range(users):
+        pool.spawn(_talk, module, 'user-%04d' % i, turns, errors)
+    pool.join()
+    cost = time.time() - start
+    print('%s users x %s messages in %.2fs, %s redis calls, %s errors' % (
+        users, turns, cost, backends.redis_db.calls, len(errors)))
+    for error in errors[:10]:
+        print(error)
+    return not errors
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    sys.exit(0 if run(*args) else 1)
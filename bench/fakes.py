@@ -0,0 +1,897 @@
+# -*- coding: utf-8 -*-
+''' 压测/检查脚本用的进程内假后端
+
+FakeRedis和FakeMongoClient只实现了项目里用到的命令和查询语法。
+每次和"服务器"的交互（一个命令、一个pipeline、一次查询）都会让出greenlet并等待latency秒，
+用来模拟网络往返，同时记录调用次数，方便比较不同实现的往返次数。
+install()把它们装到backends里，必须在import dialogs之前调用。
+'''
+import re
+import time
+import bisect
+import fnmatch
+import gevent
+from bson.objectid import ObjectId
+from redis.exceptions import ResponseError
+
+import backends
+from wechat import bot
+
+_MISSING = object()
+_RE_TYPE = type(re.compile(''))
+
+def install(mongo_client=None, redis_db=None):
+    ''' 用假后端替换backends中的客户端
+    '''
+    mongo_client = mongo_client or FakeMongoClient()
+    redis_db = redis_db or FakeRedis()
+    backends._mongo_client = mongo_client
+    backends._mongo_pid = backends.os.getpid()
+    backends._collections = {}
+    backends.redis_db = redis_db
+    return mongo_client, redis_db
+
+class _RedisStore(object):
+    def __init__(self):
+        self.data = {}
+        self.expire_at = {}
+
+    def alive(self, key):
+        if key in self.expire_at and self.expire_at[key] < time.time():
+            self.data.pop(key, None)
+            self.expire_at.pop(key, None)
+        return key in self.data
+
+    def read(self, key, default=None):
+        return self.data[key] if self.alive(key) else default
+
+    def read_list(self, key):
+        items = self.read(key, [])
+        if not isinstance(items, list):
+            raise ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return items
+
+def _key(key):
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+class _RedisCommands(object):
+    ''' 命令的实际实现，第一个参数是_RedisStore
+    '''
+    @staticmethod
+    def get(store, key):
+        return store.read(_key(key))
+
+    @staticmethod
+    def mget(store, *keys):
+        return [store.read(_key(k)) for k in keys]
+
+    @staticmethod
+    def set(store, key, value, ex=None, nx=False):
+        key = _key(key)
+        if nx and store.alive(key):
+            return None
+        store.data[key] = _encode(value)
+        store.expire_at.pop(key, None)
+        if ex:
+            store.expire_at[key] = time.time() + ex
+        return True
+
+    @staticmethod
+    def setex(store, key, time_, value):
+        key = _key(key)
+        store.data[key] = _encode(value)
+        store.expire_at[key] = time.time() + time_
+        return True
+
+    @staticmethod
+    def getrange(store, key, start, end):
+        value = store.read(_key(key)) or b''
+        # 和redis一样包含end，负数从末尾算起
+        if start < 0:
+            start = max(len(value) + start, 0)
+        if end < 0:
+            end = len(value) + end
+        return value[start:end + 1]
+
+    @staticmethod
+    def exists(store, key):
+        return store.alive(_key(key))
+
+    @staticmethod
+    def expire(store, key, time_):
+        key = _key(key)
+        if not store.alive(key):
+            return False
+        store.expire_at[key] = time.time() + time_
+        return True
+
+    @staticmethod
+    def ttl(store, key):
+        key = _key(key)
+        if not store.alive(key):
+            return -2
+        if key not in store.expire_at:
+            return -1
+        return int(store.expire_at[key] - time.time())
+
+    @staticmethod
+    def delete(store, *keys):
+        count = 0
+        for key in keys:
+            key = _key(key)
+            if store.alive(key):
+                count += 1
+            store.data.pop(key, None)
+            store.expire_at.pop(key, None)
+        return count
+
+    @staticmethod
+    def keys(store, pattern='*'):
+        return [k.encode('utf-8') for k in list(store.data) if store.alive(k) and fnmatch.fnmatch(k, pattern)]
+
+    @staticmethod
+    def hincrbyfloat(store, key, field, amount=1.0):
+        key = _key(key)
+        items = store.read(key, {})
+        value = float(items.get(_encode(field), 0)) + float(amount)
+        items[_encode(field)] = _encode(repr(value))
+        store.data[key] = items
+        return value
+
+    @staticmethod
+    def hgetall(store, key):
+        return dict(store.read(_key(key), {}))
+
+    @staticmethod
+    def publish(store, channel, message):
+        # 没有订阅者
+        return 0
+
+    @staticmethod
+    def incr(store, key, amount=1):
+        key = _key(key)
+        value = int(store.read(key, b'0')) + amount
+        store.data[key] = _encode(value)
+        return value
+
+    @staticmethod
+    def rpush(store, key, *values):
+        key = _key(key)
+        items = store.read_list(key)
+        items.extend(_encode(v) for v in values)
+        store.data[key] = items
+        return len(items)
+
+    @staticmethod
+    def blpop(store, key, timeout=0):
+        # 只支持一个key，没有数据时轮询直到超时
+        key = _key(key)
+        deadline = time.time() + timeout
+        while True:
+            items = store.read_list(key)
+            if items:
+                return key.encode('utf-8'), items.pop(0)
+            if timeout and time.time() >= deadline:
+                return None
+            gevent.sleep(0.01)
+
+    @staticmethod
+    def lindex(store, key, index):
+        items = store.read_list(_key(key))
+        try:
+            return items[index]
+        except IndexError:
+            return None
+
+    @staticmethod
+    def lset(store, key, index, value):
+        store.read_list(_key(key))[index] = _encode(value)
+        return True
+
+    @staticmethod
+    def lrange(store, key, start, end):
+        items = store.read_list(_key(key))
+        end = len(items) if end == -1 else end + 1
+        return items[start:end]
+
+    @staticmethod
+    def llen(store, key):
+        return len(store.read_list(_key(key)))
+
+    @staticmethod
+    def ltrim(store, key, start, end):
+        key = _key(key)
+        items = store.read_list(key)
+        end = len(items) if end == -1 else end + 1
+        store.data[key] = items[start:end]
+        return True
+
+    @staticmethod
+    def eval(store, script, numkeys, *keys_and_args):
+        # lua脚本用对应的python实现代替
+        return SCRIPTS[script](store, keys_and_args[:numkeys], keys_and_args[numkeys:])
+
+def _append_history(store, keys, args):
+    key = _key(keys[0])
+    name, msg, expire, max_length = args
+    if not store.alive(key):
+        _RedisCommands.rpush(store, key, name)
+    length = _RedisCommands.rpush(store, key, msg)
+    if length > int(max_length):
+        _RedisCommands.delete(store, key)
+        return 0
+    _RedisCommands.expire(store, key, int(expire))
+    return length
+
+SCRIPTS = {
+    bot.APPEND_HISTORY_SCRIPT: _append_history,
+}
+
+class FakeRedis(object):
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.store = _RedisStore()
+        self.calls = 0
+
+    def _io(self):
+        self.calls += 1
+        gevent.sleep(self.latency)
+
+    def __getattr__(self, name):
+        try:
+            command = getattr(_RedisCommands, name)
+        except AttributeError:
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            self._io()
+            return command(self.store, *args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+class FakePipeline(object):
+    ''' 命令先排队，execute时算一次往返
+    '''
+    def __init__(self, redis_db):
+        self.redis_db = redis_db
+        self.queue = []
+
+    def __getattr__(self, name):
+        try:
+            command = getattr(_RedisCommands, name)
+        except AttributeError:
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            self.queue.append((command, args, kwargs))
+            return self
+        return call
+
+    def execute(self, raise_on_error=True):
+        queue, self.queue = self.queue, []
+        if not queue:
+            return []
+        self.redis_db._io()
+        results = []
+        for command, args, kwargs in queue:
+            try:
+                results.append(command(self.redis_db.store, *args, **kwargs))
+            except ResponseError as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+def _get(doc, key):
+    for part in key.split('.'):
+        if isinstance(doc, dict) and part in doc:
+            doc = doc[part]
+        else:
+            return _MISSING
+    return doc
+
+def _candidates(value):
+    # 数组字段匹配数组本身或者其中任意元素
+    if isinstance(value, list):
+        return [value] + value
+    return [value]
+
+def _compare(op):
+    def check(value, arg, cond):
+        for v in _candidates(value):
+            if v is _MISSING or v is None or isinstance(v, list):
+                continue
+            try:
+                if op(v, arg):
+                    return True
+            except TypeError:
+                continue
+        return False
+    return check
+
+def _regex(value, arg, cond):
+    if not isinstance(arg, _RE_TYPE):
+        flags = re.I if 'i' in cond.get('$options', '') else 0
+        arg = re.compile(arg, flags)
+    return any(isinstance(v, str) and arg.search(v) for v in _candidates(value))
+
+def _elem_match(value, arg, cond):
+    if not isinstance(value, list):
+        return False
+    operators = all(k.startswith('$') for k in arg)
+    for v in value:
+        if operators and _match_value(v, arg):
+            return True
+        if not operators and isinstance(v, dict) and _match(v, arg):
+            return True
+    return False
+
+def _in(value, arg, cond):
+    if value is _MISSING:
+        return None in arg
+    return any(v in arg for v in _candidates(value) if not isinstance(v, list))
+
+def _prepare(query):
+    ''' $in/$nin的参数转成set，避免每个文档都线性查找
+    '''
+    if isinstance(query, dict):
+        res = {}
+        for k, v in query.items():
+            if k in ('$in', '$nin'):
+                try:
+                    v = set(v)
+                except TypeError:
+                    pass
+            res[k] = _prepare(v)
+        return res
+    if isinstance(query, list):
+        return [_prepare(q) for q in query]
+    return query
+
+_OPS = {
+    '$in': _in,
+    '$nin': lambda value, arg, cond: not _in(value, arg, cond),
+    '$ne': lambda value, arg, cond: not _eq(value, arg),
+    '$gt': _compare(lambda v, a: v > a),
+    '$gte': _compare(lambda v, a: v >= a),
+    '$lt': _compare(lambda v, a: v < a),
+    '$lte': _compare(lambda v, a: v <= a),
+    '$exists': lambda value, arg, cond: (value is not _MISSING) == bool(arg),
+    '$regex': _regex,
+    '$options': lambda value, arg, cond: True,
+    '$elemMatch': _elem_match,
+}
+
+def _eq(value, cond):
+    if value is _MISSING:
+        return cond is None
+    return any(v == cond for v in _candidates(value))
+
+def _match_value(value, cond):
+    if isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond):
+        return all(_OPS[op](value, arg, cond) for op, arg in cond.items())
+    if isinstance(cond, _RE_TYPE):
+        return _regex(value, cond, {})
+    return _eq(value, cond)
+
+def _match(doc, query):
+    for key, cond in (query or {}).items():
+        if key == '$or':
+            if not any(_match(doc, q) for q in cond):
+                return False
+        elif key == '$and':
+            if not all(_match(doc, q) for q in cond):
+                return False
+        elif not _match_value(_get(doc, key), cond):
+            return False
+    return True
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {k: True for k in projection}
+    if any(projection.values()):
+        res = {k: doc[k] for k, v in projection.items() if v and k in doc}
+        if projection.get('_id', True) and '_id' in doc:
+            res['_id'] = doc['_id']
+        return res
+    return {k: v for k, v in doc.items() if k not in projection}
+
+def _sort_key(value):
+    # 缺失的字段排在最前面（升序）
+    if value is _MISSING or value is None:
+        return (0, 0)
+    return (1, value)
+
+def _sort(docs, spec):
+    for key, direction in reversed(spec):
+        docs.sort(key=lambda d: _sort_key(_get(d, key)), reverse=direction < 0)
+    return docs
+
+def _normalize_sort(key_or_list, direction=None):
+    if key_or_list is None:
+        return []
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    return list(key_or_list)
+
+def _apply_update(doc, update):
+    for op, fields in update.items():
+        for key, value in fields.items():
+            if op == '$set':
+                doc[key] = value
+            elif op == '$unset':
+                doc.pop(key, None)
+            elif op == '$inc':
+                doc[key] = doc.get(key, 0) + value
+            elif op == '$max':
+                doc[key] = max(doc[key], value) if key in doc else value
+            elif op == '$min':
+                doc[key] = min(doc[key], value) if key in doc else value
+            elif op == '$push':
+                doc.setdefault(key, []).append(value)
+            elif op == '$addToSet':
+                values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                items = doc.setdefault(key, [])
+                items.extend(v for v in values if v not in items)
+            elif op == '$pull':
+                doc[key] = [v for v in doc.get(key, []) if not _match_value(v, value)]
+            elif op == '$setOnInsert':
+                pass
+            else:
+                raise NotImplementedError(op)
+
+def _upsert_doc(query, update):
+    doc = {k: v for k, v in (query or {}).items() if not k.startswith('$') and not isinstance(v, dict)}
+    for key, value in update.get('$setOnInsert', {}).items():
+        doc[key] = value
+    _apply_update(doc, update)
+    doc.setdefault('_id', ObjectId())
+    return doc
+
+def _is_point(cond):
+    # 等值条件，$in按每个值展开之后也是等值
+    if cond is _MISSING or isinstance(cond, (list, _RE_TYPE)):
+        return False
+    return not isinstance(cond, dict) or list(cond) == ['$in']
+
+class _Result(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class FakeCursor(object):
+    ''' 遍历时才算一次往返
+    '''
+    def __init__(self, collection, query, projection=None, sort=None):
+        self.collection = collection
+        self.query = _prepare(query)
+        self.projection = projection
+        self._sort = _normalize_sort(sort)
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def _docs(self):
+        if not self.query and self._sort and len(self._sort) == 1 and self._limit:
+            # 没有条件、按一个索引字段排序取前几条（例如第一条资源）时直接用索引的顺序
+            docs = self.collection._first(self._sort[0], self._skip + self._limit)
+            if docs is not None:
+                return docs[self._skip:]
+        docs = [d for d in self.collection._scan(self.query) if _match(d, self.query)]
+        _sort(docs, self._sort)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return docs
+
+    def __iter__(self):
+        self.collection._io()
+        return iter([_project(d, self.projection) for d in self._docs()])
+
+    def explain(self):
+        self.collection._io()
+        return self.collection._explain(self.query, self._sort)
+
+class FakeCollection(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.docs = []
+        self.indexes = {}
+        self.calls = 0
+        self._lookups = {}
+        self._orders = {}
+
+    def _io(self):
+        self.calls += 1
+        self.client._io()
+
+    def _changed(self):
+        self._lookups = {}
+        self._orders = {}
+
+    def _lookup(self, field):
+        ''' 索引字段的值到文档位置的映射，数据变化后重建，数组字段不支持
+        '''
+        if field not in self._lookups:
+            lookup = {}
+            for i, doc in enumerate(self.docs):
+                value = _get(doc, field)
+                if isinstance(value, (list, dict)):
+                    lookup = None
+                    break
+                lookup.setdefault(None if value is _MISSING else value, []).append(i)
+            self._lookups[field] = lookup
+        return self._lookups[field]
+
+    def _order(self, field):
+        ''' 按索引字段排序的(值, 文档位置)，只支持所有文档都有这个字段且值是同一类型的情况
+        '''
+        if field not in self._orders:
+            lookup = self._lookup(field)
+            order = None
+            if lookup and None not in lookup and len(set(type(v) for v in lookup)) == 1:
+                pairs = sorted((v, i) for v, positions in lookup.items() for i in positions)
+                order = ([v for v, i in pairs], [i for v, i in pairs])
+            self._orders[field] = order
+        return self._orders[field]
+
+    def _range(self, field, cond):
+        order = self._order(field)
+        if order is None:
+            return None
+        values, positions = order
+        lo, hi = 0, len(values)
+        if '$gte' in cond:
+            lo = max(lo, bisect.bisect_left(values, cond['$gte']))
+        if '$gt' in cond:
+            lo = max(lo, bisect.bisect_right(values, cond['$gt']))
+        if '$lte' in cond:
+            hi = min(hi, bisect.bisect_right(values, cond['$lte']))
+        if '$lt' in cond:
+            hi = min(hi, bisect.bisect_left(values, cond['$lt']))
+        return sorted(positions[lo:hi])
+
+    def _first(self, sort, count):
+        field, direction = sort
+        indexed = set(['_id']) | set(index['key'][0][0] for index in self.indexes.values())
+        order = self._order(field) if field in indexed else None
+        if order is None:
+            return None
+        positions = order[1] if direction > 0 else order[1][::-1]
+        return [self.docs[i] for i in positions[:count]]
+
+    def _scan(self, query):
+        ''' 查询条件中有索引字段的等值、$in或范围条件时只返回候选文档，否则返回全部文档
+        大数据量的压测不会被假后端的全表扫描拖慢
+        '''
+        indexed = set(['_id']) | set(index['key'][0][0] for index in self.indexes.values())
+        for field, cond in (query or {}).items():
+            if field not in indexed:
+                continue
+            if isinstance(cond, dict) and cond and set(cond) <= set(['$gt', '$gte', '$lt', '$lte']):
+                positions = self._range(field, cond)
+                if positions is None:
+                    continue
+                return [self.docs[i] for i in positions]
+            if isinstance(cond, dict):
+                if list(cond) != ['$in'] or not isinstance(cond['$in'], set):
+                    continue
+                values = cond['$in']
+            elif isinstance(cond, (list, _RE_TYPE)):
+                continue
+            else:
+                values = [cond]
+            lookup = self._lookup(field)
+            if lookup is None:
+                continue
+            positions = sorted(i for v in values for i in lookup.get(v, ()))
+            return [self.docs[i] for i in positions]
+        return self.docs
+
+    def _explain(self, query, sort):
+        ''' 没有查询优化器：索引的第一个字段在查询条件中或者是第一个排序字段时认为可以使用，
+        索引在等值/$in条件之后的字段和排序一致（方向全部相同或全部相反）时不需要内存排序，
+        部分索引只在查询条件包含它的过滤条件时使用
+        '''
+        query = query or {}
+        candidates = [{'name': '_id_', 'key': [('_id', 1)]}] + list(self.indexes.values())
+        plans = []
+        for index in candidates:
+            partial = index.get('partialFilterExpression') or {}
+            if any(query.get(field, _MISSING) != value for field, value in partial.items()):
+                continue
+            keys = index['key']
+            if keys[0][0] not in query and not (sort and sort[0][0] == keys[0][0]):
+                continue
+            rest = list(keys)
+            while rest and _is_point(query.get(rest[0][0], _MISSING)):
+                rest.pop(0)
+            head = rest[:len(sort)]
+            sorted_by_index = not sort or (
+                [field for field, d in head] == [field for field, d in sort] and
+                len(set(d * sd for (field, d), (sfield, sd) in zip(head, sort))) == 1
+            )
+            plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': index['name']}}
+            if not sorted_by_index:
+                plan = {'stage': 'SORT', 'inputStage': plan}
+            plans.append((not sorted_by_index, len(plans), plan))
+        if plans:
+            plan = min(plans)[2]
+        else:
+            plan = {'stage': 'COLLSCAN'}
+            if sort:
+                plan = {'stage': 'SORT', 'inputStage': plan}
+        return {'queryPlanner': {'winningPlan': plan}}
+
+    def find(self, filter=None, projection=None, sort=None, **kwargs):
+        return FakeCursor(self, filter, projection, sort)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for doc in FakeCursor(self, filter, projection, sort).limit(1):
+            return doc
+        return None
+
+    def count(self, filter=None):
+        self._io()
+        filter = _prepare(filter)
+        return sum(1 for d in self._scan(filter) if _match(d, filter))
+
+    count_documents = count
+
+    def distinct(self, key, filter=None):
+        self._io()
+        values = []
+        for doc in self.docs:
+            if not _match(doc, filter):
+                continue
+            value = _get(doc, key)
+            for v in (value if isinstance(value, list) else [value]):
+                if v is not _MISSING and v not in values:
+                    values.append(v)
+        return values
+
+    def insert_one(self, doc):
+        self._io()
+        doc.setdefault('_id', ObjectId())
+        self.docs.append(dict(doc))
+        self._changed()
+        return _Result(inserted_id=doc['_id'])
+
+    def insert_many(self, docs):
+        self._io()
+        for doc in docs:
+            doc.setdefault('_id', ObjectId())
+            self.docs.append(dict(doc))
+        self._changed()
+        return _Result(inserted_ids=[d['_id'] for d in docs])
+
+    def _update(self, filter, update, upsert=False, multi=False):
+        self._changed()
+        matched = 0
+        before = None
+        for doc in self.docs:
+            if _match(doc, filter):
+                if before is None:
+                    before = dict(doc)
+                _apply_update(doc, update)
+                matched += 1
+                if not multi:
+                    break
+        upserted_id = None
+        if not matched and upsert:
+            doc = _upsert_doc(filter, update)
+            self.docs.append(doc)
+            upserted_id = doc['_id']
+        return matched, before, upserted_id
+
+    def update_one(self, filter, update, upsert=False):
+        self._io()
+        matched, before, upserted_id = self._update(filter, update, upsert)
+        return _Result(matched_count=matched, modified_count=matched, upserted_id=upserted_id)
+
+    def update_many(self, filter, update, upsert=False):
+        self._io()
+        matched, before, upserted_id = self._update(filter, update, upsert, multi=True)
+        return _Result(matched_count=matched, modified_count=matched, upserted_id=upserted_id)
+
+    def update(self, spec, document, upsert=False, multi=False):
+        self._io()
+        matched, before, upserted_id = self._update(spec, document, upsert, multi)
+        return {'n': matched or int(bool(upserted_id)), 'nModified': matched, 'updatedExisting': bool(matched), 'ok': 1.0}
+
+    def find_one_and_update(self, filter, update, projection=None, upsert=False, return_document=False, **kwargs):
+        self._io()
+        matched, before, upserted_id = self._update(filter, update, upsert)
+        if return_document:
+            return self.find_one(filter, projection)
+        return _project(before, projection) if before else None
+
+    def replace_one(self, filter, replacement, upsert=False):
+        self._io()
+        return self._replace(filter, replacement, upsert)
+
+    def _replace(self, filter, replacement, upsert):
+        self._changed()
+        for i, doc in enumerate(self.docs):
+            if _match(doc, filter):
+                replacement = dict(replacement)
+                replacement.setdefault('_id', doc['_id'])
+                self.docs[i] = replacement
+                return _Result(matched_count=1, upserted_id=None)
+        if upsert:
+            replacement = dict(replacement)
+            replacement.setdefault('_id', ObjectId())
+            self.docs.append(replacement)
+            return _Result(matched_count=0, upserted_id=replacement['_id'])
+        return _Result(matched_count=0, upserted_id=None)
+
+    def delete_many(self, filter):
+        self._io()
+        self._changed()
+        before = len(self.docs)
+        self.docs = [d for d in self.docs if not _match(d, filter)]
+        return _Result(deleted_count=before - len(self.docs))
+
+    def bulk_write(self, requests, ordered=True):
+        self._io()
+        self._changed()
+        for request in requests:
+            kind = type(request).__name__
+            if kind == 'InsertOne':
+                doc = dict(request._doc)
+                doc.setdefault('_id', ObjectId())
+                self.docs.append(doc)
+            elif kind in ('UpdateOne', 'UpdateMany'):
+                self._update(request._filter, request._doc, request._upsert, multi=(kind == 'UpdateMany'))
+            elif kind == 'ReplaceOne':
+                self._replace(request._filter, request._doc, request._upsert)
+            else:
+                raise NotImplementedError(kind)
+        return _Result(acknowledged=True)
+
+    def aggregate(self, pipeline, **kwargs):
+        self._io()
+        # 第一个$match可以用索引缩小范围
+        first = pipeline[0].get('$match') if pipeline else None
+        docs = [dict(d) for d in self._scan(first)]
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if op == '$match':
+                docs = [d for d in docs if _match(d, arg)]
+            elif op == '$sort':
+                docs = _sort(docs, list(arg.items()))
+            elif op == '$limit':
+                docs = docs[:arg]
+            elif op == '$skip':
+                docs = docs[arg:]
+            elif op == '$project':
+                docs = [_project(d, arg) for d in docs]
+            elif op == '$unwind':
+                field = arg.lstrip('$')
+                docs = [dict(d, **{field: v}) for d in docs for v in d.get(field, [])]
+            elif op == '$group':
+                docs = _group(docs, arg)
+            else:
+                raise NotImplementedError(op)
+        return iter(docs)
+
+    def create_index(self, keys, **kwargs):
+        self._io()
+        keys = _normalize_sort(keys)
+        name = kwargs.get('name') or '_'.join('%s_%s' % (k, d) for k, d in keys)
+        self.indexes[name] = dict(kwargs, key=keys, name=name)
+        self._changed()
+        return name
+
+    def create_indexes(self, models):
+        return [
+            self.create_index(list(model.document['key'].items()), **{k: v for k, v in model.document.items() if k != 'key'})
+            for model in models
+        ]
+
+    def drop_index(self, name):
+        self._io()
+        del self.indexes[name]
+        self._changed()
+
+    def index_information(self):
+        self._io()
+        info = {'_id_': {'key': [('_id', 1)]}}
+        for name, index in self.indexes.items():
+            info[name] = {k: v for k, v in index.items() if k != 'name'}
+        return info
+
+def _expr(doc, expr):
+    if isinstance(expr, str) and expr.startswith('$'):
+        value = _get(doc, expr[1:])
+        return None if value is _MISSING else value
+    if isinstance(expr, dict):
+        return {k: _expr(doc, v) for k, v in expr.items()}
+    return expr
+
+def _group(docs, spec):
+    groups = {}
+    for doc in docs:
+        gid = _expr(doc, spec['_id'])
+        gkey = repr(gid)
+        group = groups.setdefault(gkey, {'_id': gid})
+        for field, acc in spec.items():
+            if field == '_id':
+                continue
+            (op, expr), = acc.items()
+            value = _expr(doc, expr)
+            if op == '$sum':
+                group[field] = group.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+            elif op == '$max':
+                if value is not None and (field not in group or value > group[field]):
+                    group[field] = value
+            elif op == '$min':
+                if value is not None and (field not in group or value < group[field]):
+                    group[field] = value
+            elif op == '$first':
+                group.setdefault(field, value)
+            elif op == '$last':
+                group[field] = value
+            elif op == '$push':
+                group.setdefault(field, []).append(value)
+            elif op == '$addToSet':
+                items = group.setdefault(field, [])
+                if value not in items:
+                    items.append(value)
+            else:
+                raise NotImplementedError(op)
+    return list(groups.values())
+
+class FakeDatabase(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self.client, name)
+        return self.collections[name]
+
+class FakeMongoClient(object):
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.dbs = {}
+        self.calls = 0
+
+    def _io(self):
+        self.calls += 1
+        gevent.sleep(self.latency)
+
+    def __getitem__(self, name):
+        if name not in self.dbs:
+            self.dbs[name] = FakeDatabase(self, name)
+        return self.dbs[name]
+
+def timeit(func, repeat=20):
+    ''' 返回每次调用的平均耗时（毫秒）
+    '''
+    start = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - start) * 1000 / repeat
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+''' keyword搜索索引的回归检查和耗时对比
+
+python -m bench.keyword_search [--keywords 数量] [--corpus 语料条数] [--repeat 次数]
+用原来的mongo正则查询作为参照，逐条比较回归语料的搜索结果，结果不一致时以状态码1退出；
+之后分别输出原来的正则查询和内存索引每次搜索的平均耗时。
+'''
+import re
+import sys
+import random
+import argparse
+
+from bench import fakes
+
+TITLES = [
+    '进击的巨人', '进击的巨人 第二季', '命运石之门', 'Steins;Gate', '银魂', '银魂°',
+    '我的英雄学院', '僕のヒーローアカデミア', 'Re:从零开始的异世界生活', 'Fate/Zero',
+    'Fate/stay night [UBW]', 'ONE PIECE', 'One Punch Man', '一拳超人', '火影忍者疾风传',
+    '琅琊榜', '琅琊榜之风起长林', '权力的游戏', 'Game of Thrones', '神探夏洛克', 'Sherlock',
+    '奔跑吧兄弟', '快乐大本营', '爸爸去哪儿', 'Running Man', '无限挑战', 'Doctor Who',
+    '工作细胞', 'はたらく細胞', '夏目友人帐', '夏目友人帳 陆', 'JOJO的奇妙冒险', '紫罗兰永恒花园',
+]
+ALIASES = {
+    '进击的巨人': ['Attack on Titan', '進撃の巨人', 'AOT'],
+    '命运石之门': ['Steins;Gate', 'シュタインズ・ゲート'],
+    '我的英雄学院': ['My Hero Academia', 'MHA'],
+    'Re:从零开始的异世界生活': ['Re:Zero', 'Re：ゼロから始める異世界生活'],
+    '权力的游戏': ['GOT', '冰与火之歌'],
+    '神探夏洛克': ['Sherlock (2010)'],
+    '一拳超人': ['ワンパンマン', 'OPM'],
+}
+
+# 原来的查询在这些输入上会报错或者有特殊含义，必须保持一致
+SPECIAL = [
+    '.*', '.', '..', '^进击', '巨人$', 'Fate/.*', 'fate/zero', 'Re:', '[UBW]', 'a|b', 'S.*k',
+    '(', ')', '[', '*', '+', '?', '\\', 'a{2}', 'ste', 'STE', 'got', 'Got', '的', '之', 'Man',
+    ' ', 'one piece', 'ONE  PIECE', '°', '・', ';', 'Gate', '第二季', '2010', 'xyz', '不存在',
+]
+# 全角和大小写变化，原来的正则不能匹配，索引的结果需要和对应的半角输入一致
+FULLWIDTH = [
+    ('ＯＮＥ　ＰＩＥＣＥ', 'one piece'),
+    ('ｓｈｅｒｌｏｃｋ', 'Sherlock'),
+    ('ＪＯＪＯ', 'jojo'),
+    ('Ｒｅ：', 'Re:'),
+]
+
+def seed(mongo_db, keyword_count):
+    for i in range(keyword_count):
+        title = TITLES[i % len(TITLES)]
+        if i >= len(TITLES):
+            title = '%s %s' % (title, i)
+        mongo_db['keywords'].insert_one({
+            'keyword': title,
+            'alias': ALIASES.get(title, []),
+            'type': random.choice(['anime', 'drama', 'variety']),
+            # 没有资源或没有上线的keyword不能被搜索到
+            'status': 'activated' if i % 7 else 'deactivated',
+            'valid_feed_count': i % 5,
+        })
+
+def corpus(mongo_db, size):
+    ''' 特殊输入加上从标题和别名中随机截取的子串
+    '''
+    names = []
+    for keyword in mongo_db['keywords'].find():
+        names.append(keyword['keyword'])
+        names.extend(keyword['alias'])
+    queries = list(SPECIAL)
+    while len(queries) < size:
+        name = random.choice(names)
+        start = random.randrange(len(name))
+        query = name[start:start + random.randint(1, 6)]
+        if random.random() < 0.3:
+            query = query.swapcase()
+        queries.append(query)
+    return queries
+
+def regex_search(mongo_keywords, query):
+    ''' 原来dialogs._search中的查询
+    '''
+    return list(mongo_keywords.find({
+        '$or': [
+            {
+                'keyword': re.compile(query, flags=re.I),
+            },
+            {
+                'alias': {
+                    '$elemMatch': { '$regex': query , '$options': '$i' }
+                }
+            }
+        ],
+        'valid_feed_count': {'$gt': 0},
+        'status': 'activated',
+    }, {'keyword': True, 'type': True}))
+
+def _ids(search, query):
+    try:
+        # mongo返回文档，索引返回repository.Keyword
+        return [keyword['_id'] if isinstance(keyword, dict) else keyword._id for keyword in search(query)]
+    except re.error:
+        return 'error'
+
+def run(keyword_count, corpus_size, repeat):
+    random.seed(0)
+    mongo_client, redis_db = fakes.install()
+    mongo_db = mongo_client[fakes.backends.local['MONGO_DATABASE']]
+    seed(mongo_db, keyword_count)
+    mongo_keywords = mongo_db['keywords']
+
+    import keyword_index
+    index = keyword_index.refresh()
+    queries = corpus(mongo_db, corpus_size)
+
+    failed = 0
+    for query in queries:
+        expected = _ids(lambda q: regex_search(mongo_keywords, q), query)
+        got = _ids(index.search, query)
+        if expected != got:
+            failed += 1
+            print('MISMATCH %r: regex=%s index=%s' % (query, expected, got))
+    for query, halfwidth in FULLWIDTH:
+        expected = _ids(index.search, halfwidth)
+        got = _ids(index.search, query)
+        if not expected or expected != got:
+            failed += 1
+            print('MISMATCH %r: %r=%s index=%s' % (query, halfwidth, expected, got))
+    print('%s queries, %s mismatches' % (len(queries) + len(FULLWIDTH), failed))
+
+    sample = queries[:repeat]
+    regex_cost = fakes.timeit(lambda: [_ids(lambda q: regex_search(mongo_keywords, q), q) for q in sample], 1) / len(sample)
+    index_cost = fakes.timeit(lambda: [_ids(index.search, q) for q in sample], 1) / len(sample)
+    print('regex scan: %8.3f ms/search' % regex_cost)
+    print('index:      %8.3f ms/search' % index_cost)
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keywords', default=2000, type=int)
+    parser.add_argument('--corpus', default=2000, type=int)
+    parser.add_argument('--repeat', default=200, type=int)
+    args = parser.parse_args()
+    sys.exit(1 if run(args.keywords, args.corpus, args.repeat) else 0)
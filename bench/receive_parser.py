@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+''' 微信消息解析的耗时对比
+
+python -m bench.receive_parser [--repeat 次数]
+先检查单次扫描和ElementTree对每个样例解析出的字段一致（不一致时以状态码1退出），
+再输出两种方式解析每条消息的平均耗时。
+'''
+import sys
+import argparse
+
+from bench import fakes
+from wechat import receive
+
+SAMPLES = {
+    'text': '''<xml>
+<ToUserName><![CDATA[gh_amwatcher]]></ToUserName>
+<FromUserName><![CDATA[oQWx9wLh3hX0aB1c2d3e4f5g6h7]]></FromUserName>
+<CreateTime>1500000000</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[进击的巨人]]></Content>
+<MsgId>6436529398871000000</MsgId>
+</xml>''',
+    'text_multiline': '<xml><ToUserName><![CDATA[gh]]></ToUserName><FromUserName><![CDATA[u]]></FromUserName>'
+        '<CreateTime>1500000000</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+        '<Content><![CDATA[第一行\r\n第二行 <b>&amp;</b>]]></Content><MsgId>1</MsgId></xml>',
+    'event': '''<xml>
+<ToUserName><![CDATA[gh_amwatcher]]></ToUserName>
+<FromUserName><![CDATA[oQWx9wLh3hX0aB1c2d3e4f5g6h7]]></FromUserName>
+<CreateTime>1500000000</CreateTime>
+<MsgType><![CDATA[event]]></MsgType>
+<Event><![CDATA[subscribe]]></Event>
+<EventKey><![CDATA[]]></EventKey>
+</xml>''',
+    'image': '''<xml>
+<ToUserName><![CDATA[gh_amwatcher]]></ToUserName>
+<FromUserName><![CDATA[oQWx9wLh3hX0aB1c2d3e4f5g6h7]]></FromUserName>
+<CreateTime>1500000000</CreateTime>
+<MsgType><![CDATA[image]]></MsgType>
+<PicUrl><![CDATA[http://mmbiz.qpic.cn/xxx]]></PicUrl>
+<MediaId><![CDATA[media_id]]></MediaId>
+<MsgId>6436529398871000001</MsgId>
+</xml>''',
+    # 以下样例走ElementTree
+    'nested_event': '''<xml>
+<ToUserName><![CDATA[gh_amwatcher]]></ToUserName>
+<FromUserName><![CDATA[oQWx9wLh3hX0aB1c2d3e4f5g6h7]]></FromUserName>
+<CreateTime>1500000000</CreateTime>
+<MsgType><![CDATA[event]]></MsgType>
+<Event><![CDATA[scancode_push]]></Event>
+<EventKey><![CDATA[key]]></EventKey>
+<ScanCodeInfo><ScanType><![CDATA[qrcode]]></ScanType><ScanResult><![CDATA[1]]></ScanResult></ScanCodeInfo>
+</xml>''',
+    'entity': '<xml><ToUserName>gh</ToUserName><FromUserName>u</FromUserName>'
+        '<CreateTime>1500000000</CreateTime><MsgType>text</MsgType>'
+        '<Content>a &amp; b</Content><MsgId>2</MsgId></xml>',
+    # 含有]]>的文本被拆成两个CDATA段
+    'text_split_cdata': '<xml><ToUserName><![CDATA[gh]]></ToUserName><FromUserName><![CDATA[u]]></FromUserName>'
+        '<CreateTime>1500000000</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+        '<Content><![CDATA[x]]]]><![CDATA[>y]]></Content><MsgId>3</MsgId></xml>',
+    'voice': '''<xml>
+<ToUserName><![CDATA[gh_amwatcher]]></ToUserName>
+<FromUserName><![CDATA[oQWx9wLh3hX0aB1c2d3e4f5g6h7]]></FromUserName>
+<CreateTime>1500000000</CreateTime>
+<MsgType><![CDATA[voice]]></MsgType>
+<MediaId><![CDATA[media_id]]></MediaId>
+<Format><![CDATA[amr]]></Format>
+<MsgId>6436529398871000002</MsgId>
+</xml>''',
+}
+
+def _etree(data):
+    fields = receive._parse_etree(data)
+    return receive.MSG_TYPES.get(fields.get('MsgType'), receive.Msg)(fields)
+
+def _fields(msg):
+    return type(msg), {name: getattr(msg, name) for name in msg.FIELDS}
+
+def run(repeat):
+    failed = 0
+    print('sample             fast   etree   (us/msg)')
+    for name, sample in sorted(SAMPLES.items()):
+        data = sample.encode('utf-8')
+        if _fields(receive.parse_xml(data)) != _fields(_etree(data)):
+            failed += 1
+            print('MISMATCH %s: %r != %r' % (name, receive.parse_xml(data), _etree(data)))
+        fast = fakes.timeit(lambda: receive.parse_xml(data), repeat) * 1000
+        etree = fakes.timeit(lambda: _etree(data), repeat) * 1000
+        print('%-15s %7.1f %7.1f' % (name, fast, etree))
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', default=20000, type=int)
+    args = parser.parse_args()
+    sys.exit(1 if run(args.repeat) else 0)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+''' show_updates在不同关注数量下的耗时
+
+python -m bench.show_updates [--latency 毫秒] [--repeat 次数]
+每次mongo/redis往返都会等待latency毫秒，输出每条消息的平均耗时和往返次数。
+分别在摘要刚生成（fresh）和摘要的updated_at都是一天前（stale）时测量，两种情况的往返次数都应该和关注数量无关。
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import random
+import argparse
+from datetime import datetime, timedelta
+
+from bench import fakes
+
+FOLLOW_SIZES = (1, 10, 100, 500)
+FEEDS_PER_KEYWORD = 10
+
+def seed(mongo_db, keyword_count):
+    now = datetime.now()
+    mongo_db['meta'].insert_one({'type': 'HELP_MESSAGE', 'content': ['help']})
+    keyword_ids = []
+    for i in range(keyword_count):
+        kid = mongo_db['keywords'].insert_one({
+            'keyword': 'keyword-%04d' % i,
+            'alias': [],
+            'type': random.choice(['anime', 'drama', 'variety']),
+            'status': 'activated',
+            'valid_feed_count': FEEDS_PER_KEYWORD,
+        }).inserted_id
+        keyword_ids.append(kid)
+        for ep in range(1, FEEDS_PER_KEYWORD + 1):
+            upload_time = now - timedelta(days=FEEDS_PER_KEYWORD - ep, minutes=i)
+            fid = mongo_db['feeds'].insert_one({
+                'keyword_id': kid,
+                'keyword_title': 'keyword-%04d' % i,
+                'title': 'keyword-%04d 第%s话' % (i, ep),
+                'href': 'http://example.com/%s/%s' % (i, ep),
+                'upload_time': upload_time,
+                'scrapy_time': upload_time,
+                'analyzed': True,
+            }).inserted_id
+            mongo_db['series'].insert_one({
+                'keyword_id': kid,
+                'season': '1',
+                'episode': str(ep).zfill(2),
+                'first_upload_time': upload_time,
+                'feeds': [fid],
+            })
+    return keyword_ids
+
+def run(latency, repeat):
+    mongo_client, redis_db = fakes.install()
+    mongo_db = mongo_client[fakes.backends.local['MONGO_DATABASE']]
+    keyword_ids = seed(mongo_db, max(FOLLOW_SIZES))
+
+    import dialogs
+    import summaries
+    summaries.rebuild_all()
+    # 数据准备好之后才开始模拟网络延迟
+    mongo_client.latency = redis_db.latency = latency / 1000.0
+
+    print('summaries follows    ms/msg   mongo/msg   redis/msg')
+    for age in ('fresh', 'stale'):
+        if age == 'stale':
+            mongo_db['keyword_summary'].update_many({}, {'$set': {'updated_at': datetime.now() - timedelta(days=1)}})
+        for size in FOLLOW_SIZES:
+            open_id = 'bench-user-%s-%s' % (age, size)
+            mongo_db['users'].insert_one({
+                'open_id': open_id,
+                'follow_keywords': keyword_ids[:size],
+                'last_check_time': datetime.now(),
+            })
+            mongo_calls, redis_calls = mongo_client.calls, redis_db.calls
+            cost = fakes.timeit(lambda: dialogs.show_updates(open_id, '!3', None), repeat)
+            print('%9s %7s %8.2f %11.1f %11.1f' % (
+                age, size, cost,
+                (mongo_client.calls - mongo_calls) / repeat,
+                (redis_db.calls - redis_calls) / repeat,
+            ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', default=0.5, type=float, metavar='MS')
+    parser.add_argument('--repeat', default=10, type=int)
+    args = parser.parse_args()
+    run(args.latency, args.repeat)
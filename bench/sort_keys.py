@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+''' 剧集排序字段的顺序检查
+
+python -m bench.sort_keys
+每组编号按从旧到新排列，检查indexes.py算出的排序字段也是严格递增的，不满足时以状态码1退出。
+'''
+import sys
+
+import indexes
+
+EPISODES = [
+    ['-1', '1', '2', '9', '10', '12', '99', '100'],
+    # 合集取第一集
+    ['01-02', '03', '11-12', '13', '99'],
+    ['12', '12.5', '13'],
+    ['第1话', '第9话', '第10话', 'EP11', '第12集'],
+    # 没有编号的排在最前
+    [None, '1'],
+    ['SP', '1'],
+]
+DATE_EPISODES = [
+    ['-1', '2017.04.30', '2017-5-1', '2017/05/02', '2017年5月10日', '20170511', '2018.1.1'],
+    ['17.12.31', '2018-01-01'],
+    [None, '20170101'],
+    ['SP', '20170101'],
+]
+
+def _check(name, number, groups):
+    failed = 0
+    for values in groups:
+        keys = [number(value) for value in values]
+        if any(a >= b for a, b in zip(keys, keys[1:])):
+            failed += 1
+            print('MISORDERED %s: %s' % (name, list(zip(values, keys))))
+    return failed
+
+def run():
+    failed = _check('episode', indexes.sort_number, EPISODES)
+    failed += _check('date_episode', indexes.date_sort_number, DATE_EPISODES)
+    print('%s groups, %s misordered' % (len(EPISODES) + len(DATE_EPISODES), failed))
+    return failed
+
+if __name__ == '__main__':
+    sys.exit(1 if run() else 0)
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+''' 消息处理热路径的基准测试
+
+python -m bench.suite [--keywords 数量] [--feeds 每个keyword的资源数] [--only 名称前缀]
+                      [--save] [--baseline 文件] [--threshold 比例]
+用假后端和接近线上规模的数据（默认2000个keyword、20万条资源）测量：
+    - receive.parse_xml解析、_new_dialog选择会话、_make_pages渲染、reply格式化
+    - dialogs.py中每个会话通过bot.answer端到端处理一条消息
+每项重复执行多轮取中位数，输出每次的耗时和mongo/redis往返次数。
+--save把结果写入基准文件（默认bench/baseline.json），之后的运行和基准比较，
+比基准慢超过threshold的项标记为REGRESSION并以状态码1退出。基准和机器相关，不要提交到仓库。
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+from bench import fakes
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+FEEDS_PER_EPISODE = 4
+FOLLOWS = 50
+ROUNDS = 3
+MIN_TIME = 0.3
+
+TEXT_XML = '''<xml>
+<ToUserName><![CDATA[gh_amwatcher]]></ToUserName>
+<FromUserName><![CDATA[%s]]></FromUserName>
+<CreateTime>%s</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[%s]]></Content>
+<MsgId>%s</MsgId>
+</xml>'''
+
+EVENT_XML = '''<xml>
+<ToUserName><![CDATA[gh_amwatcher]]></ToUserName>
+<FromUserName><![CDATA[%s]]></FromUserName>
+<CreateTime>%s</CreateTime>
+<MsgType><![CDATA[event]]></MsgType>
+<Event><![CDATA[%s]]></Event>
+<EventKey><![CDATA[]]></EventKey>
+</xml>'''
+
+def seed(mongo_db, keyword_count, feeds_per_keyword):
+    ''' 每个keyword的资源按天分布在最近feeds_per_keyword/FEEDS_PER_EPISODE天内，每集FEEDS_PER_EPISODE个资源
+    '''
+    import indexes
+    now = datetime.now()
+    rand = random.Random(0)
+    keywords, feeds, series = [], [], []
+    for i in range(keyword_count):
+        kid = ObjectId()
+        name = 'keyword-%04d' % i
+        keywords.append({
+            '_id': kid,
+            'keyword': name,
+            'alias': ['别名%04d' % i],
+            'type': rand.choice(['anime', 'drama', 'variety']),
+            'status': 'activated',
+            'valid_feed_count': feeds_per_keyword,
+        })
+        episodes = max(feeds_per_keyword // FEEDS_PER_EPISODE, 1)
+        for ep in range(1, episodes + 1):
+            upload_time = now - timedelta(days=episodes - ep, minutes=i)
+            fids = []
+            for n in range(FEEDS_PER_EPISODE):
+                fid = ObjectId()
+                fids.append(fid)
+                feeds.append({
+                    '_id': fid,
+                    'keyword_id': kid,
+                    'keyword_title': name,
+                    'title': '[字幕组%s] %s 第%s话 1080P' % (n, name, ep),
+                    'href': 'http://example.com/%s/%s/%s' % (i, ep, n),
+                    'upload_time': upload_time,
+                    'scrapy_time': upload_time,
+                    'analyzed': True,
+                })
+            episode = {
+                'keyword_id': kid,
+                'season': '1',
+                'episode': str(ep).zfill(2),
+                'first_upload_time': upload_time,
+                'feeds': fids,
+            }
+            # 直接写入排序字段，假后端逐条执行indexes.normalize_series的更新太慢
+            episode.update(indexes.series_sort_keys(episode))
+            series.append(episode)
+    mongo_db['keywords'].insert_many(keywords)
+    mongo_db['feeds'].insert_many(feeds)
+    mongo_db['series'].insert_many(series)
+    indexes.ensure_indexes()
+    mongo_db['meta'].insert_one({'type': 'HELP_MESSAGE', 'content': ['回复剧名搜索', '回复!查看更新', '回复.查看关注']})
+    for n in range(3):
+        mongo_db['meta'].insert_one({
+            'type': 'HELP_LINKS',
+            'order': n,
+            'title': '帮助%s' % n,
+            'description': '帮助说明%s' % n,
+            'url': 'http://example.com/help/%s' % n,
+        })
+    return [kw['_id'] for kw in keywords]
+
+class Chat(object):
+    ''' 以一个用户的身份通过bot.answer发送消息
+    '''
+    def __init__(self, module, open_id):
+        self.module = module
+        self.open_id = open_id
+        self.seq = 0
+
+    def _next(self):
+        # CreateTime和MsgId都不重复，不会被当作微信的重试
+        self.seq += 1
+        return 1500000000 + self.seq, '%s-%s' % (self.open_id, self.seq)
+
+    def say(self, text):
+        from wechat import bot
+        create_time, msg_id = self._next()
+        data = (TEXT_XML % (self.open_id, create_time, text, msg_id)).encode('utf-8')
+        return bot.answer(data, self.module).format()
+
+    def event(self, event):
+        from wechat import bot
+        create_time, msg_id = self._next()
+        data = (EVENT_XML % (self.open_id, create_time, event)).encode('utf-8')
+        return bot.answer(data, self.module).format()
+
+    def reset(self):
+        from wechat import bot
+        ctx = bot.Context(self.module, self.open_id)
+        ctx.reset()
+        ctx.flush()
+
+def measure(func, setup=None, counters=None):
+    ''' 返回每次调用耗时（毫秒）的多轮中位数和每次调用的后端往返次数，setup不计入
+    counters返回当前的往返计数(mongo, redis)
+    '''
+    calls = [0, 0]
+    def once():
+        if setup:
+            setup()
+        before = counters() if counters else (0, 0)
+        start = time.perf_counter()
+        func()
+        cost = time.perf_counter() - start
+        after = counters() if counters else (0, 0)
+        calls[0] += after[0] - before[0]
+        calls[1] += after[1] - before[1]
+        return cost
+    first = once()
+    repeat = max(1, int(MIN_TIME / ROUNDS / max(first, 1e-6)))
+    results = []
+    for i in range(ROUNDS):
+        results.append(sum(once() for j in range(repeat)) * 1000 / repeat)
+    results.sort()
+    count = repeat * ROUNDS + 1
+    return results[len(results) // 2], calls[0] / count, calls[1] / count
+
+def _dialog_case(chat, text, before=(), event=False):
+    def setup():
+        chat.reset()
+        for msg in before:
+            chat.say(msg)
+    send = chat.event if event else chat.say
+    return (lambda: send(text)), setup
+
+def _pin_case(module, open_id):
+    from wechat import bot
+    import settings
+    import backends
+    pin = '123456'
+    def setup():
+        backends.redis_db.setex(settings.PIN_KEY % pin, settings.PIN_EXPIRE, 'EMPTY')
+    def func():
+        # pin_login没有配置在ROUTER里，直接运行这个会话
+        ctx = bot.Context(module, open_id)
+        dialog = module.pin_login(open_id)
+        dialog.send(None)
+        bot._redis_send(ctx, dialog, pin)
+        bot._run(ctx, dialog, 'text', pin)
+        ctx.flush()
+    return func, setup
+
+def cases(mongo_db, keyword_ids):
+    import dialogs
+    from wechat import bot, receive, reply
+
+    open_id = 'bench-user'
+    mongo_db['users'].insert_one({
+        'open_id': open_id,
+        'site': 'main',
+        'active': True,
+        'follow_keywords': keyword_ids[:FOLLOWS],
+        'last_check_time': datetime.now() - timedelta(days=3),
+    })
+    chat = Chat(dialogs, open_id)
+    text_xml = (TEXT_XML % (open_id, 1500000000, '进击的巨人', 1)).encode('utf-8')
+    event_xml = (EVENT_XML % (open_id, 1500000000, 'subscribe')).encode('utf-8')
+    lines = ['%s. keyword-%04d [动画]' % (i, i) for i in range(100)]
+    articles = [{
+        'title': 'title %s' % i,
+        'description': 'description %s' % i,
+        'url': 'http://example.com/%s' % i,
+    } for i in range(5)]
+    prerendered = reply.Prerendered('TextMsg', '\n'.join(lines[:10]))
+
+    yield 'receive.parse_xml.text', (lambda: receive.parse_xml(text_xml)), None
+    yield 'receive.parse_xml.event', (lambda: receive.parse_xml(event_xml)), None
+    for name, text in (('snapshot', '!3'), ('generator', '?'), ('fallback', '进击的巨人')):
+        yield 'bot._new_dialog.%s' % name, (lambda text=text: bot._new_dialog(bot.Context(dialogs, open_id), 'text', text)), None
+    yield 'dialogs._make_page', (lambda: dialogs._make_page(lines[:10], False, prefix='--- 关注列表 ---')), None
+    yield 'dialogs._make_pages.100', (lambda: dialogs._make_pages(lines, 10, prefix='--- 关注列表 ---', end_suffix='--- 结束 ---')), None
+    yield 'reply.TextMsg.format', (lambda: reply.TextMsg(open_id, 'gh_amwatcher', '\n'.join(lines[:10])).format()), None
+    yield 'reply.NewsMsg.format', (lambda: reply.NewsMsg(open_id, 'gh_amwatcher', articles).format()), None
+    yield 'reply.Prerendered.format', (lambda: prerendered(open_id, 'gh_amwatcher').format()), None
+
+    dialog_cases = [
+        ('show_help', '?', ()),
+        ('show_help_link', '??', ()),
+        ('show_updates', '!3', ()),
+        ('show_updates.next', 'N', ('!3',)),
+        ('show_updates.list', 'L', ('!3',)),
+        ('show_all_updates', '!!3', ()),
+        ('show_follows', '.', ()),
+        ('show_follows.next', 'N', ('.',)),
+        ('search_keyword.one', 'keyword-0001', ()),
+        ('search_keyword.many', 'keyword-01', ()),
+        ('search_keyword.all', '..', ()),
+        ('search_keyword.all.next', 'N', ('..',)),
+        ('search_keyword.all.select', '3', ('..',)),
+        ('search_keyword.regex', '^keyword-00[0-4]', ()),
+        ('search_keyword.select', '3', ('keyword-01',)),
+        ('search_keyword.follow', 'F3', ('keyword-01',)),
+        ('search_keyword.feeds', 'L', ('keyword-0001',)),
+        ('search_keyword.feeds.next', 'N', ('keyword-0001', 'L')),
+    ]
+    for name, text, before in dialog_cases:
+        func, setup = _dialog_case(chat, text, before)
+        yield 'dialog.%s' % name, func, setup
+    for name, event in (('deactive_user', 'unsubscribe'), ('active_user', 'subscribe')):
+        func, setup = _dialog_case(chat, event, event=True)
+        yield 'dialog.%s' % name, func, setup
+    func, setup = _pin_case(dialogs, open_id)
+    yield 'dialog.pin_login', func, setup
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def run(args):
+    mongo_client, redis_db = fakes.install()
+    mongo_db = mongo_client[fakes.backends.local['MONGO_DATABASE']]
+    start = time.time()
+    keyword_ids = seed(mongo_db, args.keywords, args.feeds)
+
+    import settings
+    import summaries
+    import rollups
+    settings.ASYNC_REPLY = False
+    summaries.rebuild_all()
+    rollups.rebuild_all()
+    sizes = {'keywords': args.keywords, 'feeds': args.keywords * args.feeds}
+    print('seeded %(keywords)s keywords, %(feeds)s feeds' % sizes + ' in %.1fs' % (time.time() - start))
+
+    baseline = load_baseline(args.baseline)
+    if baseline and baseline['sizes'] != sizes:
+        print('baseline %s was recorded with %s, not comparing' % (args.baseline, baseline['sizes']))
+        baseline = None
+    base_results = baseline['results'] if baseline else {}
+
+    counters = lambda: (mongo_client.calls, redis_db.calls)
+    results = {}
+    regressions = []
+    print('%-32s %10s %8s %8s %10s %8s' % ('case', 'ms/op', 'mongo', 'redis', 'baseline', 'change'))
+    # 回复会被print到标准输出，测量时丢掉
+    with open(os.devnull, 'w') as devnull:
+        for name, func, setup in cases(mongo_db, keyword_ids):
+            if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                continue
+            with contextlib.redirect_stdout(devnull):
+                cost, mongo_per_op, redis_per_op = measure(func, setup, counters)
+            results[name] = cost
+            line = '%-32s %10.3f %8.1f %8.1f' % (name, cost, mongo_per_op, redis_per_op)
+            if name in base_results:
+                change = cost / base_results[name] - 1
+                line += ' %10.3f %+7.1f%%' % (base_results[name], change * 100)
+                if change > args.threshold:
+                    regressions.append(name)
+                    line += '  REGRESSION'
+            print(line)
+
+    if args.save:
+        saved = load_baseline(args.baseline) or {}
+        if saved.get('sizes') != sizes:
+            saved = {'sizes': sizes, 'results': {}}
+        saved['results'].update(results)
+        saved['recorded_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with open(args.baseline, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+        print('baseline saved to %s' % args.baseline)
+    if regressions:
+        print('%s regressions over %.0f%%: %s' % (len(regressions), args.threshold * 100, ', '.join(regressions)))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keywords', default=2000, type=int)
+    parser.add_argument('--feeds', default=100, type=int, help='每个keyword的资源数')
+    parser.add_argument('--only', default=None, action='append', metavar='PREFIX')
+    parser.add_argument('--save', default=False, action='store_true')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', default=0.2, type=float)
+    args = parser.parse_args()
+    sys.exit(1 if run(args) else 0)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+''' worker内的缓存
+
+RefreshingCache: 第一次使用时同步加载，之后超过ttl秒的数据先照常返回，同时在后台重新加载
+（stale-while-revalidate），加载失败时保留旧数据并记录日志，下一次访问再重试。
+LRUCache: 有数量上限的LRU，每一项超过ttl秒后失效。
+'''
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('__main__.cache')
+
+class RefreshingCache(object):
+    def __init__(self, name, loader, ttl):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.value = None
+        self.loaded_at = None
+        self.refreshing = False
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            value = self.loader()
+        except Exception:
+            logger.exception('%s refresh failed', self.name)
+        else:
+            self.value = value
+            self.loaded_at = time.time()
+        finally:
+            self.refreshing = False
+        return self.value
+
+    def invalidate(self):
+        ''' 数据有变化时调用，下一次访问会触发后台刷新
+        '''
+        if self.loaded_at is not None:
+            self.loaded_at = 0
+
+    def get(self):
+        if self.loaded_at is None:
+            # 还没有数据时只能等待加载，同一时间只有一个greenlet去加载
+            with self._lock:
+                if self.loaded_at is None:
+                    self.refresh()
+            if self.loaded_at is None:
+                raise Exception('%s unavailable' % self.name)
+            return self.value
+        if time.time() - self.loaded_at > self.ttl and not self.refreshing:
+            self.refreshing = True
+            # gevent monkey patch之后这是一个greenlet
+            threading.Thread(target=self.refresh, daemon=True).start()
+        return self.value
+
+class LRUCache(object):
+    ''' 有数量上限和过期时间的LRU缓存
+    '''
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, expire_at = self.data[key]
+        except KeyError:
+            return default
+        if expire_at < time.time():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = (value, time.time() + self.ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+''' worker内共用的redis订阅
+
+每个worker只有一个greenlet用psubscribe接收所有登记过的频道，收到消息后按频道的模式交给登记的函数，
+各个模块不用各自占用一个redis连接和一个greenlet。
+模块在import时调用register登记，第一次需要收到通知时调用ensure_listener启动本worker的greenlet。
+订阅断开重连时收不到期间的消息，重新订阅后会调用登记的on_subscribe，让模块自己补救（例如清空缓存）。
+'''
+import os
+import time
+import logging
+import threading
+
+import backends
+
+logger = logging.getLogger('__main__.channels')
+
+# 模式 -> (on_message(channel, data), on_subscribe)
+_handlers = {}
+_listener_pid = None
+
+def register(pattern, on_message, on_subscribe=None):
+    ''' 登记一个频道模式，必须在ensure_listener之前（模块import时）调用
+    '''
+    if _listener_pid == os.getpid():
+        raise RuntimeError('Channel %s registered after the listener started' % pattern)
+    _handlers[pattern] = (on_message, on_subscribe)
+
+def _listen():
+    while True:
+        try:
+            pubsub = backends.redis_db.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(*_handlers)
+            for on_message, on_subscribe in _handlers.values():
+                if on_subscribe is not None:
+                    on_subscribe()
+            for message in pubsub.listen():
+                if message['type'] != 'pmessage':
+                    continue
+                on_message, on_subscribe = _handlers[message['pattern'].decode('utf-8')]
+                on_message(message['channel'].decode('utf-8'), message['data'].decode('utf-8'))
+        except Exception:
+            logger.exception('Channel listener failed, reconnecting...')
+            time.sleep(1)
+
+def ensure_listener():
+    global _listener_pid
+    # 监听的greenlet只属于创建它的worker
+    if _listener_pid != os.getpid():
+        _listener_pid = os.getpid()
+        threading.Thread(target=_listen, daemon=True).start()
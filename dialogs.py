@@ -5,29 +5,26 @@ import re
 import settings
 import logging
 import random
-from redis import StrictRedis
-from pymongo import MongoClient, DESCENDING, ASCENDING
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
 from flask import url_for
-from wechat.bot import UnexpectAnswer
+from wechat.bot import UnexpectAnswer, snapshot, background
+from wechat.router import Router
+from wechat.reply import Prerendered
 from datetime import datetime, timedelta
-from collections import defaultdict
-from bson import json_util
-
-logger = logging.getLogger('__main__')
-
-local = settings.LOCAL_CONFIG
-redis_db = StrictRedis(
-    host=local['REDIS_HOST'], 
-    port=local['REDIS_PORT'], 
-    password=local['REDIS_PASSWORD'],
-    db=local['REDIS_DB']
-)
-def mongoCollection(cname):
-    mongo_client = MongoClient(local['MONGO_URI'])
-    mongo_db = mongo_client[local['MONGO_DATABASE']]
-    return mongo_db[cname]
-
-ROUTER = {
+from collections import defaultdict, Counter
+from bson.objectid import ObjectId
+from backends import mongoCollection, redis_db
+import keyword_index
+import repository
+import rollups
+from cache import RefreshingCache
+from users import invalidate_user
+import pin_notify
+
+logger = logging.getLogger('__main__.dialogs')
+
+ROUTER = Router({
     'text': [
         ('^[\?\？]$', 'show_help'),
         ('^[\?\？]{2}$', 'show_help_link'),
@@ -42,7 +39,7 @@ ROUTER = {
         ('^unsubscribe$', 'deactive_user'),
         ('.*', 'show_help'),
     ],
-}
+})
 
 TYPE_TXT = {
     'anime': '动画',
@@ -52,126 +49,177 @@ TYPE_TXT = {
 
 
 def _keyword_summary(keyword):
-    mongo_feeds = mongoCollection('feeds')
-    mongo_series = mongoCollection('series')
-    text = '[%s] %s' % (TYPE_TXT[keyword['type']], keyword['keyword'])
+    summary = repository.keyword_summary(keyword._id)
+    text = '[%s] %s' % (TYPE_TXT[keyword.type], keyword.keyword)
     text += '\n-----\n'
-    feeds = list(mongo_feeds.find({
-        'keyword_id': keyword['_id'], 
-        'break_rules': {
-            '$exists': False,
-        },
-    }).sort('upload_time', DESCENDING))
-    text += '最后更新：%s \n' % feeds[0]['upload_time'].strftime('%Y-%m-%d')
+    if summary.last_upload_time:
+        text += '最后更新：%s \n' % summary.last_upload_time.strftime('%Y-%m-%d')
     
     # 最近更新的ep，date_ep
     text += '更新至：' 
-    last_ep_series = list(mongo_series.find({'keyword_id': keyword['_id']}, sort=[('season', DESCENDING), ('episode', DESCENDING), ('date_episode', DESCENDING)]))
-    last_date_ep_series = list(mongo_series.find({'keyword_id': keyword['_id']}, sort=[('season', DESCENDING), ('date_episode', DESCENDING), ('episode', DESCENDING)]))
-    if last_ep_series[0]['first_upload_time'] >= last_date_ep_series[0]['first_upload_time']:
-        last_series = last_ep_series[0]
-    else:
-        last_series = last_date_ep_series[0]
-
-    if 'season' in last_series and last_series['season'] != '-1':
-        text += '第%s季 ' % last_series['season']
-    if 'episode' in last_series:
-        text += '第%s话 ' % last_series['episode']
-    if 'date_episode' in last_series:
-        text += last_series['date_episode']
-    last_series_index = 0
-    return text, feeds, last_ep_series, last_series
+    if summary.season is not None and summary.season != '-1':
+        text += '第%s季 ' % summary.season
+    if summary.episode is not None:
+        text += '第%s话 ' % summary.episode
+    if summary.date_episode is not None:
+        text += summary.date_episode
+    return text
     
-def _make_page(text_list, page_size, prefix='', suffix='--- 回复N翻页 ---', end_suffix=''):
-    idx = 0
-    show_list = text_list[idx: idx+page_size]
-    while True:
-        text = prefix
-        if text:
-            text += '\n'
-        text += '\n'.join(show_list)
-        
-        idx += page_size
+def _make_page(show_list, is_last, prefix='', suffix='--- 回复N翻页 ---', end_suffix=''):
+    text = prefix
+    if text:
+        text += '\n'
+    text += '\n'.join(show_list)
+    if not is_last:
+        if suffix:
+            text += '\n' + suffix
+    # 最后一页了，显示end_suffix
+    elif end_suffix:
+        text += '\n' + end_suffix
+    return text
+
+def _make_pages(text_list, page_size, prefix='', suffix='--- 回复N翻页 ---', end_suffix=''):
+    ''' 一次渲染出所有页，列表为空时也有一页
+    '''
+    pages = []
+    for idx in range(0, max(len(text_list), 1), page_size):
         show_list = text_list[idx: idx+page_size]
-        if len(show_list) > 0:
-            if suffix:
-                text += '\n' + suffix
-            yield ('TextMsg', text), False
-        # 最后一页了，显示end_suffix
-        else:
-            if end_suffix:
-                text += '\n' + end_suffix
-            yield ('TextMsg', text), True
-            return
+        is_last = idx + page_size >= len(text_list)
+        pages.append(_make_page(show_list, is_last, prefix, suffix, end_suffix))
+    return pages
 
-# 从MONGO里面读取HELP_LINKS和HELP_MESSAGE
-meta = mongoCollection('meta')
-HELP_LINKS = ('NewsMsg', list(meta.find({'type': 'HELP_LINKS'}, sort=[('order', ASCENDING)])))
-HELP_MESSAGE = '\n'.join( meta.find_one({'type': 'HELP_MESSAGE'})['content'] )
+def _cache_pages(to_user, name, pages):
+    ''' 把渲染好的页面存入redis list，过期时间和会话一致
+    之后的翻页直接按页码读取，不再查询mongo
+    '''
+    key = settings.PAGE_KEY % (to_user, name)
+    pipe = redis_db.pipeline()
+    pipe.delete(key)
+    pipe.rpush(key, *pages)
+    pipe.expire(key, settings.CONTEXT_EXPIRE)
+    pipe.execute()
+    return len(pages)
+
+def _cached_page(to_user, name, page):
+    ''' 读取缓存的页面并刷新过期时间
+    '''
+    key = settings.PAGE_KEY % (to_user, name)
+    pipe = redis_db.pipeline()
+    pipe.lindex(key, page)
+    pipe.expire(key, settings.CONTEXT_EXPIRE)
+    text, _ = pipe.execute()
+    if text is None:
+        # 缓存已经不存在，只能重新开始会话
+        logger.error('页面缓存丢失: %s', key)
+        raise UnexpectAnswer
+    return text.decode('utf-8')
+
+def _edit_cached_line(to_user, name, page, num, edit):
+    ''' 修改缓存页面中编号为num的行，edit返回None时删除该行
+    '''
+    lines = []
+    for line in _cached_page(to_user, name, page).split('\n'):
+        if line.startswith('%s. ' % num):
+            line = edit(line)
+            if line is None:
+                continue
+        lines.append(line)
+    text = '\n'.join(lines)
+    redis_db.lset(settings.PAGE_KEY % (to_user, name), page, text)
+    return text
+
+def _has_next(state):
+    return state['page'] + 1 < state['pages']
+
+def _dump_ids(ids):
+    # 会话快照需要能够json序列化，ObjectId存为字符串
+    return [str(i) for i in ids]
+
+def _load_meta():
+    ''' 从MONGO里面读取HELP_LINKS和HELP_MESSAGE
+    帮助和欢迎消息是最常见的回复，预先渲染好
+    '''
+    meta = mongoCollection('meta')
+    return {
+        'HELP_LINKS': ('NewsMsg', Prerendered('NewsMsg', list(meta.find({'type': 'HELP_LINKS'}, sort=[('order', ASCENDING)])))),
+        'HELP_MESSAGE': ('TextMsg', Prerendered('TextMsg', '\n'.join( meta.find_one({'type': 'HELP_MESSAGE'})['content'] ))),
+    }
+
+# 第一次用到时才读取，修改后的内容在META_CACHE_TTL秒内生效
+META = RefreshingCache('Meta', _load_meta, settings.META_CACHE_TTL)
 
 def show_help(to_user):
     yield None
     msg_content, is_replay = yield None
-    return ('TextMsg', HELP_MESSAGE)
+    return META.get()['HELP_MESSAGE']
 
 def show_help_link(to_user):
     yield None
     msg_content, is_replay = yield None
-    return HELP_LINKS      
+    return META.get()['HELP_LINKS']
+
+@background
+@snapshot
+def show_all_updates(to_user, msg_content, state):
+    if state is not None:
+        if msg_content in ['N', 'n'] and _has_next(state):
+            state['page'] += 1
+            msg = ('TextMsg', _cached_page(to_user, 'all_updates', state['page']))
+            # 最后一页之后的任何回复都是新会话
+            return msg, (state if _has_next(state) else None)
+        raise UnexpectAnswer
 
-def show_all_updates(to_user):
-    yield None
-    msg_content, is_replay = yield None
     now_time = datetime.now()
     back_days = 7
     try:
         back_days = int(msg_content.replace("!", "").replace("！", ""))
     except ValueError:
         pass
+    back_days = max(0, min(back_days, settings.UPDATES_MAX_DAYS))
     last_check_time = now_time - timedelta(days=back_days)
-    mongo_feeds = mongoCollection('feeds')
-    # 获取所有新资源
-    updated_keywords = mongo_feeds.aggregate([
-        {'$match': {
-            'scrapy_time': { '$gte': last_check_time }, # 获取在上次爬取后新增的资源
-            'upload_time': { '$gte': last_check_time - timedelta(days=5) }, # 同时upload_time必须在一周内,避免因搜索排名导致的误更新
-            'break_rules': { '$exists': False },
-            'analyzed': True,
-        }},
-        {'$group': {
-            "_id": {
-                "keyword": "$keyword_title",
-            },
-            "last_update": { "$max": "$upload_time" },
-        }},
-        {'$sort': {'last_update': -1}},
-    ])
+    # 获取所有新资源，按天的汇总见rollups.py
     summary_text_list = []
-    for item in updated_keywords:
-        keyword = item['_id']['keyword']
-        last_update = item['last_update'].strftime('%Y-%m-%d')
-        summary_text_list.append('%s => 更新时间：%s' % (keyword, last_update))
+    for keyword, last_update in rollups.last_updates(last_check_time):
+        summary_text_list.append('%s => 更新时间：%s' % (keyword, last_update.strftime('%Y-%m-%d')))
 
     if not summary_text_list:
-        return ('TextMsg', '该时段无资源更新！' % last_check_time.strftime('%Y/%m/%d %H:%M'))
-    if back_days > 0:
-        prefix = '--- %s天内的所有更新 ---' % back_days
-    
-    for msg, is_last in _make_page(
-        summary_text_list, 10, 
-        prefix=prefix, 
+        return ('TextMsg', '该时段无资源更新！'), None
+    pages = _make_pages(
+        summary_text_list, 10,
+        prefix='--- %s天内的所有更新 ---' % back_days, 
         suffix= '--- 回复N翻页 ---',
-    ):
-        selected, is_replay = yield msg
-        if selected in ['N', 'n'] and not is_last:
-            continue
-        else:
-            raise UnexpectAnswer    
+    )
+    if len(pages) == 1:
+        return ('TextMsg', pages[0]), None
+    state = {
+        'page': 0,
+        'pages': _cache_pages(to_user, 'all_updates', pages),
+    }
+    return ('TextMsg', pages[0]), state
 
-def show_updates(to_user):
-    yield None
-    msg_content, is_replay = yield None
+@background
+@snapshot
+def show_updates(to_user, msg_content, state):
+    if state is None:
+        return _check_updates(to_user, msg_content)
+    if state['step'] == 'summary':
+        if msg_content in ['N', 'n'] and _has_next(state):
+            state['page'] += 1
+            return ('TextMsg', _cached_page(to_user, 'updates', state['page'])), state
+        elif msg_content in ['L', 'l']:
+            state['step'] = 'list'
+            state['page'] = 0
+            state['pages'] = state.pop('list_pages')
+        else:
+            raise UnexpectAnswer
+    elif msg_content in ['N', 'n'] and _has_next(state):
+        state['page'] += 1
+    else:
+        raise UnexpectAnswer
+    msg = ('TextMsg', _cached_page(to_user, 'updates_list', state['page']))
+    return msg, (state if _has_next(state) else None)
 
+def _check_updates(to_user, msg_content):
     now_time = datetime.now()
     back_days = 0
     try:
@@ -179,240 +227,211 @@ def show_updates(to_user):
     except ValueError:
         pass
     
-    mongo_feeds = mongoCollection('feeds')
-    mongo_series = mongoCollection('series')
-    mongo_users = mongoCollection('users')
-    mongo_keywords = mongoCollection('keywords')
-    
     # 获取用户关注的keyword和它的最新剧集
-    user = mongo_users.find_one({'open_id': to_user})
-    if 'last_check_time' not in user:
-        user['last_check_time'] = now_time
+    user = repository.user_follows(to_user)
     # 没关注的用户显示提示
-    if 'follow_keywords' not in user or not user['follow_keywords']:
-        return ('TextMsg', '您还没有关注资源哦，回复剧名搜索或者回复".."列出所有资源~')
+    if not user.follow_keywords:
+        return ('TextMsg', '您还没有关注资源哦，回复剧名搜索或者回复".."列出所有资源~'), None
     if back_days == 0:
-        last_check_time = user['last_check_time'] 
-        if now_time - last_check_time > timedelta(days=30): # 最多显示1个月内的更新，避免内容过多
-            last_check_time = now_time - timedelta(days=30)
-    else:
-        last_check_time = now_time - timedelta(days=back_days)
-    logger.debug(last_check_time)
-    
-    lkey = settings.LAST_CHECK_KEY % to_user
-    if not is_replay and back_days == 0:
-        # 获取更新查看时间，并保存到REDIS缓存
-        last_check_time = user['last_check_time'] 
+        last_check_time = user.last_check_time or now_time
         if now_time - last_check_time > timedelta(days=30): # 最多显示1个月内的更新，避免内容过多
             last_check_time = now_time - timedelta(days=30)
+        # 更新查看时间，翻页时不会再执行到这里
         logger.debug('Write update to mongo...')
-        mongo_users.find_one_and_update(
-            { 'open_id': to_user }, 
-            {
-                '$set': { 'last_check_time': now_time },
-            }
-        )
-        last_check_time_str = datetime.strftime(last_check_time, '%Y-%m-%d %H:%M:%S')
-        redis_db.setex(lkey, 300, last_check_time_str)
-    elif back_days > 0:
-        last_check_time = now_time - timedelta(days=back_days)
+        repository.mark_checked(to_user, now_time)
     else:
-        # REPLAY情况下读取REDIS缓存获得更新时间
-        try:
-            redis_db.expire(lkey, 300)
-            last_check_time_str = redis_db.get(lkey).decode('utf-8')
-            last_check_time = datetime.strptime(last_check_time_str, '%Y-%m-%d %H:%M:%S')
-        except Exception:
-            raise UnexpectAnswer
-            
+        last_check_time = now_time - timedelta(days=back_days)
     logger.debug(last_check_time)
     
     # 获取所有新资源
-    new_feeds = list(mongo_feeds.find({
-        'keyword_id': { '$in': user['follow_keywords'] },
-        'scrapy_time': { '$gte': last_check_time }, # 获取在上次爬取后新增的资源
-        'upload_time': { '$gte': last_check_time - timedelta(days=5) }, # 同时upload_time必须在一周内,避免因搜索排名导致的误更新
-        'break_rules': {'$exists': False},
-        'analyzed': True,
-    }).sort('upload_time', DESCENDING))
+    follow_list = user.follow_keywords
+    # 获取在上次爬取后新增的资源，同时upload_time必须在一周内,避免因搜索排名导致的误更新
+    new_feeds = repository.new_feeds(follow_list, last_check_time, last_check_time - timedelta(days=5))
     
-    text_list = ['%(title)s\n%(href)s' % f for f in new_feeds]
-    fid_list = [f['_id'] for f in new_feeds]
+    text_list = ['%s\n%s' % (f.title, f.href) for f in new_feeds]
+    fid_set = set(f._id for f in new_feeds)
+    new_feed_count = Counter(f.keyword_id for f in new_feeds)
     
+    # 所有关注的keyword和它们的摘要各一次查询取出
+    keywords = {kw._id: kw for kw in repository.keywords_by_ids(follow_list)}
+    summaries = repository.keyword_summaries(follow_list)
     summary_text_list = []
-    for kid in user['follow_keywords']:
-        keyword = mongo_keywords.find_one({'_id': kid})
-        last_ep_series = list(mongo_series.find({'keyword_id': keyword['_id']}, sort=[('season', DESCENDING), ('episode', DESCENDING), ('date_episode', DESCENDING)]))
-        last_date_ep_series = list(mongo_series.find({'keyword_id': keyword['_id']}, sort=[('season', DESCENDING), ('date_episode', DESCENDING), ('episode', DESCENDING)]))
-        if not last_ep_series:
+    for kid in follow_list:
+        keyword = keywords.get(kid)
+        last_series = summaries[kid]
+        # keyword已删除或者还没有剧集
+        if not keyword or last_series.feeds is None:
             continue
-        if last_ep_series[0]['first_upload_time'] >= last_date_ep_series[0]['first_upload_time']:
-            last_series = last_ep_series[0]
-        else:
-            last_series = last_date_ep_series[0]
-        # last_series = last_series[0]
-        if 'episode' in last_series:
-            last_ep_text = '第%s话' % last_series['episode']
-        else:
-            last_ep_text = last_series['date_episode']
-        new_feed_count = 0
-        for fid in last_series['feeds']:
-            if fid not in fid_list:
-                break
+        if last_series.episode is not None:
+            last_ep_text = '第%s话' % last_series.episode
         else:
+            last_ep_text = last_series.date_episode
+        if fid_set.issuperset(last_series.feeds):
             # 最新话资源都是这次在这次更新中=>更新了新一集
-            summary_text_list.append('%s[%s] 更新至 %s' % (keyword['keyword'], TYPE_TXT[keyword['type']], last_ep_text))
-            continue
-        # 并不是新一集
-        new_feed_count = 0
-        for f in new_feeds:
-            if f['keyword_id'] == kid:
-                new_feed_count += 1
-        if new_feed_count > 0:
-            summary_text_list.append('%s[%s] 有%s个新资源' % (keyword['keyword'], TYPE_TXT[keyword['type']], new_feed_count))
+            summary_text_list.append('%s[%s] 更新至 %s' % (keyword.keyword, TYPE_TXT[keyword.type], last_ep_text))
+        elif new_feed_count[kid] > 0:
+            # 并不是新一集
+            summary_text_list.append('%s[%s] 有%s个新资源' % (keyword.keyword, TYPE_TXT[keyword.type], new_feed_count[kid]))
 
     if not summary_text_list:
-        return ('TextMsg', '从上次查看[%s]到现在，关注的资源没有更新哦' % last_check_time.strftime('%Y/%m/%d %H:%M'))
+        return ('TextMsg', '从上次查看[%s]到现在，关注的资源没有更新哦' % last_check_time.strftime('%Y/%m/%d %H:%M')), None
     if back_days > 0:
         prefix = '--- %s天内的更新 ---' % back_days
     else:
         prefix = '--- %s后的更新 ---' % last_check_time.strftime('%m/%d %H:%M')
     
-    for msg, is_last in _make_page(
+    pages = _make_pages(
         summary_text_list, 10, 
         prefix=prefix, 
         suffix= '--- 回复N翻页，回复L显示详细列表 ---',
         end_suffix='--- 回复L显示详细列表 ---'
-    ):
-        selected, is_replay = yield msg
-        if selected in ['N', 'n'] and not is_last:
-            continue
-        elif selected in ['L', 'l']:
-            for list_msg, is_last in _make_page(
-                text_list, 5, 
-                suffix= '--- 回复N翻页 ---',
-                end_suffix='--- 结束 ---'
-            ):
-                selected, is_replay = yield list_msg
-                if selected in ['N', 'n'] and not is_last:
-                    continue
-                else:
-                    raise UnexpectAnswer
-        else:
-            raise UnexpectAnswer        
+    )
+    # 详细列表也在这里一起渲染，回复L和翻页时都不需要再查询
+    list_pages = _make_pages(
+        text_list, 5, 
+        suffix= '--- 回复N翻页 ---',
+        end_suffix='--- 结束 ---'
+    )
+    state = {
+        'step': 'summary',
+        'page': 0,
+        'pages': _cache_pages(to_user, 'updates', pages),
+        'list_pages': _cache_pages(to_user, 'updates_list', list_pages),
+    }
+    return ('TextMsg', pages[0]), state
        
 def pin_login(to_user):
     yield None
     msg_content, is_replay = yield None
     
-    mongo_users = mongoCollection('users')
     pin_key = settings.PIN_KEY % msg_content
     pin_val = redis_db.get(pin_key)
     if not pin_val:
         return ('TextMsg', '您输入的PIN码不存在')
     else:
+        user_exists = repository.activate_user(to_user)
+        invalidate_user(to_user)
+        # 用户记录写入之后再绑定并通知，被唤醒的登录页面一定能查到这个用户
         redis_db.setex(pin_key, 30, to_user)
-        res = mongo_users.update({
-            'open_id': to_user,
-            'site': 'main',
-        },{
-            '$set': {
-                'active': True,
-                'open_id': to_user,
-                'site': 'main',
-            }
-        }, upsert=True)
-        user_exists = res['updatedExisting']
+        pin_notify.notify(msg_content, to_user)
         if user_exists:
             return ('TextMsg', '登陆成功！浏览器将自动跳转。')
         else:
             return ('TextMsg', '欢迎使用点剧，浏览器将自动跳转。')
 
-def show_follows(to_user):
-    yield None # send none for start
-    msg_content, is_replay = yield None # Initial value
-    
-    mongo_users = mongoCollection('users')
-    mongo_keywords = mongoCollection('keywords')
-    user = mongo_users.find_one({'open_id': to_user})
-    if 'follow_keywords' not in user or not user['follow_keywords']:
-        return ('TextMsg', '您还没有关注资源哦，回复剧名搜索或者回复"!!"随便看看吧~')
-    follow_list = user['follow_keywords']
-    keywords = list(mongo_keywords.find({'_id': {'$in': follow_list}}))
-    num = 0
-    text_list = []
-    already_followed = {}
-    for kw in keywords:
-        text_list.append('%s. %s [%s]' % (num, kw['keyword'], TYPE_TXT[kw['type']]))
-        num += 1
-    for msg, is_last in _make_page(
-        text_list, 10, 
-        prefix='【回复F加数字(如F2)取关】\n--- 关注列表 ---',
-        suffix='--- 回复N翻页 回复数字选择 ---', 
-        end_suffix='--- 回复数字选择 ---'
-    ):
-        selected, is_replay = yield msg
-        if selected in ['N', 'n'] and not is_last:
-            continue
-        try:
-            while True:
-                if selected[0] in ['F', 'f']:
-                    selected = int(selected[1:])
-                    keyword = keywords[selected]
-                    logger.debug(keyword)
-                    if not is_replay:
-                        msg_type, msg_content = _try_follow(to_user, True, keyword)
-                        clear_msg = re.sub('%s.*\n' % selected, '' ,msg[1])
-                        msg_content = '%s\n(%s)' % (clear_msg, msg_content)
-                    else:
-                        msg_content = 'none'
-                    selected, is_replay = yield ('TextMsg', msg_content)
-                else:
-                    logger.debug(selected)
-                    break
-            if selected in ['N', 'n'] and not is_last:
-                continue
-            selected = int(selected)
-            if selected > len(keywords) or selected < 0:
-                raise TypeError
-            logger.debug(keywords[selected]['keyword'])
-            raise UnexpectAnswer(keywords[selected]['keyword'])
-        except UnexpectAnswer as e:
-            raise e
-        except Exception:
-            raise UnexpectAnswer
+@snapshot
+def show_follows(to_user, msg_content, state):
+    if state is None:
+        user = repository.user_follows(to_user)
+        if not user.follow_keywords:
+            return ('TextMsg', '您还没有关注资源哦，回复剧名搜索或者回复"!!"随便看看吧~'), None
+        keywords = repository.keywords_by_ids(user.follow_keywords)
+        text_list = []
+        for num, kw in enumerate(keywords):
+            text_list.append('%s. %s [%s]' % (num, kw.keyword, TYPE_TXT[kw.type]))
+        pages = _make_pages(
+            text_list, 10, 
+            prefix='【回复F加数字(如F2)取关】\n--- 关注列表 ---',
+            suffix='--- 回复N翻页 回复数字选择 ---', 
+            end_suffix='--- 回复数字选择 ---'
+        )
+        state = {
+            'page': 0,
+            'pages': _cache_pages(to_user, 'follows', pages),
+            'ids': _dump_ids(kw._id for kw in keywords),
+        }
+        return ('TextMsg', pages[0]), state
+
+    selected = msg_content
+    if selected in ['N', 'n'] and _has_next(state):
+        state['page'] += 1
+        return ('TextMsg', _cached_page(to_user, 'follows', state['page'])), state
+    try:
+        if selected[0] in ['F', 'f']:
+            selected = int(selected[1:])
+            keyword = _find_keyword(state['ids'][selected])
+            logger.debug(keyword)
+            msg_type, msg_content = _try_follow(to_user, True, keyword)
+            # 取关的资源从缓存的页面中删掉
+            _edit_cached_line(to_user, 'follows', selected // 10, selected, lambda line: None)
+            msg_content = '%s\n(%s)' % (_cached_page(to_user, 'follows', state['page']), msg_content)
+            return ('TextMsg', msg_content), state
+        selected = int(selected)
+        if selected >= len(state['ids']) or selected < 0:
+            raise TypeError
+        keyword = _find_keyword(state['ids'][selected])
+        logger.debug(keyword.keyword)
+        raise UnexpectAnswer(keyword.keyword)
+    except UnexpectAnswer as e:
+        raise e
+    except Exception:
+        raise UnexpectAnswer
+
+def _find_keyword(kid):
+    return repository.find_keyword(kid)
 
 def _try_follow(to_user, already_followed, keyword):
-    mongo_users = mongoCollection('users')
     if already_followed:
-        mongo_users.find_one_and_update({
-            'open_id': to_user
-        }, 
-        {
-            '$pull': {
-                'follow_keywords': keyword['_id'],
-            }
-        })
-        return ('TextMsg', '%s取关成功!' % keyword['keyword'])
+        repository.unfollow(to_user, keyword._id)
+        return ('TextMsg', '%s取关成功!' % keyword.keyword)
     else:
-        mongo_users.find_one_and_update({
-            'open_id': to_user
-        }, 
-        {
-            '$addToSet': { 'follow_keywords': keyword['_id'] },
-        }, upsert=True)
-        return ('TextMsg', '%s关注成功!' % keyword['keyword'])
+        repository.follow(to_user, keyword._id)
+        return ('TextMsg', '%s关注成功!' % keyword.keyword)
             
-def search_keyword(to_user):
-    yield None # send none for start
-    msg_content, is_replay = yield None # Initial value
-    
-    mongo_keywords = mongoCollection('keywords')
-    mongo_feeds = mongoCollection('feeds')
-    mongo_series = mongoCollection('series')
-    mongo_users = mongoCollection('users')
+FEED_PAGE_SIZE = 5
+
+def _feed_page(state):
+    ''' 详细资源列表的下一页，快照中保存下一页开始的位置
+    每页只查询这一页的资源，和keyword的资源总数无关
+    '''
+    feeds, state['cursor'] = repository.feed_page(state['keyword_id'], FEED_PAGE_SIZE, state['cursor'])
+    text_list = ['%s\n%s' % (feed.title, feed.href) for feed in feeds]
+    if state['followed']:
+        suffix_follow = '回复F取关'
+    else:
+        suffix_follow = '回复F关注'
+    return _make_page(
+        text_list, state['cursor'] is None,
+        suffix='--- 回复N翻页 %s ---' % suffix_follow,
+        end_suffix='--- %s ---' % suffix_follow
+    )
+
+@snapshot
+def search_keyword(to_user, msg_content, state):
+    if state is None:
+        return _search(to_user, msg_content)
+    if state['step'] == 'select':
+        return _select_keyword(to_user, msg_content, state)
     
-    user = mongo_users.find_one({'open_id': to_user})
+    if msg_content in ['F', 'f']:
+        keyword = _find_keyword(state['keyword_id'])
+        if keyword is None:
+            # 显示之后被删除的keyword
+            raise UnexpectAnswer
+        return _try_follow(to_user, state['followed'], keyword), None
+    if state['step'] == 'summary':
+        if msg_content in ['L', 'l']:
+            state['step'] = 'feeds'
+            state['cursor'] = None
+            return ('TextMsg', _feed_page(state)), state
+    elif msg_content in ['N', 'n'] and state['cursor'] is not None:
+        return ('TextMsg', _feed_page(state)), state
+    raise UnexpectAnswer
+
+SEARCH_PAGE_SIZE = 10
+SEARCH_PREFIX = '【回复F加数字(如F2)可以直接关注/取关资源哦】\n--- 找到了多个资源 ---'
+SEARCH_SUFFIX = '--- 回复N翻页 回复数字选择 ---'
+SEARCH_END_SUFFIX = '--- 回复数字选择 ---'
+# ObjectId的二进制长度
+ID_SIZE = 12
+
+def _search_line(num, kw, followed):
+    if followed:
+        return '%s. %s [%s] [已关注]' % (num, kw.keyword, TYPE_TXT[kw.type])
+    return '%s. %s [%s]' % (num, kw.keyword, TYPE_TXT[kw.type])
+
+def _search(to_user, msg_content):
+    user = repository.user_follows(to_user)
     
     shuffle = False
     msg_content = msg_content.strip()
@@ -420,161 +439,151 @@ def search_keyword(to_user):
         msg_content = '.*'
         shuffle = True
     try:
-        keywords = mongo_keywords.find({
-            '$or': [
-                {
-                    'keyword': re.compile(msg_content.strip(), flags=re.I),
-                },
-                {
-                    'alias': { 
-                        '$elemMatch': { '$regex': msg_content.strip() , '$options': '$i' }
-                    }
-                }
-            ],
-            'valid_feed_count': {'$gt': 0},
-            'status': 'activated',
-        })
-    except Exception:
-        return ('TextMsg', '∑(っ °Д °;)っ请不要输入奇怪的东西啦，真的会死机的哦~~')
-    keywords = [k for k in keywords]
+        keywords = keyword_index.search(msg_content.strip())
+    except (re.error, OperationFailure):
+        return ('TextMsg', '∑(っ °Д °;)っ请不要输入奇怪的东西啦，真的会死机的哦~~'), None
     
-    if shuffle and not is_replay:
+    if shuffle:
         random.shuffle(keywords)
-        rkey = settings.RECOMMEND_KEY % to_user
-        redis_db.setex(rkey, 300, json_util.dumps(keywords))
-    elif shuffle and is_replay :
-        rkey = settings.RECOMMEND_KEY % to_user
-        keywords = json_util.loads(redis_db.get(rkey).decode('utf-8'))
     
     count = len(keywords)
-    already_followed = {}
+    follow_keywords = set(user.follow_keywords)
     if count == 0:
-        return ('TextMsg', '没有找到"%s"相关的资源，如需添加新资源请点击: https://www.wenjuan.net/s/mmeYZj/' % msg_content.strip())
-    elif count > 1:
-        text_list = []
-        num = 0
-        for kw in keywords:
-            if 'follow_keywords' in user and kw['_id'] in user['follow_keywords']:
-                text_line = '%s. %s [%s] [已关注]' % (num, kw['keyword'], TYPE_TXT[kw['type']])
-                already_followed[kw['_id']] = True
+        return ('TextMsg', '没有找到"%s"相关的资源，如需添加新资源请点击: https://www.wenjuan.net/s/mmeYZj/' % msg_content.strip()), None
+    elif count == 1:
+        keyword = keywords[0]
+        return _show_keyword(keyword, keyword._id in follow_keywords)
+    if shuffle:
+        return _recommend(to_user, keywords, follow_keywords)
+    
+    text_list = []
+    for num, kw in enumerate(keywords):
+        text_list.append(_search_line(num, kw, kw._id in follow_keywords))
+    pages = _make_pages(text_list, SEARCH_PAGE_SIZE, SEARCH_PREFIX, SEARCH_SUFFIX, SEARCH_END_SUFFIX)
+    state = {
+        'step': 'select',
+        'page': 0,
+        'pages': _cache_pages(to_user, 'search', pages),
+        'ids': _dump_ids(kw._id for kw in keywords),
+        'followed': _dump_ids(kw._id for kw in keywords if kw._id in follow_keywords),
+    }
+    return ('TextMsg', pages[0]), state
+
+def _recommend(to_user, keywords, follow_keywords):
+    ''' '..'随机列出所有资源
+    结果有所有上线的keyword，不渲染所有页面，快照中也不保存所有id：打乱后的id按二进制写入RECOMMEND_KEY，
+    翻页和选择时只读取用到的id，keyword从worker内的keyword_index取出，每次的开销和keyword总数无关
+    '''
+    redis_db.setex(settings.RECOMMEND_KEY % to_user, settings.CONTEXT_EXPIRE, b''.join(kw._id.binary for kw in keywords))
+    state = {
+        'step': 'select',
+        'recommend': len(keywords),
+        'page': 0,
+        'pages': (len(keywords) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE,
+        'followed': _dump_ids(kw._id for kw in keywords if kw._id in follow_keywords),
+    }
+    first_page = {kw._id: kw for kw in keywords[:SEARCH_PAGE_SIZE]}
+    return ('TextMsg', _recommend_page(state, 0, list(first_page), first_page)), state
+
+def _recommend_ids(to_user, start, count):
+    ''' 读取打乱后的第start个开始的count个id，并刷新过期时间
+    '''
+    key = settings.RECOMMEND_KEY % to_user
+    pipe = redis_db.pipeline()
+    pipe.getrange(key, start * ID_SIZE, (start + count) * ID_SIZE - 1)
+    pipe.expire(key, settings.CONTEXT_EXPIRE)
+    data, _ = pipe.execute()
+    if not data:
+        logger.error('推荐列表丢失: %s', key)
+        raise UnexpectAnswer
+    return [ObjectId(data[i:i + ID_SIZE]) for i in range(0, len(data), ID_SIZE)]
+
+def _recommend_page(state, page, ids, keywords):
+    text_list = []
+    for num, kid in enumerate(ids, page * SEARCH_PAGE_SIZE):
+        kw = keywords.get(kid)
+        # 已经删除的keyword
+        if kw is not None:
+            text_list.append(_search_line(num, kw, str(kid) in state['followed']))
+    is_last = page + 1 >= state['pages']
+    return _make_page(text_list, is_last, SEARCH_PREFIX, SEARCH_SUFFIX, SEARCH_END_SUFFIX)
+
+def _search_page(to_user, state, page):
+    if 'recommend' not in state:
+        return _cached_page(to_user, 'search', page)
+    ids = _recommend_ids(to_user, page * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE)
+    return _recommend_page(state, page, ids, keyword_index.get_keywords(ids))
+
+def _selected_id(to_user, state, selected):
+    count = state['recommend'] if 'recommend' in state else len(state['ids'])
+    if selected >= count or selected < 0:
+        raise TypeError
+    if 'recommend' not in state:
+        return state['ids'][selected]
+    return str(_recommend_ids(to_user, selected, 1)[0])
+
+def _select_keyword(to_user, selected, state):
+    if selected in ['N', 'n'] and _has_next(state):
+        state['page'] += 1
+        return ('TextMsg', _search_page(to_user, state, state['page'])), state
+    try:
+        if selected[0] in ['F', 'f']:
+            selected = int(selected[1:])
+            kid = _selected_id(to_user, state, selected)
+            keyword = _find_keyword(kid)
+            already_followed = kid in state['followed']
+            msg_type, msg_content = _try_follow(to_user, already_followed, keyword)
+            if already_followed:
+                state['followed'].remove(kid)
+                edit = lambda line: line.replace(' [已关注]', '')
             else:
-                text_line = '%s. %s [%s]' % (num, kw['keyword'], TYPE_TXT[kw['type']])
-                already_followed[kw['_id']] = False
-            text_list.append(text_line)
-            num += 1
-        for msg, is_last in _make_page(
-            text_list, 10, 
-            prefix='【回复F加数字(如F2)可以直接关注/取关资源哦】\n--- 找到了多个资源 ---', 
-            suffix='--- 回复N翻页 回复数字选择 ---', 
-            end_suffix='--- 回复数字选择 ---'
-        ):
-            selected, is_replay = yield msg
-            
-            if selected in ['N', 'n'] and not is_last:
-                continue
-            try:
-                while True:
-                    if selected[0] in ['F', 'f']:
-                        selected = int(selected[1:])
-                        keyword = keywords[selected]
-                        if not is_replay:
-                            msg_type, msg_content = _try_follow(to_user, already_followed[keyword['_id']], keyword)
-                            if '关注' in msg_content:
-                                clear_msg = re.sub('(%s.*?\]).*' % selected, lambda match: '%s [已关注]' % match.group(1) ,msg[1])
-                            else:
-                                clear_msg = re.sub('(%s.*?\]).*' % selected, lambda match: match.group(1) ,msg[1])
-                            msg_content = '%s\n(%s)' % (clear_msg, msg_content)
-                        else:
-                            msg_content = 'none'
-                        selected, is_replay = yield ('TextMsg', msg_content)
-                    else:
-                        logger.debug(selected)
-                        break
-                if selected in ['N', 'n'] and not is_last:
-                    continue
-                selected = int(selected)
-                if selected > count or selected < 0:
-                    raise TypeError
-                break
-            except Exception:
-                raise UnexpectAnswer
-    else:
-        selected = 0
-    keyword = keywords[selected]
+                state['followed'].append(kid)
+                edit = lambda line: line + ' [已关注]'
+            # 推荐列表每次重新渲染，搜索结果在缓存的页面中更新关注标记
+            if 'recommend' not in state:
+                _edit_cached_line(to_user, 'search', selected // SEARCH_PAGE_SIZE, selected, edit)
+            msg_content = '%s\n(%s)' % (_search_page(to_user, state, state['page']), msg_content)
+            return ('TextMsg', msg_content), state
+        logger.debug(selected)
+        selected = int(selected)
+        kid = _selected_id(to_user, state, selected)
+        keyword = _find_keyword(kid)
+    except Exception:
+        raise UnexpectAnswer
+    if keyword is None:
+        # 列出之后被删除的keyword
+        raise UnexpectAnswer
+    return _show_keyword(keyword, kid in state['followed'])
 
-    text, feeds, all_episodes, last_series = _keyword_summary(keyword)
+def _show_keyword(keyword, already_followed):
+    text = _keyword_summary(keyword)
     
     text += '\n-----\n'
     text += '回复L列出所有资源\n'
     # 查询用户是否关注了这个资源
-    if 'follow_keywords' in user and keyword['_id'] in user['follow_keywords']:
-        already_followed[keyword['_id']] = True
+    if already_followed:
         text += '您已关注该资源，回复F取消关注'
     else:
-        already_followed[keyword['_id']] = False
         text += '回复F关注该资源'
-    selected, is_replay = yield ('TextMsg', text)
-    
-    feeds = mongo_feeds.find({
-        'keyword_id': keyword['_id'],
-        'break_rules': {'$exists': False}
-    }).sort('upload_time', DESCENDING)
-    text_list = ['%(title)s\n%(href)s' % feed for feed in feeds]
-    if already_followed[keyword['_id']]:
-        suffix_follow = '回复F取关'
-    else:
-        suffix_follow = '回复F关注'
-    if selected in ['L', 'l']:
-        for msg, is_last in _make_page(
-            text_list, 5, 
-            suffix='--- 回复N翻页 %s ---' % suffix_follow, 
-            end_suffix='--- %s ---' % suffix_follow
-        ):
-            selected, is_replay = yield msg
-            
-            if selected in ['N', 'n'] and not is_last:
-                continue
-            elif selected in ['F', 'f']:
-                return _try_follow(to_user, already_followed[keyword['_id']], keyword)
-            else:
-                raise UnexpectAnswer
-    elif selected in ['F', 'f']:
-        return _try_follow(to_user, already_followed[keyword['_id']], keyword)
-    else:
-        raise UnexpectAnswer
-    
-    return ('TextMsg', text)
+    state = {
+        'step': 'summary',
+        'keyword_id': str(keyword._id),
+        'followed': already_followed,
+    }
+    return ('TextMsg', text), state
 
 def active_user(to_user):
     yield None # send none for start
     msg_content, is_replay = yield None # Initial value
     
-    mongo_users = mongoCollection('users')
-    res = mongo_users.update({
-        'open_id': to_user,
-        'site': 'main',
-    },{
-        '$set': {
-            'active': True,
-            'open_id': to_user,
-            'site': 'main',
-            'last_check_time': datetime.now() - timedelta(days=365),
-        }
-    }, upsert=True)
+    repository.activate_user(to_user, last_check_time=datetime.now() - timedelta(days=365))
+    invalidate_user(to_user)
     # return ('TextMsg', HELP)
-    return HELP_LINKS
+    return META.get()['HELP_LINKS']
    
 def deactive_user(to_user):
     yield None # send none for start
     msg_content = yield None # Initial value
-    mongo_users = mongoCollection('users')
-    mongo_users.update({
-        'open_id': to_user,
-        'site': 'main',
-    },{
-        '$set': {
-            'active': False,
-            'site': 'main',
-        }
-    })
+    repository.deactivate_user(to_user)
+    invalidate_user(to_user)
     return ('TextMsg', 'Bye')
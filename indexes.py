@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+#coding=utf-8
+''' mongo索引和查询形状
+
+INDEXES声明每种查询需要的索引，ensure_indexes()按名字和已有的索引对比，只创建缺少的、重建定义变化的，
+部署时（Dockerfile）执行，重复执行不会做任何事。
+QUERIES登记了repository.py等模块中的每种查询，check()对它们执行explain()，报告全表扫描和内存排序。
+series的season/episode/date_episode是字符串（'-1'表示没有），按字符串排序时'10'排在'9'前面，
+这里给剧集补上数字的season_key/episode_key/date_episode_key，最新一集是索引上的第一条。
+    python indexes.py --ensure       # 创建索引
+    python indexes.py --normalize    # 给还没有排序字段（或者SORT_VERSION不同）的剧集补上
+    python indexes.py --check        # explain所有登记的查询
+'''
+import re
+import sys
+import logging
+import argparse
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+from bson.objectid import ObjectId
+
+import logs
+from backends import mongoCollection
+
+logger = logging.getLogger('__main__.indexes')
+
+# 排序字段的计算方法变化时增加，--normalize会重新计算所有版本不同的剧集
+SORT_VERSION = 2
+# 最新一集：先按集数，再按日期集数
+EPISODE_ORDER = [('season_key', DESCENDING), ('episode_key', DESCENDING), ('date_episode_key', DESCENDING)]
+DATE_EPISODE_ORDER = [('season_key', DESCENDING), ('date_episode_key', DESCENDING), ('episode_key', DESCENDING)]
+
+NORMALIZE_BATCH = 1000
+
+# (collection, 索引名, 字段, 选项)
+# partialFilterExpression不支持$exists: False，break_rules只能在读取文档之后过滤
+INDEXES = [
+    ('series', 'keyword_episode', [('keyword_id', ASCENDING)] + EPISODE_ORDER, {}),
+    ('series', 'keyword_date_episode', [('keyword_id', ASCENDING)] + DATE_EPISODE_ORDER, {}),
+    # 详细资源列表按(upload_time, _id)分页
+    ('feeds', 'keyword_upload', [('keyword_id', ASCENDING), ('upload_time', DESCENDING), ('_id', DESCENDING)], {}),
+    # show_updates按keyword_id $in查询、按upload_time排序，scrapy_time在索引中过滤
+    ('feeds', 'analyzed_keyword_upload', [('keyword_id', ASCENDING), ('upload_time', DESCENDING), ('scrapy_time', DESCENDING)], {
+        'partialFilterExpression': {'analyzed': True},
+    }),
+    ('feeds', 'scrapy', [('scrapy_time', ASCENDING)], {}),
+    ('users', 'open_id', [('open_id', ASCENDING)], {}),
+    ('keywords', 'status_feed_count', [('status', ASCENDING), ('valid_feed_count', ASCENDING)], {}),
+    ('meta', 'type_order', [('type', ASCENDING), ('order', ASCENDING)], {}),
+]
+
+# explain只关心查询的形状，条件中的值只需要类型正确
+_SAMPLE_ID = ObjectId()
+_SAMPLE_TIME = datetime(2017, 1, 1)
+_VALID = {'$exists': False}
+
+# (名称, collection, 查询条件, 排序)
+QUERIES = [
+    ('summaries._last_series.episode', 'series', {'keyword_id': _SAMPLE_ID}, EPISODE_ORDER),
+    ('summaries._last_series.date_episode', 'series', {'keyword_id': _SAMPLE_ID}, DATE_EPISODE_ORDER),
+    ('indexes.normalize_series', 'series', {'keyword_id': _SAMPLE_ID, 'sort_version': {'$ne': SORT_VERSION}}, []),
+    ('summaries.build_summary.last_feed', 'feeds', {'keyword_id': _SAMPLE_ID, 'break_rules': _VALID}, [('upload_time', DESCENDING)]),
+    ('summaries.refresh_recent', 'feeds', {'scrapy_time': {'$gte': _SAMPLE_TIME}}, []),
+    ('repository.new_feeds', 'feeds', {
+        'keyword_id': {'$in': [_SAMPLE_ID, ObjectId()]},
+        'scrapy_time': {'$gte': _SAMPLE_TIME},
+        'upload_time': {'$gte': _SAMPLE_TIME},
+        'break_rules': _VALID,
+        'analyzed': True,
+    }, [('upload_time', DESCENDING)]),
+    ('repository.feed_page', 'feeds', {'keyword_id': _SAMPLE_ID, 'break_rules': _VALID}, [('upload_time', DESCENDING), ('_id', DESCENDING)]),
+    ('repository.feed_page.next', 'feeds', {
+        'keyword_id': _SAMPLE_ID,
+        'break_rules': _VALID,
+        '$or': [{'upload_time': {'$lt': _SAMPLE_TIME}}, {'upload_time': _SAMPLE_TIME, '_id': {'$lt': _SAMPLE_ID}}],
+    }, [('upload_time', DESCENDING), ('_id', DESCENDING)]),
+    ('rollups._aggregate', 'feeds', {
+        'scrapy_time': {'$gte': _SAMPLE_TIME, '$lt': _SAMPLE_TIME},
+        'upload_time': {'$gte': _SAMPLE_TIME},
+        'break_rules': _VALID,
+        'analyzed': True,
+    }, []),
+    ('rollups.rebuild_all', 'feeds', {}, [('scrapy_time', ASCENDING)]),
+    ('repository.user_follows', 'users', {'open_id': 'sample'}, []),
+    ('repository.activate_user', 'users', {'open_id': 'sample', 'site': 'main'}, []),
+    ('repository.searchable_keywords', 'keywords', {'valid_feed_count': {'$gt': 0}, 'status': 'activated'}, []),
+    ('dialogs.META.help_links', 'meta', {'type': 'HELP_LINKS'}, [('order', ASCENDING)]),
+]
+
+def _integer(value):
+    return re.fullmatch(r'-?\d+', value.strip()) is not None
+
+def sort_number(value):
+    ''' 季数、集数转成数字：没有编号、'-1'和不含数字的都是-1，其他的取第一组数字，'01-02'是1，'12.5'是12.5
+    '''
+    if value is None:
+        return -1
+    value = str(value)
+    if _integer(value):
+        return int(value)
+    match = re.search(r'\d+(?:\.\d+)?', value)
+    if not match:
+        return -1
+    number = float(match.group())
+    return int(number) if number.is_integer() else number
+
+def date_sort_number(value):
+    ''' 日期集数转成YYYYMMDD形式的数字：'2017-5-1'和'2017.05.01'都是20170501，
+    已经是一个整数的（'20170501'、'-1'）直接使用，不含数字的是-1
+    '''
+    if value is None:
+        return -1
+    value = str(value)
+    if _integer(value):
+        return int(value)
+    groups = [int(group) for group in re.findall(r'\d+', value)]
+    if len(groups) >= 3:
+        year, month, day = groups[:3]
+        if year < 100:
+            year += 2000
+        return year * 10000 + month * 100 + day
+    return groups[0] if groups else -1
+
+# (原字段, 排序字段, 计算方法)
+SORT_KEYS = (
+    ('season', 'season_key', sort_number),
+    ('episode', 'episode_key', sort_number),
+    ('date_episode', 'date_episode_key', date_sort_number),
+)
+
+def series_sort_keys(series):
+    keys = {key: number(series.get(field)) for field, key, number in SORT_KEYS}
+    keys['sort_version'] = SORT_VERSION
+    return keys
+
+def normalize_series(keyword_id=None):
+    ''' 给还没有排序字段或者排序字段版本不同的剧集补上，返回补上的数量
+    爬虫写入的剧集没有这些字段，更新keyword摘要前对这个keyword调用一次
+    '''
+    query = {'sort_version': {'$ne': SORT_VERSION}}
+    if keyword_id is not None:
+        query['keyword_id'] = keyword_id
+    mongo_series = mongoCollection('series')
+    requests = []
+    count = 0
+    for series in mongo_series.find(query, {field: True for field, key, number in SORT_KEYS}):
+        requests.append(UpdateOne({'_id': series['_id']}, {'$set': series_sort_keys(series)}))
+        if len(requests) >= NORMALIZE_BATCH:
+            mongo_series.bulk_write(requests, ordered=False)
+            count += len(requests)
+            requests = []
+    if requests:
+        mongo_series.bulk_write(requests, ordered=False)
+        count += len(requests)
+    return count
+
+def _same_index(info, keys, options):
+    if [(field, int(direction)) for field, direction in info['key']] != keys:
+        return False
+    if info.get('partialFilterExpression') != options.get('partialFilterExpression'):
+        return False
+    return all(info.get(name) == value for name, value in options.items())
+
+def ensure_indexes():
+    ''' 创建INDEXES中缺少的索引，定义变化的删除后重建，返回创建的索引名
+    '''
+    created = []
+    for cname in sorted(set(index[0] for index in INDEXES)):
+        collection = mongoCollection(cname)
+        existing = collection.index_information()
+        models = []
+        for index_cname, name, keys, options in INDEXES:
+            if index_cname != cname:
+                continue
+            info = existing.get(name)
+            if info is not None:
+                if _same_index(info, keys, options):
+                    continue
+                logger.warning('Index %s.%s changed, rebuilding', cname, name)
+                collection.drop_index(name)
+            models.append(IndexModel(keys, name=name, background=True, **options))
+        if models:
+            created.extend('%s.%s' % (cname, name) for name in collection.create_indexes(models))
+    return created
+
+def _stages(plan):
+    yield plan
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            yield from _stages(child)
+
+def check():
+    ''' 对QUERIES中的每种查询执行explain()，返回[(名称, 问题)]
+    全表扫描（COLLSCAN）和内存排序（SORT）都算问题
+    '''
+    problems = []
+    for name, cname, query, sort in QUERIES:
+        cursor = mongoCollection(cname).find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = list(_stages(cursor.explain()['queryPlanner']['winningPlan']))
+        used = [stage['indexName'] for stage in stages if 'indexName' in stage]
+        logger.info('%s: %s', name, ', '.join(used) or 'no index')
+        for stage in stages:
+            if stage['stage'] in ('COLLSCAN', 'SORT'):
+                problems.append((name, stage['stage']))
+    return problems
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ensure', default=False, action='store_true')
+    parser.add_argument('--normalize', default=False, action='store_true')
+    parser.add_argument('--check', default=False, action='store_true')
+    args = parser.parse_args()
+
+    logs.configure()
+    if args.ensure:
+        logger.info('Indexes created: %s', ', '.join(ensure_indexes()) or 'none')
+    if args.normalize:
+        logger.info('%s series normalized', normalize_series())
+    if args.check:
+        problems = check()
+        for name, stage in problems:
+            logger.warning('%s: %s', name, stage)
+        if problems:
+            sys.exit(1)
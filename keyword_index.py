@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+''' worker内存中的keyword搜索索引
+
+search_keyword原来把用户输入当作正则去mongo里匹配keyword和alias，无法使用索引，每条消息都是一次全表扫描。
+这里把所有上线的keyword和别名读到内存中，按字符和二元组(bigram)建倒排索引：
+    - 普通输入：NFKC规范化（全角转半角）并忽略大小写后做子串匹配
+    - 含有正则语法的输入（很少见）：仍然交给mongo执行原来的正则查询，保持原来的语义。
+      不在worker中执行用户输入的正则：python的re没有回溯上限，'(.*.*)*x'之类的输入会卡住整个gevent循环
+'.*'（'..'随机推荐）直接返回所有keyword。
+索引只按时间刷新：首次使用时建立，超过KEYWORD_INDEX_TTL秒后在后台重建，重建期间继续使用旧索引，
+keyword的变化（爬虫和后台写入）最多KEYWORD_INDEX_TTL秒后生效。
+'''
+import logging
+import unicodedata
+from collections import defaultdict
+
+import settings
+import repository
+from cache import RefreshingCache
+
+logger = logging.getLogger('__main__.keyword_index')
+
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+def normalize(text):
+    ''' 全角转半角，忽略大小写
+    '''
+    return unicodedata.normalize('NFKC', text).casefold()
+
+def _grams(text):
+    return set(text[i:i+2] for i in range(len(text) - 1))
+
+class KeywordIndex(object):
+    def __init__(self, keywords):
+        # keywords保持mongo返回的顺序，搜索结果也按这个顺序返回
+        self.keywords = keywords
+        self.by_id = {kw._id: kw for kw in keywords}
+        self.names = []
+        self.chars = defaultdict(set)
+        self.grams = defaultdict(set)
+        for pos, kw in enumerate(keywords):
+            names = []
+            if isinstance(kw.keyword, str):
+                names.append(kw.keyword)
+            if isinstance(kw.alias, list):
+                names.extend(a for a in kw.alias if isinstance(a, str))
+            normalized = [normalize(name) for name in names]
+            self.names.append(normalized)
+            for name in normalized:
+                for char in name:
+                    self.chars[char].add(pos)
+                for gram in _grams(name):
+                    self.grams[gram].add(pos)
+
+    def search(self, text):
+        ''' 返回匹配的keyword列表，含有正则语法的输入不是合法的正则时抛出re.error或OperationFailure
+        '''
+        if text == '.*':
+            return list(self.keywords)
+        if REGEX_CHARS & set(text):
+            return repository.regex_keywords(text)
+        query = normalize(text)
+        if not query:
+            return list(self.keywords)
+        if len(query) == 1:
+            candidates = self.chars.get(query, set())
+        else:
+            postings = [self.grams.get(gram) for gram in _grams(query)]
+            if not all(postings):
+                return []
+            candidates = set.intersection(*sorted(postings, key=len))
+        return [
+            self.keywords[pos] for pos in sorted(candidates)
+            if any(query in name for name in self.names[pos])
+        ]
+
+def _load():
+    keywords = repository.searchable_keywords()
+    index = KeywordIndex(keywords)
+    logger.info('Keyword index loaded: %s keywords', len(keywords))
+    return index
+
+_index = RefreshingCache('Keyword index', _load, settings.KEYWORD_INDEX_TTL)
+
+def refresh():
+    return _index.refresh()
+
+def search(text):
+    return _index.get().search(text)
+
+def get_keywords(keyword_ids):
+    ''' 从索引中按id取出keyword，返回{keyword_id: Keyword}
+    索引中没有的（刚下线或者这个worker的索引还没有刷新）再查一次mongo
+    '''
+    by_id = _index.get().by_id
+    found = {kid: by_id[kid] for kid in keyword_ids if kid in by_id}
+    missing = [kid for kid in keyword_ids if kid not in found]
+    if missing:
+        found.update((kw._id, kw) for kw in repository.keywords_by_ids(missing))
+    return found
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+''' 日志配置
+
+configure()按settings.LOGGING配置日志，LOG_ASYNC开启时把所有handler移到一个独立的写日志线程：
+记录日志的greenlet只把LogRecord放进内存队列，格式化、写文件和切分文件都在这个线程中完成，
+不会阻塞gevent的事件循环。队列满时丢弃新的日志并计数，写日志线程会补记一条丢弃了多少条。
+模块的logger都是'__main__.<模块名>'，可以通过LOG_LEVELS单独设置级别。
+'''
+import os
+import random
+import atexit
+import logging
+import logging.config
+from collections import deque
+from gevent import monkey
+
+import settings
+
+# gevent monkey patch之后threading.Thread是greenlet，写文件仍然会阻塞事件循环，这里需要真正的线程
+_start_thread = monkey.get_original('_thread', 'start_new_thread')
+_sleep = monkey.get_original('time', 'sleep')
+_RLock = monkey.get_original('_thread', 'RLock')
+
+class Lazy(object):
+    ''' 日志真正输出时才调用func生成内容
+    '''
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+class Truncated(object):
+    ''' 输出时截断到limit个字符
+    '''
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        value = str(value)
+        if len(value) > self.limit:
+            return '%s...(%s more)' % (value[:self.limit], len(value) - self.limit)
+        return value
+
+def sample_payload(logger, level=logging.INFO):
+    ''' 请求内容按LOG_PAYLOAD_SAMPLE的比例记录，用Truncated(data, settings.LOG_PAYLOAD_MAX)截断
+    '''
+    return logger.isEnabledFor(level) and random.random() < settings.LOG_PAYLOAD_SAMPLE
+
+class AsyncHandler(logging.Handler):
+    ''' 把LogRecord交给写日志线程，由线程调用原来的handlers
+    deque的append和popleft在多线程下是原子的，不需要锁
+    '''
+    def __init__(self, handlers, capacity):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.capacity = capacity
+        self.records = deque()
+        self.dropped = 0
+        self.writer_pid = None
+        for handler in handlers:
+            # 原来的锁是gevent的，只在写日志线程中使用时换成真正的锁
+            handler.lock = _RLock()
+
+    def emit(self, record):
+        # uwsgi在master中配置日志后fork，线程不会被继承，每个worker第一次写日志时启动自己的线程
+        if self.writer_pid != os.getpid():
+            # 从父进程继承的日志由父进程写
+            self.records.clear()
+            self.writer_pid = os.getpid()
+            _start_thread(self._write_loop, ())
+        if len(self.records) >= self.capacity:
+            self.dropped += 1
+            return
+        # 异常信息在这里格式化，traceback对象不跨线程保留
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def drain(self):
+        while True:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+            self._write(record)
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self._write(logging.makeLogRecord({
+                'name': __name__,
+                'module': 'logs',
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': '%s log records dropped, log queue is full',
+                'args': (dropped,),
+            }))
+
+    def _write_loop(self):
+        while True:
+            try:
+                self.drain()
+            except Exception:
+                # 写日志失败时不能再写日志
+                pass
+            _sleep(settings.LOG_WRITE_INTERVAL)
+
+def _make_async(logger):
+    handlers = list(logger.handlers)
+    if not handlers:
+        return
+    for handler in handlers:
+        logger.removeHandler(handler)
+    handler = AsyncHandler(handlers, settings.LOG_QUEUE_SIZE)
+    logger.addHandler(handler)
+    # 进程退出时写完队列中剩下的日志
+    atexit.register(lambda: handler.writer_pid == os.getpid() and handler.drain())
+
+def configure():
+    config = dict(settings.LOGGING)
+    config['loggers'] = dict(config['loggers'])
+    for module, level in settings.LOG_LEVELS.items():
+        config['loggers']['__main__.%s' % module] = {'level': level}
+    logging.config.dictConfig(config)
+    if settings.LOG_ASYNC:
+        _make_async(logging.getLogger())
+        _make_async(logging.getLogger('__main__'))
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+''' 运行指标
+
+每个进程在内存中累计计数和直方图，后台greenlet每METRICS_FLUSH_INTERVAL秒用一个pipeline把增量
+HINCRBYFLOAT到redis的METRICS_KEY，所有uwsgi worker和reply_worker的数据在redis中汇总，
+render()读取汇总结果输出Prometheus文本格式。记录一次观测只是内存中的几次加法，不会产生I/O。
+    - 每条消息：总耗时、mongo/redis往返次数（按消息类型和会话）
+    - 每个会话：处理耗时、重放的历史消息数
+    - mongo命令和redis命令/pipeline：次数和耗时
+    - HTTP请求：按Flask endpoint的耗时
+'''
+import os
+import time
+import atexit
+import bisect
+import logging
+import threading
+from functools import wraps
+
+import settings
+import backends
+
+logger = logging.getLogger('__main__.metrics')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+# {(名称, 标签值): [各区间计数..., 总和, 次数]} 或 {(名称, 标签值): [值]}，flush时清空
+_pending = {}
+_families = {}
+_flusher_pid = None
+# 当前greenlet正在处理的消息
+_local = threading.local()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+def _format_number(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _families[name] = self
+
+    def inc(self, *label_values, amount=1):
+        key = (self.name, label_values)
+        series = _pending.get(key)
+        if series is None:
+            series = _pending[key] = [0]
+            _ensure_flusher()
+        series[0] += amount
+
+    def fields(self, label_values, series):
+        labels = _labels(self.labels, label_values)
+        yield '%s\t\t%s\t' % (self.name, labels), series[0]
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        _families[name] = self
+
+    def observe(self, value, *label_values):
+        key = (self.name, label_values)
+        series = _pending.get(key)
+        if series is None:
+            series = _pending[key] = [0] * (len(self.buckets) + 3)
+            _ensure_flusher()
+        # 最后一个区间是+Inf
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def fields(self, label_values, series):
+        ''' redis中保存累积的区间计数，和Prometheus的格式一致
+        '''
+        labels = _labels(self.labels, label_values)
+        cumulative = 0
+        for le, count in zip(self.buckets + ('+Inf',), series):
+            cumulative += count
+            yield '%s\t_bucket\t%s\t%s' % (self.name, labels, le), cumulative
+        yield '%s\t_sum\t%s\t' % (self.name, labels), series[-2]
+        yield '%s\t_count\t%s\t' % (self.name, labels), series[-1]
+
+MESSAGE_SECONDS = Histogram('amwatcher_message_seconds', 'wechat.bot.answer处理一条消息的耗时', ('msg_type', 'dialog'))
+MESSAGE_MONGO_CALLS = Histogram('amwatcher_message_mongo_calls', '一条消息的mongo命令数', ('dialog',), COUNT_BUCKETS)
+MESSAGE_REDIS_CALLS = Histogram('amwatcher_message_redis_calls', '一条消息的redis往返次数', ('dialog',), COUNT_BUCKETS)
+DIALOG_SECONDS = Histogram('amwatcher_dialog_seconds', '会话处理一条消息的耗时', ('dialog',))
+REPLAY_DEPTH = Histogram('amwatcher_replay_depth', '恢复会话时重放的历史消息数', ('dialog',), COUNT_BUCKETS)
+MONGO_SECONDS = Histogram('amwatcher_mongo_seconds', 'mongo命令的耗时', ('command',))
+MONGO_FAILURES = Counter('amwatcher_mongo_failures_total', '失败的mongo命令数', ('command',))
+REDIS_SECONDS = Histogram('amwatcher_redis_seconds', 'redis命令或pipeline的耗时', ('command',))
+HTTP_SECONDS = Histogram('amwatcher_http_seconds', 'HTTP请求的耗时', ('endpoint', 'status'))
+
+class _Message(object):
+    __slots__ = ('msg_type', 'dialog', 'mongo_calls', 'redis_calls')
+
+    def __init__(self):
+        self.msg_type = 'unknown'
+        self.dialog = 'none'
+        self.mongo_calls = 0
+        self.redis_calls = 0
+
+def measure_message(func):
+    ''' 统计被装饰的函数处理一条消息的耗时和后端往返次数
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        message = _local.message = _Message()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.message = None
+            MESSAGE_SECONDS.observe(time.perf_counter() - start, message.msg_type, message.dialog)
+            MESSAGE_MONGO_CALLS.observe(message.mongo_calls, message.dialog)
+            MESSAGE_REDIS_CALLS.observe(message.redis_calls, message.dialog)
+    return wrapper
+
+def tag(**kwargs):
+    ''' 设置当前消息的msg_type/dialog标签
+    '''
+    message = getattr(_local, 'message', None)
+    if message is not None:
+        for name, value in kwargs.items():
+            setattr(message, name, value)
+
+def dialog(name, seconds):
+    DIALOG_SECONDS.observe(seconds, name)
+    tag(dialog=name)
+
+def mongo_call(command, seconds, failed=False):
+    MONGO_SECONDS.observe(seconds, command)
+    if failed:
+        MONGO_FAILURES.inc(command)
+    message = getattr(_local, 'message', None)
+    if message is not None:
+        message.mongo_calls += 1
+
+def redis_call(command, seconds):
+    REDIS_SECONDS.observe(seconds, command)
+    message = getattr(_local, 'message', None)
+    if message is not None:
+        message.redis_calls += 1
+
+def flush():
+    ''' 把本进程的增量合并到redis
+    '''
+    global _pending
+    pending, _pending = _pending, {}
+    if not pending:
+        return 0
+    pipe = backends.redis_db.pipeline(transaction=False)
+    for (name, label_values), series in pending.items():
+        for field, value in _families[name].fields(label_values, series):
+            pipe.hincrbyfloat(settings.METRICS_KEY, field, value)
+    pipe.execute()
+    return len(pending)
+
+def _flush_loop():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            logger.exception('Metrics flush failed')
+
+def _ensure_flusher():
+    global _flusher_pid
+    # 和pin_notify一样，fork出来的worker需要自己的greenlet
+    if _flusher_pid != os.getpid():
+        _flusher_pid = os.getpid()
+        threading.Thread(target=_flush_loop, daemon=True).start()
+
+def render():
+    ''' 所有进程汇总后的指标，Prometheus文本格式
+    '''
+    samples = {}
+    for field, value in backends.redis_db.hgetall(settings.METRICS_KEY).items():
+        name, suffix, labels, le = field.decode('utf-8').split('\t')
+        if name in _families:
+            samples.setdefault(name, []).append((labels, suffix, float(le) if le else 0, le, value))
+    lines = []
+    for name in sorted(samples):
+        family = _families[name]
+        lines.append('# HELP %s %s' % (name, family.help))
+        lines.append('# TYPE %s %s' % (name, family.type))
+        for labels, suffix, order, le, value in sorted(samples[name]):
+            if le:
+                labels = '%s,le="%s"' % (labels, le) if labels else 'le="%s"' % le
+            lines.append('%s%s{%s} %s' % (name, suffix, labels, _format_number(value)))
+    return '\n'.join(lines) + '\n'
+
+@atexit.register
+def _flush_at_exit():
+    # worker退出（例如max-requests）时不丢掉最后一段数据
+    if _flusher_pid == os.getpid():
+        try:
+            flush()
+        except Exception:
+            logger.exception('Metrics flush failed')
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+''' PIN码登录的推送通知
+
+用户在微信里发送PIN码后，bot在PIN_CHANNEL上publish一条消息。
+每个worker的订阅greenlet（channels.py）用psubscribe接收所有PIN码的通知，再唤醒本worker里等待这个PIN码的请求，
+等待中的请求只是挂在Event上，不占用CPU，也不各自占用redis连接。
+每个等待都会占用一个uwsgi的gevent协程，所以同时等待的数量限制在PIN_MAX_WAITERS以内。
+'''
+import logging
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+import settings
+import backends
+import channels
+
+logger = logging.getLogger('__main__.pin_notify')
+
+class TooManyWaiters(Exception):
+    pass
+
+_waiters = defaultdict(set)
+_slots = threading.BoundedSemaphore(settings.PIN_MAX_WAITERS)
+_prefix = settings.PIN_CHANNEL % ''
+
+def _wake(channel, open_id):
+    pin_code = channel[len(_prefix):]
+    for event in list(_waiters.get(pin_code, ())):
+        event.set()
+
+channels.register(settings.PIN_CHANNEL % '*', _wake)
+
+def notify(pin_code, open_id):
+    backends.redis_db.publish(settings.PIN_CHANNEL % pin_code, open_id)
+
+@contextmanager
+def waiter(pin_code):
+    ''' 在with块内收到pin_code的通知时，返回的Event会被set
+    先注册再检查PIN状态，这样检查和等待之间publish的通知也不会丢失
+    '''
+    if not _slots.acquire(blocking=False):
+        raise TooManyWaiters
+    event = threading.Event()
+    try:
+        channels.ensure_listener()
+        _waiters[pin_code].add(event)
+        yield event
+    finally:
+        _waiters[pin_code].discard(event)
+        if not _waiters[pin_code]:
+            del _waiters[pin_code]
+        _slots.release()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#coding=utf-8
+''' 登录PIN码分配
+
+所有6位PIN码预先打乱后放在redis列表PIN_POOL_KEY中，分配时由lua脚本原子地完成：
+    1. 把租约（PIN_LEASE_KEY，按到期时间排序的zset）已到期的PIN码放回列表末尾，每次最多PIN_RECYCLE_BATCH个
+       PIN码仍在使用（例如刚绑定了open_id）时按剩余时间顺延租约
+    2. 从列表头部取出一个PIN码，写入PIN_KEY并登记租约
+不管已经分配出去多少PIN码，一次分配都只是一次redis往返。
+生成并写入一百万个PIN码需要几秒，不能放在登录请求中，列表在部署时（Dockerfile）建立：
+    python pins.py --ensure   # PIN码池还没有建立时建立
+    python pins.py --init     # 重建PIN码池（正在使用的PIN码也会回到池中）
+    python pins.py --stats    # 查看PIN码池的使用情况
+'''
+import time
+import random
+import logging
+import argparse
+
+import settings
+import logs
+import backends
+
+logger = logging.getLogger('__main__.pins')
+
+PIN_COUNT = 1000000
+INIT_BATCH = 10000
+
+# KEYS: PIN码池, 租约  ARGV: 当前时间, 有效期, PIN_KEY前缀, 每次回收的上限
+CLAIM_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, tonumber(ARGV[4]))
+for _, pin in ipairs(expired) do
+    local left = redis.call('PTTL', ARGV[3] .. pin)
+    if left > 0 then
+        redis.call('ZADD', KEYS[2], now + left / 1000, pin)
+    else
+        redis.call('ZREM', KEYS[2], pin)
+        redis.call('RPUSH', KEYS[1], pin)
+    end
+end
+local pin = redis.call('LPOP', KEYS[1])
+if not pin then
+    return false
+end
+redis.call('SETEX', ARGV[3] .. pin, ARGV[2], 'EMPTY')
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), pin)
+return pin
+'''
+
+_claim_script = None
+
+def init_pool(force=False):
+    ''' 建立打乱顺序的PIN码池，已经建立过时除非force否则不做任何事
+    '''
+    redis_db = backends.redis_db
+    if not force and redis_db.exists(settings.PIN_POOL_READY_KEY):
+        return False
+    # 防止多个worker同时建立
+    if not redis_db.set(settings.PIN_POOL_LOCK_KEY, 1, ex=60, nx=True):
+        return False
+    try:
+        pins = [str(i).zfill(6) for i in range(PIN_COUNT)]
+        random.SystemRandom().shuffle(pins)
+        pipe = redis_db.pipeline()
+        pipe.delete(settings.PIN_POOL_KEY, settings.PIN_LEASE_KEY)
+        for i in range(0, PIN_COUNT, INIT_BATCH):
+            pipe.rpush(settings.PIN_POOL_KEY, *pins[i:i+INIT_BATCH])
+        pipe.set(settings.PIN_POOL_READY_KEY, 1)
+        pipe.execute()
+        logger.info('PIN pool initialized with %s codes', PIN_COUNT)
+        return True
+    finally:
+        redis_db.delete(settings.PIN_POOL_LOCK_KEY)
+
+def _claim():
+    global _claim_script
+    if _claim_script is None:
+        _claim_script = backends.redis_db.register_script(CLAIM_SCRIPT)
+    return _claim_script(
+        keys=[settings.PIN_POOL_KEY, settings.PIN_LEASE_KEY],
+        args=[time.time(), settings.PIN_EXPIRE, settings.PIN_KEY % '', settings.PIN_RECYCLE_BATCH],
+        client=backends.redis_db,
+    )
+
+def claim():
+    ''' 分配一个PIN码并写入PIN_KEY，PIN码用完或者PIN码池还没有建立时返回None
+    '''
+    pin = _claim()
+    if pin is None:
+        if not backends.redis_db.exists(settings.PIN_POOL_READY_KEY):
+            logger.error('PIN pool not initialized, run pins.py --ensure')
+        else:
+            logger.warning('PIN pool exhausted: %s', stats())
+        return None
+    return pin.decode('utf-8')
+
+def stats():
+    pipe = backends.redis_db.pipeline(transaction=False)
+    pipe.llen(settings.PIN_POOL_KEY)
+    pipe.zcard(settings.PIN_LEASE_KEY)
+    pipe.zcount(settings.PIN_LEASE_KEY, '-inf', time.time())
+    free, leased, expired = pipe.execute()
+    return {
+        'free': free,
+        'leased': leased,
+        # 已到期、等待下一次分配时回收的数量
+        'expired': expired,
+        'occupancy': leased / PIN_COUNT,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ensure', default=False, action='store_true')
+    parser.add_argument('--init', default=False, action='store_true')
+    parser.add_argument('--stats', default=False, action='store_true')
+    args = parser.parse_args()
+
+    logs.configure()
+    if args.ensure and not init_pool():
+        logger.info('PIN pool already initialized')
+    if args.init:
+        init_pool(force=True)
+    if args.stats:
+        logger.info(stats())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#coding=utf-8
+''' 异步回复的后台进程
+
+settings.ASYNC_REPLY开启后，wechat.bot.answer把标记了@background的耗时会话放进REPLY_QUEUE_KEY，
+这里用gevent协程池处理，结果攒成一批后通过客服消息接口发送，失败的消息按指数退避重试。
+处理出错的会话也会发送FAILED_REPLY：用户已经收到了success，没有回复的话什么都看不到。
+    python reply_worker.py [--workers N]
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import time
+import logging
+import argparse
+import gevent
+from gevent.pool import Pool
+from gevent.queue import Queue, Empty
+
+import settings
+import logs
+import backends
+import dialogs
+from wechat import bot, delivery
+
+logger = logging.getLogger('__main__.reply_worker')
+
+FAILED_REPLY = '∑(っ °Д °;)っ服务器开小差了，请稍后再试一次吧~'
+
+def handle(job, outbox):
+    try:
+        type, msg = bot.run_job(job, dialogs)
+        message = delivery.to_message(job['to_user'], type, msg)
+    except Exception:
+        logger.exception('Reply job failed: %s', job)
+        outbox.put((delivery.to_message(job['to_user'], 'TextMsg', FAILED_REPLY), 0))
+        return
+    outbox.put((message, 0))
+    logger.info('%s answered in %.2fs', job['dialog'], time.time() - job['queued_at'])
+
+def _retry(outbox, message, attempt):
+    gevent.sleep(2 ** attempt)
+    outbox.put((message, attempt))
+
+def deliver(client, outbox, batch_size=settings.DELIVERY_BATCH, retries=settings.DELIVERY_RETRIES):
+    ''' 从outbox中最多取batch_size条消息一起发送
+    '''
+    while True:
+        batch = [outbox.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(outbox.get_nowait())
+            except Empty:
+                break
+        attempts = {id(message): attempt for message, attempt in batch}
+        for message in client.send_batch([message for message, attempt in batch]):
+            attempt = attempts[id(message)] + 1
+            if attempt > retries:
+                logger.error('Delivery to %s dropped after %s retries', message['touser'], retries)
+                continue
+            gevent.spawn(_retry, outbox, message, attempt)
+
+def run(client, workers=settings.REPLY_WORKERS, stop=None):
+    pool = Pool(workers)
+    outbox = Queue()
+    gevent.spawn(deliver, client, outbox)
+    while stop is None or not stop.is_set():
+        pool.wait_available()
+        item = backends.redis_db.blpop(settings.REPLY_QUEUE_KEY, timeout=1)
+        if item is None:
+            continue
+        pool.spawn(handle, json.loads(item[1].decode('utf-8')), outbox)
+    pool.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default=settings.REPLY_WORKERS, type=int)
+    args = parser.parse_args()
+
+    logs.configure()
+    run(delivery.make_client(), args.workers)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+''' 对话和网页使用的数据访问
+
+dialogs.py/start.py不直接使用pymongo，而是调用这里按用途命名的查询。每个查询都带projection，
+只读取用到的字段，结果是只有这些字段的__slots__记录：传输和BSON解码的数据更少，
+每个greenlet持有的对象也更小。缓存和统计都可以加在这一层。
+记录中文档没有的字段取DEFAULTS中的值，没有默认值的是None。
+'''
+import re
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import DESCENDING
+
+import summaries
+from backends import mongoCollection
+from modules import User
+
+class Record(object):
+    __slots__ = ()
+    DEFAULTS = {}
+
+    def __init__(self, doc):
+        defaults = self.DEFAULTS
+        for field in self.__slots__:
+            setattr(self, field, doc.get(field, defaults.get(field)))
+
+    @classmethod
+    def projection(cls):
+        return dict.fromkeys(cls.__slots__, True)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, ' '.join('%s=%r' % (field, getattr(self, field)) for field in self.__slots__))
+
+class Keyword(Record):
+    __slots__ = ('_id', 'keyword', 'type', 'alias')
+
+class UserFollows(Record):
+    __slots__ = ('_id', 'follow_keywords', 'last_check_time')
+    DEFAULTS = {'follow_keywords': []}
+
+class FeedLink(Record):
+    __slots__ = ('_id', 'title', 'href', 'keyword_id', 'upload_time')
+
+class KeywordSummary(Record):
+    ''' summaries.py中的摘要，没有剧集的keyword只有last_upload_time
+    '''
+    __slots__ = ('_id', 'last_upload_time', 'season', 'episode', 'date_episode', 'feeds')
+
+# 详细资源列表的顺序，_id保证顺序唯一
+FEED_ORDER = [('upload_time', DESCENDING), ('_id', DESCENDING)]
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+# Flask-Login使用的用户字段，不读取关注列表
+LOGIN_FIELDS = {'open_id': True, 'display_name': True, 'active': True, 'role': True}
+
+def _find(cname, record, query, sort=None, limit=0):
+    cursor = mongoCollection(cname).find(query, record.projection())
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+    return [record(doc) for doc in cursor]
+
+def _find_one(cname, record, query):
+    doc = mongoCollection(cname).find_one(query, record.projection())
+    return record(doc) if doc else None
+
+# keywords
+
+def find_keyword(keyword_id):
+    return _find_one('keywords', Keyword, {'_id': ObjectId(keyword_id)})
+
+def keywords_by_ids(keyword_ids):
+    ''' 按mongo返回的顺序，已删除的keyword不在结果中
+    '''
+    return _find('keywords', Keyword, {'_id': {'$in': keyword_ids}})
+
+def searchable_keywords():
+    ''' 有有效资源并且已上线的keyword
+    '''
+    return _find('keywords', Keyword, {
+        'valid_feed_count': {'$gt': 0},
+        'status': 'activated',
+    })
+
+def regex_keywords(pattern):
+    ''' 原来的正则搜索，在mongo中匹配keyword和别名，查询条件和原来完全一致
+    pattern不是合法的正则时抛出re.error或pymongo.errors.OperationFailure
+    '''
+    return _find('keywords', Keyword, {
+        '$or': [
+            {'keyword': re.compile(pattern, flags=re.I)},
+            {'alias': {'$elemMatch': {'$regex': pattern, '$options': '$i'}}},
+        ],
+        'valid_feed_count': {'$gt': 0},
+        'status': 'activated',
+    })
+
+def keyword_summary(keyword_id):
+    return KeywordSummary(summaries.get_summary(keyword_id, KeywordSummary.projection()))
+
+def keyword_summaries(keyword_ids):
+    ''' 返回{keyword_id: KeywordSummary}
+    '''
+    found = summaries.get_summaries(keyword_ids, KeywordSummary.projection())
+    return {keyword_id: KeywordSummary(summary) for keyword_id, summary in found.items()}
+
+# feeds
+
+def new_feeds(keyword_ids, scrapy_since, upload_since):
+    ''' keyword_ids在scrapy_since之后爬取到、upload_time在upload_since之后的有效资源，新的在前
+    '''
+    return _find('feeds', FeedLink, {
+        'keyword_id': {'$in': keyword_ids},
+        'scrapy_time': {'$gte': scrapy_since},
+        'upload_time': {'$gte': upload_since},
+        'break_rules': {'$exists': False},
+        'analyzed': True,
+    }, [('upload_time', DESCENDING)])
+
+def feed_page(keyword_id, limit, cursor=None):
+    ''' keyword的有效资源，新的在前，按(upload_time, _id)分页，每次只读取这一页
+    cursor是上一页返回的位置（可以保存在会话快照中），返回(这一页的FeedLink, 下一页的cursor)，
+    没有下一页时cursor是None
+    '''
+    query = {
+        'keyword_id': ObjectId(keyword_id),
+        'break_rules': {'$exists': False},
+    }
+    if cursor is not None:
+        upload_time = _EPOCH + cursor[0] * _MICROSECOND
+        feed_id = ObjectId(cursor[1])
+        query['$or'] = [
+            {'upload_time': {'$lt': upload_time}},
+            {'upload_time': upload_time, '_id': {'$lt': feed_id}},
+        ]
+    # 多读一条判断是否还有下一页
+    feeds = _find('feeds', FeedLink, query, FEED_ORDER, limit + 1)
+    if len(feeds) <= limit:
+        return feeds, None
+    last = feeds[limit - 1]
+    return feeds[:limit], [(last.upload_time - _EPOCH) // _MICROSECOND, str(last._id)]
+
+# users
+
+def user_follows(open_id):
+    return _find_one('users', UserFollows, {'open_id': open_id})
+
+def follow(open_id, keyword_id):
+    mongoCollection('users').update_one({'open_id': open_id}, {'$addToSet': {'follow_keywords': keyword_id}}, upsert=True)
+
+def unfollow(open_id, keyword_id):
+    mongoCollection('users').update_one({'open_id': open_id}, {'$pull': {'follow_keywords': keyword_id}})
+
+def mark_checked(open_id, check_time):
+    mongoCollection('users').update_one({'open_id': open_id}, {'$set': {'last_check_time': check_time}})
+
+def activate_user(open_id, last_check_time=None):
+    ''' 返回用户是否已经存在
+    '''
+    values = {
+        'active': True,
+        'open_id': open_id,
+        'site': 'main',
+    }
+    if last_check_time is not None:
+        values['last_check_time'] = last_check_time
+    res = mongoCollection('users').update({'open_id': open_id, 'site': 'main'}, {'$set': values}, upsert=True)
+    return res['updatedExisting']
+
+def deactivate_user(open_id):
+    mongoCollection('users').update({
+        'open_id': open_id,
+        'site': 'main',
+    }, {
+        '$set': {
+            'active': False,
+            'site': 'main',
+        }
+    })
+
+def user_exists(open_id):
+    return mongoCollection('users').find_one({'open_id': open_id}, {'_id': True}) is not None
+
+def login_user(user_id=None, open_id=None):
+    ''' 按_id或open_id读取Flask-Login使用的User，不存在时返回None
+    '''
+    query = {'_id': ObjectId(user_id)} if user_id is not None else {'open_id': open_id}
+    user_info = mongoCollection('users').find_one(query, LOGIN_FIELDS)
+    return User(user_info) if user_info else None
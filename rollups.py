@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+#coding=utf-8
+''' 按天汇总的更新记录，供show_all_updates使用
+
+update_rollups集合中每天一个文档（_id为'YYYY-MM-DD'，按scrapy_time所在的日期），
+保存这一天爬取到的、已分析的有效资源中每个keyword的最大upload_time。
+查询N天内的更新时读取N个文档在内存中合并，只有窗口开始那一天的一部分和今天直接聚合feeds，
+耗时只和N有关，不再随资源总量增长。
+资源爬取之后还要经过分析才会标记analyzed，所以一天结束ROLLUP_FINAL_DELAY秒之后生成的文档才是最终的，
+今天、最近还可能变化的和不是最终的文档在查询时重新聚合，已经是最终的日期重新聚合后保存（没有资源的日期也保存，
+之后不再重复聚合）。日期范围从第一条资源所在的日期开始。
+最近的日期由summaries.py --watch定期重建，也可以通过命令行维护：
+    python rollups.py --rebuild          # 重建所有日期
+    python rollups.py --day 2017-05-01   # 重建单独一天
+'''
+import logging
+import argparse
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+
+import settings
+import logs
+from backends import mongoCollection
+
+logger = logging.getLogger('__main__.rollups')
+
+DAY_FORMAT = '%Y-%m-%d'
+# upload_time必须在窗口开始前UPLOAD_WINDOW_DAYS天之后，避免因搜索排名导致的误更新
+UPLOAD_WINDOW_DAYS = 5
+
+def _day_start(day):
+    return datetime(day.year, day.month, day.day)
+
+def _aggregate(start, end, min_upload=None):
+    ''' scrapy_time在[start, end)之间的资源，每个keyword的最大upload_time
+    '''
+    match = {
+        'scrapy_time': {'$gte': start, '$lt': end},
+        'break_rules': {'$exists': False},
+        'analyzed': True,
+    }
+    if min_upload is not None:
+        match['upload_time'] = {'$gte': min_upload}
+    return mongoCollection('feeds').aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': '$keyword_title',
+            'last_update': {'$max': '$upload_time'},
+        }},
+    ])
+
+def _day_updates(start, end):
+    return [
+        {'keyword': item['_id'], 'last_update': item['last_update']}
+        for item in _aggregate(start, end)
+    ]
+
+def _save_day(start, updates):
+    rollup = {
+        '_id': start.strftime(DAY_FORMAT),
+        'day': start,
+        'updates': updates,
+        'updated_at': datetime.now(),
+    }
+    mongoCollection('update_rollups').replace_one({'_id': rollup['_id']}, rollup, upsert=True)
+    return rollup
+
+def update_day(day):
+    ''' 重新汇总一天的资源
+    '''
+    start = _day_start(day)
+    return _save_day(start, _day_updates(start, start + timedelta(days=1)))
+
+def _first_day():
+    ''' 第一条资源所在的日期，没有资源时返回None
+    '''
+    first = mongoCollection('feeds').find_one({}, {'scrapy_time': True}, sort=[('scrapy_time', ASCENDING)])
+    return _day_start(first['scrapy_time']) if first else None
+
+def last_updates(since):
+    ''' since之后每个keyword的最后更新时间，按时间倒序返回[(keyword, last_update)]
+    和直接聚合feeds的结果一致：bucket中保存的是每天的最大upload_time，
+    最大值满足upload_time的条件时它就是满足条件的资源中最大的，不满足时这一天没有满足条件的资源
+    '''
+    first_feed_day = _first_day()
+    if first_feed_day is None:
+        return []
+    now = datetime.now()
+    min_upload = since - timedelta(days=UPLOAD_WINDOW_DAYS)
+    since = max(since, first_feed_day)
+    first_day = _day_start(since)
+    if first_day < since:
+        first_day += timedelta(days=1)
+    latest = {}
+    def merge(keyword, last_update):
+        if last_update >= min_upload and (keyword not in latest or last_update > latest[keyword]):
+            latest[keyword] = last_update
+
+    # 窗口开始的那一天只有一部分在窗口内
+    if first_day > since:
+        for item in _aggregate(since, min(first_day, now), min_upload):
+            merge(item['_id'], item['last_update'])
+
+    days = []
+    day = first_day
+    while day <= now:
+        days.append(day)
+        day += timedelta(days=1)
+    rollups = {r['_id']: r for r in mongoCollection('update_rollups').find({
+        '_id': {'$in': [day.strftime(DAY_FORMAT) for day in days]},
+    })}
+    final_delay = timedelta(seconds=settings.ROLLUP_FINAL_DELAY)
+    for day in days:
+        end = day + timedelta(days=1)
+        rollup = rollups.get(day.strftime(DAY_FORMAT))
+        if rollup is not None and rollup['updated_at'] >= end + final_delay:
+            updates = rollup['updates']
+        else:
+            # 今天、缺少的和不是最终的都重新聚合，已经不会变化的日期保存下来
+            updates = _day_updates(day, min(end, now))
+            if now >= end + final_delay:
+                _save_day(day, updates)
+        for update in updates:
+            merge(update['keyword'], update['last_update'])
+    return sorted(latest.items(), key=lambda item: item[1], reverse=True)
+
+def refresh_recent(since):
+    ''' 重建since到现在之间的每一天
+    '''
+    day = _day_start(since)
+    count = 0
+    while day <= datetime.now():
+        update_day(day)
+        day += timedelta(days=1)
+        count += 1
+    return count
+
+def rebuild_all():
+    first_day = _first_day()
+    if first_day is None:
+        return 0
+    return refresh_recent(first_day)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild', default=False, action='store_true')
+    parser.add_argument('--day', default=None, metavar='YYYY-MM-DD')
+    args = parser.parse_args()
+
+    logs.configure()
+    if args.day:
+        rollup = update_day(datetime.strptime(args.day, DAY_FORMAT))
+        logger.info('%s: %s keywords updated', rollup['_id'], len(rollup['updates']))
+    if args.rebuild:
+        logger.info('%s days of update rollups rebuilt', rebuild_all())
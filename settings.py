@@ -11,9 +11,86 @@ PORT = 5000
 ADDRESS = '0.0.0.0'
 
 CONTEXT_KEY = 'amwatcher:main:context:%s'
-PIN_KEY = 'amwatcher:main:pin:%s'
-LAST_CHECK_KEY = 'amwatcher:main:last_check_time:%s'
+STATE_KEY = 'amwatcher:main:state:%s'
+PAGE_KEY = 'amwatcher:main:page:%s:%s'
+# '..'随机推荐：打乱后的keyword id，每个12字节
 RECOMMEND_KEY = 'amwatcher:main:recommend:%s'
+PIN_KEY = 'amwatcher:main:pin:%s'
+PIN_CHANNEL = 'amwatcher:main:pin_channel:%s'
+# PIN码池（pins.py）
+PIN_POOL_KEY = 'amwatcher:main:pin_pool'
+PIN_POOL_READY_KEY = 'amwatcher:main:pin_pool:ready'
+PIN_POOL_LOCK_KEY = 'amwatcher:main:pin_pool:lock'
+PIN_LEASE_KEY = 'amwatcher:main:pin_lease'
+# 120秒有效，另外5秒留给网络延迟
+PIN_EXPIRE = 125
+PIN_RECYCLE_BATCH = 100
+# 会话在最后一条消息之后保持的秒数
+CONTEXT_EXPIRE = 300
+# 微信重试的消息：处理中或已处理的消息在MSG_KEY保存回复，重试的请求最多等待MSG_WAIT_TIMEOUT秒
+MSG_KEY = 'amwatcher:main:msg:%s'
+MSG_CACHE_EXPIRE = 30
+MSG_WAIT_TIMEOUT = 4.5
+MSG_WAIT_INTERVAL = 0.1
+# 会话记录超过这个长度时丢弃，下一条消息开启新会话
+CONTEXT_MAX_HISTORY = 100
+
+# MongoDB连接池，每个worker共用一个客户端，大小和uwsgi的gevent数保持一致
+MONGO_MAX_POOL_SIZE = LOCAL_CONFIG.get('MONGO_MAX_POOL_SIZE', 100)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = LOCAL_CONFIG.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000)
+# Redis连接池，连接用完时greenlet等待REDIS_POOL_TIMEOUT秒而不是直接报错
+REDIS_MAX_CONNECTIONS = LOCAL_CONFIG.get('REDIS_MAX_CONNECTIONS', 100)
+REDIS_POOL_TIMEOUT = LOCAL_CONFIG.get('REDIS_POOL_TIMEOUT', 2)
+
+# 内存中keyword搜索索引的重建间隔
+KEYWORD_INDEX_TTL = 60
+# meta集合（帮助信息等）的刷新间隔
+META_CACHE_TTL = 60
+
+# 登录页面等待PIN码绑定时，单次长轮询的最长时间和每个worker同时等待的上限
+# 每个等待都占用一个gevent协程（uwsgi.ini中gevent = 100），需要给微信消息留出足够的协程
+PIN_WAIT_TIMEOUT = 25
+PIN_MAX_WAITERS = 50
+
+# 异步回复：耗时的会话先回复success，由reply_worker.py处理后通过客服消息接口发送
+ASYNC_REPLY = LOCAL_CONFIG.get('ASYNC_REPLY', False)
+REPLY_QUEUE_KEY = 'amwatcher:main:reply_queue'
+REPLY_WORKERS = LOCAL_CONFIG.get('REPLY_WORKERS', 20)
+DELIVERY_BATCH = 20
+DELIVERY_RETRIES = 3
+WECHAT_API_BASE = LOCAL_CONFIG.get('WECHAT_API_BASE', 'https://api.weixin.qq.com')
+WECHAT_APPID = LOCAL_CONFIG.get('WECHAT_APPID', '')
+WECHAT_SECRET = LOCAL_CONFIG.get('WECHAT_SECRET', '')
+ACCESS_TOKEN_KEY = 'amwatcher:main:access_token'
+
+# 网页登录用户的缓存，用户记录变化时在USER_INVALIDATE_CHANNEL上通知所有worker
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+USER_INVALIDATE_CHANNEL = 'amwatcher:main:user_invalidate'
+
+# 运行指标：各进程每METRICS_FLUSH_INTERVAL秒把增量合并到METRICS_KEY，/metrics读取汇总结果
+METRICS_KEY = 'amwatcher:main:metrics'
+METRICS_FLUSH_INTERVAL = 10
+
+# !!N最多查询的天数
+UPDATES_MAX_DAYS = 365
+# 按天汇总在这一天结束多少秒后不再变化，至少要和资源爬取到分析完成（analyzed）的延迟一样长
+ROLLUP_FINAL_DELAY = 3600
+
+# keyword摘要的定期更新（summaries.py --watch，由uwsgi.ini的attach-daemon启动）
+SUMMARY_REFRESH_INTERVAL = 60
+SUMMARY_REFRESH_LOOKBACK = 3600
+
+# 日志级别，LOG_LEVELS可以单独设置模块的级别，例如{'dialogs': 'DEBUG', 'wechat.bot': 'DEBUG'}
+LOG_LEVEL = LOCAL_CONFIG.get('LOG_LEVEL', 'INFO')
+LOG_LEVELS = LOCAL_CONFIG.get('LOG_LEVELS', {})
+# 由独立线程每LOG_WRITE_INTERVAL秒写一次日志，队列中超过LOG_QUEUE_SIZE条时丢弃新的日志
+LOG_ASYNC = LOCAL_CONFIG.get('LOG_ASYNC', True)
+LOG_QUEUE_SIZE = 10000
+LOG_WRITE_INTERVAL = 0.05
+# 微信请求的XML按比例抽样记录，最多LOG_PAYLOAD_MAX个字符
+LOG_PAYLOAD_SAMPLE = LOCAL_CONFIG.get('LOG_PAYLOAD_SAMPLE', 0.01)
+LOG_PAYLOAD_MAX = 512
 
 LOGGING = {
     'version': 1,
@@ -34,19 +111,19 @@ LOGGING = {
             'class': 'logging.handlers.RotatingFileHandler',
             'formatter': 'detailed',
             'filename': '/data/logs/amwatcher.main.log',
-            'maxBytes': 1*1024*1024,
+            'maxBytes': 20*1024*1024,
             'backupCount': 10,
         },
     },
     'loggers': {
         '': {
             'handlers': ['console'],
-            'level': 'DEBUG'
+            'level': 'WARNING'
         },
         '__main__': {
             'propagate': False,
             'handlers': ['console', '__main__'],
-            'level': 'DEBUG'
+            'level': LOG_LEVEL
         },
     },
 }
\ No newline at end of file
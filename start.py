@@ -6,26 +6,29 @@ monkey.patch_all()
 import os
 import time
 import logging
-import logging.config
 import argparse
 import hashlib
 import requests
 from requests.utils import add_dict_to_cookiejar, dict_from_cookiejar
 import json
-import random
 from datetime import datetime
 from functools import wraps
 
-from flask import Flask, render_template, request, make_response, jsonify, session, escape, redirect, url_for
+from flask import Flask, render_template, request, make_response, jsonify, session, escape, redirect, url_for, g
 from flask_login import LoginManager, login_user, logout_user, current_user, login_required
-from pymongo import MongoClient
-from redis import StrictRedis
-from bson.objectid import ObjectId
 
 import settings
+import logs
+import backends
+import metrics
+from backends import mongoCollection, redis_db
 import wechat.bot
+import wechat.router
 import dialogs
-from modules import User
+import users
+import repository
+import pin_notify
+import pins
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 app = Flask(__name__, template_folder=tmpl_dir)
@@ -34,57 +37,49 @@ login_manager.login_view = "login"
 login_manager.init_app(app)
 app.secret_key = ']~\xa1\x81\xe6\xf0\xe9\x1c\x02\xf9\x10\x0c\xa9|%\xb3\xcb(\x95\x0b\xc2\xbe>\x95'
 
-logging.config.dictConfig(settings.LOGGING)
-logger = logging.getLogger('__main__')
+logs.configure()
+logger = logging.getLogger('__main__.start')
 
-local = settings.LOCAL_CONFIG
+@app.before_request
+def before_request():
+    g.request_start = time.perf_counter()
+    backends.begin_request()
 
-def mongoCollection(cname):
-    mongo_client = MongoClient(local['MONGO_URI'])
-    mongo_db = mongo_client[local['MONGO_DATABASE']]
-    return mongo_db[cname]
-
-redis_db = StrictRedis(
-    host=local['REDIS_HOST'], 
-    port=local['REDIS_PORT'], 
-    password=local['REDIS_PASSWORD'],
-    db=local['REDIS_DB']
-)
+@app.after_request
+def after_request(response):
+    # 每个请求新建的Mongo连接数，正常应为0，出现非0说明有代码绕过了共享连接池
+    connections = backends.request_connections()
+    response.headers['X-Mongo-Connections'] = str(connections)
+    if connections:
+        logger.warning('%s new mongo connection(s) opened in %s', connections, request.path)
+    # 按endpoint统计，404等没有endpoint的请求归为一类
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - start, request.endpoint or 'none', response.status_code)
+    return response
 
 @login_manager.user_loader
 def load_user(user_id):
-    logger.debug(user_id)
-    mongo_users = mongoCollection('users')
-    user_info = mongo_users.find_one({'_id': ObjectId(user_id.decode('utf-8'))})
-    logger.debug(user_info)
-    return User(user_info)
+    return users.load_user(user_id)
     
 @app.route('/login/', methods=['GET', 'POST'])
 def login():
     open_id = request.args.get('open_id', '')
     next = request.args.get('next', url_for('notify', _external=True, title='登陆成功', msg='登陆成功，您可以继续访问其他网页。'))
-    mongo_users = mongoCollection('users')
     if not open_id:
         # PIN Login logic
-        # Generate a 4-digit pin code
+        # Claim a 6-digit pin code from the pool
         # Bind pin code with HTML page
-        # In HTML page, start rolling checking for pin_login view
-        for i in range(10): # Retry 10 times at most
-            pin_code = int(random.random() * 1000000)
-            pin_code = str(pin_code).zfill(6)
-            pin_key = settings.PIN_KEY % pin_code
-            if not redis_db.exists(pin_key):
-                break
-        else:
+        # In HTML page, start waiting for pin_wait view
+        pin_code = pins.claim()
+        if pin_code is None:
             return '错误：找不到可用的PIN码'
-        redis_db.setex(pin_key, 125, 'EMPTY') # Expire after 120 sec, add another 5 sec for network delay
         return render_template('login.html', pin_code=pin_code)
         
-    user_info = mongo_users.find_one({'open_id': open_id})
-    logger.debug(user_info)
-    if not user_info:
+    user = repository.login_user(open_id=open_id)
+    logger.debug('User: %s', user)
+    if user is None:
         return render_template('login.html')
-    user = User(user_info)
     login_user(user)
     logger.info('Login success')
     
@@ -94,28 +89,45 @@ def login():
 def notify(title, msg):
     return render_template('notify.html', title=title, msg=msg)
 
-@app.route('/pin/<pin_code>/', methods=['GET'])
-def pin_login(pin_code):
-    ''' accquire by ajax page, getting pin status
-    Check redis key, if user send pin code in wechat, open_id will be set on redis
-    if key was set, return login page with open_id and redirect to next
+def _pin_status(pin_code):
+    ''' Check redis key, if user send pin code in wechat, open_id will be set on redis
+    返回None表示PIN码还没有被绑定
     '''
-    mongo_users = mongoCollection('users')
     pin_key = settings.PIN_KEY % pin_code
     pin_val = redis_db.get(pin_key)
     if not pin_val or pin_val.decode('utf-8') == 'EMPTY':
-        return jsonify({'status': False})
+        return None
     else:
         open_id = pin_val.decode('utf-8')
-        user_info = mongo_users.find_one({'open_id': open_id})
-        if user_info:
-            return jsonify({'status': True, 'open_id': pin_val.decode('utf-8')})
+        if repository.user_exists(open_id):
+            return {'status': True, 'open_id': pin_val.decode('utf-8')}
         else:
-            return jsonify({
+            return {
                 'status': False, 
                 'msg_title': '您的注册信息不存在',
                 'msg_content': '很抱歉系统中没有您的注册信息，请给公众号发送聊天信息"绑定"后再重新登录。'
-            })
+            }
+
+@app.route('/pin/<pin_code>/', methods=['GET'])
+def pin_login(pin_code):
+    ''' accquire by ajax page, getting pin status
+    if key was set, return login page with open_id and redirect to next
+    '''
+    return jsonify(_pin_status(pin_code) or {'status': False})
+
+@app.route('/pin/<pin_code>/wait/', methods=['GET'])
+def pin_wait(pin_code):
+    ''' 长轮询：等到PIN码被绑定或者PIN_WAIT_TIMEOUT秒后返回，页面收到status为False后再次请求
+    '''
+    try:
+        with pin_notify.waiter(pin_code) as event:
+            status = _pin_status(pin_code)
+            if status is None and event.wait(settings.PIN_WAIT_TIMEOUT):
+                status = _pin_status(pin_code)
+    except pin_notify.TooManyWaiters:
+        # 页面稍后重试
+        return jsonify({'status': False, 'busy': True}), 503
+    return jsonify(status or {'status': False})
 
 @app.route('/me/', methods=['GET'])
 @login_required
@@ -127,6 +139,28 @@ def keyword_menu():
     mongo_keywords = mongoCollection('keywords')
     return mongo_series.distinct('keyword_id', {'status': 'activated'})
         
+@app.route('/stats/router/', methods=['GET'])
+def router_stats():
+    ''' 当前worker中各条路由规则的命中次数和匹配耗时
+    '''
+    return jsonify({'pid': os.getpid(), 'routes': wechat.router.stats()})
+
+@app.route('/stats/pins/', methods=['GET'])
+def pin_stats():
+    ''' PIN码池的使用情况
+    '''
+    return jsonify(pins.stats())
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    ''' 所有worker汇总的运行指标，Prometheus文本格式
+    '''
+    # 先合并本worker还没写入的数据
+    metrics.flush()
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
 @app.route('/logout/', methods=['GET'])
 @login_required
 def logout():
@@ -151,7 +185,7 @@ def wechat_get():
     list = ''.join(list).encode('utf-8')
     logger.debug(list)
     hashcode = hashlib.sha1(list).hexdigest()
-    logger.info('handle/GET func: hashcode %s, signature %s' % (hashcode, signature))
+    logger.info('handle/GET func: hashcode %s, signature %s', hashcode, signature)
     if hashcode == signature:
         return echostr
     else:
@@ -162,7 +196,8 @@ def wechat_post():
     ''' WeChat reply bot
     '''
     data = request.get_data()
-    logger.info('Receiving data: %s' % data)
+    if logs.sample_payload(logger):
+        logger.info('Receiving data (%s bytes): %s', len(data), logs.Truncated(data, settings.LOG_PAYLOAD_MAX))
     return wechat.bot.answer(data, dialogs).format()
             
     
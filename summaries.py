@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#coding=utf-8
+''' 每个keyword的最新剧集摘要
+
+keyword_summary集合中每个keyword一个文档（_id为keyword_id），保存最后更新时间、
+最新一集的季/集/日期集数、这一集的资源id以及有效资源数，对话中只需要读这一个小文档。
+读取时只生成还没有的摘要，不在请求中重建：摘要由uwsgi启动的summaries.py --watch（uwsgi.ini中的attach-daemon）
+定期更新最近有新资源的keyword，爬虫写入series/feeds后也可以调用update_keyword_summary立即更新，或者通过命令行维护：
+    python summaries.py --rebuild        # 重建所有keyword的摘要
+    python summaries.py --keyword <id>   # 重建单个keyword
+    python summaries.py --watch          # 定期更新最近有新资源的keyword和rollups.py的按天汇总
+'''
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+from pymongo import DESCENDING
+from bson.objectid import ObjectId
+
+import settings
+import logs
+import rollups
+import indexes
+from backends import mongoCollection
+
+logger = logging.getLogger('__main__.summaries')
+
+SERIES_FIELDS = ('season', 'episode', 'date_episode', 'first_upload_time', 'feeds')
+
+def _last_series(keyword_id):
+    ''' 最近更新的ep，date_ep
+    '''
+    # 爬虫新写入的剧集还没有数字的排序字段
+    indexes.normalize_series(keyword_id)
+    mongo_series = mongoCollection('series')
+    last_ep_series = mongo_series.find_one({'keyword_id': keyword_id}, sort=indexes.EPISODE_ORDER)
+    if not last_ep_series:
+        return None
+    last_date_ep_series = mongo_series.find_one({'keyword_id': keyword_id}, sort=indexes.DATE_EPISODE_ORDER)
+    if last_ep_series['first_upload_time'] >= last_date_ep_series['first_upload_time']:
+        return last_ep_series
+    else:
+        return last_date_ep_series
+
+def build_summary(keyword_id):
+    mongo_feeds = mongoCollection('feeds')
+    valid_feeds = {
+        'keyword_id': keyword_id,
+        'break_rules': {
+            '$exists': False,
+        },
+    }
+    last_feed = mongo_feeds.find_one(valid_feeds, {'upload_time': True}, sort=[('upload_time', DESCENDING)])
+    summary = {
+        '_id': keyword_id,
+        'last_upload_time': last_feed['upload_time'] if last_feed else None,
+        'valid_feed_count': mongo_feeds.count(valid_feeds),
+        'updated_at': datetime.now(),
+    }
+    # 没有剧集的keyword不包含SERIES_FIELDS
+    last_series = _last_series(keyword_id)
+    if last_series:
+        for field in SERIES_FIELDS:
+            if field in last_series:
+                summary[field] = last_series[field]
+    return summary
+
+def update_keyword_summary(keyword_id):
+    summary = build_summary(keyword_id)
+    mongoCollection('keyword_summary').replace_one({'_id': keyword_id}, summary, upsert=True)
+    return summary
+
+def get_summary(keyword_id, projection=None):
+    ''' 读取keyword的摘要，还没有生成过的当场生成（当场生成的包含所有字段）
+    '''
+    summary = mongoCollection('keyword_summary').find_one({'_id': keyword_id}, projection)
+    if summary is None:
+        summary = update_keyword_summary(keyword_id)
+    return summary
+
+def get_summaries(keyword_ids, projection=None):
+    ''' 一次查询读取多个keyword的摘要，返回{keyword_id: summary}
+    '''
+    summaries = {s['_id']: s for s in mongoCollection('keyword_summary').find({'_id': {'$in': keyword_ids}}, projection)}
+    for keyword_id in keyword_ids:
+        if keyword_id not in summaries:
+            summaries[keyword_id] = update_keyword_summary(keyword_id)
+    return summaries
+
+def rebuild_all():
+    count = 0
+    for keyword in mongoCollection('keywords').find({}, {'_id': True}):
+        update_keyword_summary(keyword['_id'])
+        count += 1
+    return count
+
+def refresh_recent(since):
+    ''' 更新since之后爬取到新资源的keyword
+    '''
+    keyword_ids = mongoCollection('feeds').distinct('keyword_id', {'scrapy_time': {'$gte': since}})
+    for keyword_id in keyword_ids:
+        update_keyword_summary(keyword_id)
+    return len(keyword_ids)
+
+def watch(interval, lookback):
+    # 资源爬取后还要经过分析才会写入series，所以每次都回看lookback秒内的资源
+    while True:
+        since = datetime.now() - timedelta(seconds=lookback)
+        count = refresh_recent(since)
+        logger.info('%s keyword summaries refreshed', count)
+        # 同时重建最近的按天汇总，当天的汇总最多落后interval秒
+        rollups.refresh_recent(since)
+        time.sleep(interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild', default=False, action='store_true')
+    parser.add_argument('--keyword', default=None, metavar='KEYWORD_ID')
+    parser.add_argument('--watch', default=False, action='store_true')
+    parser.add_argument('--interval', default=settings.SUMMARY_REFRESH_INTERVAL, type=int, metavar='SECONDS')
+    parser.add_argument('--lookback', default=settings.SUMMARY_REFRESH_LOOKBACK, type=int, metavar='SECONDS')
+    args = parser.parse_args()
+
+    logs.configure()
+    if args.keyword:
+        logger.info(update_keyword_summary(ObjectId(args.keyword)))
+    if args.rebuild:
+        logger.info('%s keyword summaries rebuilt', rebuild_all())
+    if args.watch:
+        watch(args.interval, args.lookback)
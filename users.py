@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+''' Flask-Login使用的用户缓存
+
+load_user先查worker内的LRU缓存，缓存中没有时才读mongo。
+用户记录被修改时调用invalidate_user，除了清掉本worker中这个用户的缓存，还会在USER_INVALIDATE_CHANNEL上
+publish这个用户的open_id，其他worker通过channels.py的订阅收到后只删掉对应用户的缓存，其他用户的缓存不受影响。
+订阅断开重连时收不到期间的通知，所以重新订阅后清空整个缓存。
+_users和_user_ids总是同时写入、同时访问，两个LRU的顺序一致，缓存中的用户一定能按open_id找到。
+'''
+import logging
+
+import settings
+import backends
+import channels
+import repository
+from cache import LRUCache
+
+logger = logging.getLogger('__main__.users')
+
+# user_id（session中保存的mongo _id）到User
+_users = LRUCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+# open_id到user_id，失效通知中只有open_id
+_user_ids = LRUCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+def _forget(open_id):
+    user_id = _user_ids.get(open_id)
+    if user_id is not None:
+        _users.pop(user_id)
+        _user_ids.pop(open_id)
+
+def _clear():
+    _users.clear()
+    _user_ids.clear()
+
+channels.register(settings.USER_INVALIDATE_CHANNEL, lambda channel, open_id: _forget(open_id), _clear)
+
+def load_user(user_id):
+    if isinstance(user_id, bytes):
+        user_id = user_id.decode('utf-8')
+    channels.ensure_listener()
+    user = _users.get(user_id)
+    if user is not None:
+        # 同时更新_user_ids中的顺序，不会先于_users被淘汰
+        if _user_ids.get(user.open_id) != user_id:
+            _user_ids.put(user.open_id, user_id)
+    else:
+        user = repository.login_user(user_id=user_id)
+        if user is None:
+            return None
+        _users.put(user_id, user)
+        _user_ids.put(user.open_id, user_id)
+        logger.debug('User %s loaded', user_id)
+    return user
+
+def invalidate_user(open_id):
+    ''' 用户记录（active等）变化后调用
+    '''
+    _forget(open_id)
+    backends.redis_db.publish(settings.USER_INVALIDATE_CHANNEL, open_id)
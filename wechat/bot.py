@@ -1,149 +1,346 @@
 # -*- coding: utf-8 -*-
 
 import json
-import re
+import time
 import logging
-from redis import StrictRedis
 import settings
+import backends
+import metrics
+import logs
 
-from . import reply, receive
+from . import reply, receive, router
 
-logger = logging.getLogger('__main__')
+logger = logging.getLogger('__main__.wechat.bot')
 
-dialog_module = None
-hkey = None
-redis_db = None
+# 追加一条会话记录，列表第一个元素是generator的名字，其余为json编码的消息
+# KEYS[1]: 会话记录 ARGV: 会话名, 消息, 过期时间, 最大长度
+APPEND_HISTORY_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+local length = redis.call('RPUSH', KEYS[1], ARGV[2])
+if length > tonumber(ARGV[4]) then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return length
+'''
+
+# 消息正在处理中的标记，回复的XML不会是这个值
+MSG_PENDING = b'\x00pending'
 
 class UnexpectAnswer(Exception):
     ''' Raise it if user give an unexpected answer
     '''
     pass
 
-def _redis_replay(key, dialog):
+def snapshot(func):
+    ''' 标记快照式会话
+    快照式会话是普通函数 func(to_user, msg_content, state)，返回 (回复, state)。
+    state是可以json序列化的dict，开启会话时为None，返回None表示会话结束。
+    每轮对话直接读取redis中保存的state继续，不需要像generator会话一样重放全部历史消息。
+    '''
+    func.snapshot = True
+    return func
+
+def _opening(msg_content, state):
+    return state is None
+
+def background(func=None, when=None):
+    ''' 标记耗时的快照式会话
+    开启异步回复（settings.ASYNC_REPLY）后，when(msg_content, state)为真的消息不在webhook中处理，
+    而是放进REPLY_QUEUE_KEY由reply_worker.py处理，结果通过客服消息接口发给用户。
+    when默认只在开启会话时为真，翻页这类读缓存的回复仍然直接返回。
+    '''
+    def mark(func):
+        func.background = when or _opening
+        return func
+    if func is None:
+        return mark
+    return mark(func)
+
+class Context(object):
+    ''' 单条消息的处理上下文
+    同一个worker里的greenlet会在redis I/O时切换，会话相关的状态都放在这里而不是模块全局变量
+    会话记录和快照的写操作先放进pipe，消息处理完后调用flush一次性提交
+    '''
+    def __init__(self, module, to_user, redis_db=None):
+        self.module = module
+        self.to_user = to_user
+        self.hkey = settings.CONTEXT_KEY % to_user
+        self.skey = settings.STATE_KEY % to_user
+        self.redis_db = redis_db or backends.redis_db
+        self.pipe = self.redis_db.pipeline()
+
+    def load(self, msg_key=None):
+        ''' 一次往返读取会话记录和快照
+        有msg_key时同时占用这条消息，返回的claimed为False说明同一条消息已经在处理或者处理过了
+        '''
+        pipe = self.redis_db.pipeline(transaction=False)
+        if msg_key:
+            pipe.set(msg_key, MSG_PENDING, ex=settings.MSG_CACHE_EXPIRE, nx=True)
+        pipe.lrange(self.hkey, 0, -1)
+        pipe.get(self.skey)
+        results = pipe.execute(raise_on_error=False)
+        claimed = bool(results.pop(0)) if msg_key else True
+        hist, snap = results
+        if isinstance(snap, Exception):
+            raise snap
+        if isinstance(hist, Exception):
+            # 旧版本用json字符串保存的会话记录，直接丢弃
+            logger.warning('Dropping legacy dialog history of %s', self.to_user)
+            self.pipe.delete(self.hkey)
+            hist = []
+        return claimed, hist, snap
+
+    def reset(self):
+        self.pipe.delete(self.hkey, self.skey)
+
+    def flush(self):
+        self.pipe.execute()
+
+class SnapshotDialog(object):
+    ''' 快照式会话的运行器，每次send后把新的state写回redis
+    '''
+    def __init__(self, ctx, name, state=None):
+        self.ctx = ctx
+        self.name = name
+        self.state = state
+        self.handler = getattr(ctx.module, name)
+
+    def send(self, msg_content, expire=settings.CONTEXT_EXPIRE):
+        reply_msg, self.state = self.handler(self.ctx.to_user, msg_content, self.state)
+        if self.state is None:
+            self.ctx.pipe.delete(self.ctx.skey)
+        else:
+            self.ctx.pipe.setex(self.ctx.skey, expire, json.dumps([self.name, self.state]))
+        return reply_msg
+
+def _redis_replay(ctx, dialog, hist):
     ''' Replay dialog based on redis history
     '''
-    hist = redis_db.get(key)
-    if not hist:
-        raise Exception('Empty hist!')
-    else:
-        hist = json.loads(hist.decode('utf-8'))[1:]
-    for step in hist:
-        dialog.send((step, True))
+    for step in hist[1:]:
+        dialog.send((json.loads(step.decode('utf-8')), True))
     return dialog
         
-def _redis_send(key, dialog, msg, expire=300):
+def _redis_send(ctx, dialog, msg, expire=settings.CONTEXT_EXPIRE):
     ''' Send msg to dialog and store history to redis
     '''
-    hist = redis_db.get(key)
-    if not hist:
-        logger.debug(dialog.__name__)
-        # 第一个元素用于存generator的名字，其余均为消息记录
-        hist = [dialog.__name__]
-    else:
-        hist = json.loads(hist.decode('utf-8'))
-    hist.append(msg)
-    redis_db.setex(key, expire, json.dumps(hist))
-    logger.debug(dialog)
+    # 追加和刷新过期时间在redis中原子完成，同一用户的并发消息不会互相覆盖
+    ctx.pipe.eval(APPEND_HISTORY_SCRIPT, 1, ctx.hkey, dialog.__name__, json.dumps(msg), expire, settings.CONTEXT_MAX_HISTORY)
+    logger.debug('Send to %s', dialog)
     return dialog.send((msg, False))
     
 
-def _new_dialog(msg_type, msg_content, to_user):
-    redis_db.delete(hkey)
+def _send(ctx, dialog, msg):
+    if isinstance(dialog, SnapshotDialog):
+        return dialog.send(msg)
+    return _redis_send(ctx, dialog, msg)
+
+def _new_dialog(ctx, msg_type, msg_content):
+    ctx.reset()
     # 根据router重新选择并构造回复器
-    if msg_type in dialog_module.ROUTER:
-        router = dialog_module.ROUTER[msg_type]
-    else:
-        router = dialog_module.ROUTER['text']
-    for pattern, dialog_name in router:
-        regex = re.compile(pattern)
-        if regex.match(msg_content):
-            dialog = getattr(dialog_module, dialog_name)(to_user)
-            break
-    else:
+    table = router.compiled(ctx.module.ROUTER)
+    route = table.route(msg_type if msg_type in table else 'text', msg_content)
+    if route is None:
         raise Exception('Router not found')
+    dialog_name = route.name
+    handler = getattr(ctx.module, dialog_name)
+    if getattr(handler, 'snapshot', False):
+        # 快照式会话在answer中第一次send时才处理消息
+        return SnapshotDialog(ctx, dialog_name)
+    dialog = handler(ctx.to_user)
     # 初始化操作
     dialog.send(None)
-    _redis_send(hkey, dialog, msg_content)
+    _redis_send(ctx, dialog, msg_content)
     return dialog
     
-def _replay_dialog(hist, to_user):
+def _replay_dialog(ctx, hist):
     # 从hist中获取这个消息的处理器
-    dialog_name = json.loads(hist.decode('utf-8'))[0]
-    dialog = getattr(dialog_module, dialog_name)(to_user)
+    dialog_name = hist[0].decode('utf-8')
+    metrics.REPLAY_DEPTH.observe(len(hist) - 1, dialog_name)
+    dialog = getattr(ctx.module, dialog_name)(ctx.to_user)
     # 重现上下文
     dialog.send(None)
-    _redis_replay(hkey, dialog)
+    _redis_replay(ctx, dialog, hist)
     return dialog
 
-def answer(data, module):
-    # Extract msg
-    msg = receive.parse_xml(data)
-    msg_type = msg.MsgType
-    to_user = msg.FromUserName
-    from_user = msg.ToUserName
-    if isinstance(msg, receive.TextMsg):
-        msg_content = msg.Content.decode('utf-8')
-    elif isinstance(msg, receive.EventMsg):
-        msg_content = msg.Event.decode('utf-8')
-    else:
-        msg_content = 'default'
-    
-    # Initialize environment
-    global dialog_module
-    dialog_module = module
-    global hkey
-    hkey = settings.CONTEXT_KEY %  to_user
-    global redis_db
-    local = settings.LOCAL_CONFIG
-    redis_db = StrictRedis(
-        host=local['REDIS_HOST'], 
-        port=local['REDIS_PORT'], 
-        password=local['REDIS_PASSWORD'],
-        db=local['REDIS_DB']
-    )
-        
-    hist = redis_db.get(hkey)
+def _resume_dialog(ctx, snap):
+    # 从快照中恢复会话，不需要重放
+    dialog_name, state = json.loads(snap.decode('utf-8'))
+    return SnapshotDialog(ctx, dialog_name, state)
+
+def _load_dialog(ctx, msg_type, msg_content, hist, snap):
+    # 存在会话快照，直接恢复
+    if snap:
+        logger.debug('resume_dialog')
+        try:
+            return _resume_dialog(ctx, snap)
+        except Exception:
+            logger.error('会话快照错误..重新创建会话..')
+            return _new_dialog(ctx, msg_type, msg_content)
     # 新会话或者会话超时，创建新会话
-    if not hist:
-        dialog = _new_dialog(msg_type, msg_content, to_user)
+    elif not hist:
         logger.debug('new_dialog')
+        return _new_dialog(ctx, msg_type, msg_content)
     # 存在会话记录，重现上下文
     else:
         logger.debug('replay_dialog')
         try:
-            dialog = _replay_dialog(hist, to_user)
+            return _replay_dialog(ctx, hist)
         except Exception:
             logger.error('会话记录错误..重新创建会话..')
-            dialog = _new_dialog(msg_type, msg_content, to_user)
+            return _new_dialog(ctx, msg_type, msg_content)
+
+def _dialog_name(dialog):
+    if isinstance(dialog, SnapshotDialog):
+        return dialog.name
+    return dialog.__name__
+
+def _run(ctx, dialog, msg_type, msg_content, from_user=None):
+    ''' 返回(回复类型, 回复内容)
+    from_user不是None时（微信请求中）需要在后台处理的会话放进队列并返回None，
+    包括恢复的会话抛出UnexpectAnswer之后新建的会话
+    '''
+    start = time.perf_counter()
     # 发送消息
     while True:
+        if from_user is not None and _in_background(dialog, msg_content):
+            # 先回复success，处理结果由reply_worker通过客服消息发送
+            _enqueue(ctx, from_user, msg_type, msg_content, dialog)
+            return None
         try:
-            type, msg = _redis_send(hkey, dialog, msg_content)
+            type, msg = _send(ctx, dialog, msg_content)
             break
         except StopIteration as e:
             # 会话已结束，删去redis中的记录
             type, msg = e.value
-            redis_db.delete(hkey)
+            ctx.pipe.delete(ctx.hkey)
             break
         except UnexpectAnswer as e:
             # 用户发送了一个不合法的回复时抛出这个异常
             # BOT会认为用户希望开启一段新的会话
-            redis_db.delete(hkey)
+            ctx.reset()
             if str(e):
                 # 通过Exception value可以控制输入
                 msg_content = str(e)
-            dialog = _new_dialog(msg_type, msg_content, to_user)
+            dialog = _new_dialog(ctx, msg_type, msg_content)
             continue
+    # UnexpectAnswer之后的新会话也算在最终回复的会话上
+    metrics.dialog(_dialog_name(dialog), time.perf_counter() - start)
+    return type, msg
+
+def _in_background(dialog, msg_content):
+    if not settings.ASYNC_REPLY or not isinstance(dialog, SnapshotDialog):
+        return False
+    when = getattr(dialog.handler, 'background', None)
+    return bool(when and when(msg_content, dialog.state))
+
+def _enqueue(ctx, from_user, msg_type, msg_content, dialog):
+    job = {
+        'to_user': ctx.to_user,
+        'from_user': from_user,
+        'msg_type': msg_type,
+        'msg_content': msg_content,
+        'dialog': dialog.name,
+        'state': dialog.state,
+        'queued_at': time.time(),
+    }
+    ctx.pipe.rpush(settings.REPLY_QUEUE_KEY, json.dumps(job))
+    metrics.tag(dialog=dialog.name)
+
+def run_job(job, module):
+    ''' 在reply_worker中处理answer放进队列的消息，返回(回复类型, 回复内容)
+    '''
+    ctx = Context(module, job['to_user'])
+    dialog = SnapshotDialog(ctx, job['dialog'], job['state'])
+    result = _run(ctx, dialog, job['msg_type'], job['msg_content'])
+    ctx.flush()
+    return result
+
+def _message_key(msg):
+    ''' 微信在回复超时后会重发同一条消息，普通消息用MsgId识别，事件用FromUserName+CreateTime
+    '''
+    if msg.MsgId:
+        return settings.MSG_KEY % msg.MsgId
+    if msg.FromUserName and msg.CreateTime:
+        return settings.MSG_KEY % ('%s:%s' % (msg.FromUserName, msg.CreateTime))
+    return None
+
+def _wait_reply(ctx, msg_key):
+    ''' 等待正在处理的同一条消息的回复，超时则回复success，微信不会再重试
+    '''
+    metrics.tag(dialog='(duplicate)')
+    deadline = time.time() + settings.MSG_WAIT_TIMEOUT
+    while True:
+        data = ctx.redis_db.get(msg_key)
+        if data is None:
+            # 第一次处理失败，记录已删除
+            break
+        if data != MSG_PENDING:
+            logger.info('Reply of %s served from cache', msg_key)
+            return reply.RawMsg(data)
+        if time.time() >= deadline:
+            break
+        time.sleep(settings.MSG_WAIT_INTERVAL)
+    logger.warning('Duplicate message %s not answered', msg_key)
+    return reply.Msg()
+
+@metrics.measure_message
+def answer(data, module):
+    # Extract msg
+    msg = receive.parse_xml(data)
+    msg_type = msg.MsgType
+    # MsgType来自请求，不认识的类型归为一类，避免标签无限增长
+    metrics.tag(msg_type=msg_type if msg_type in receive.MSG_TYPES else 'other')
+    to_user = msg.FromUserName
+    from_user = msg.ToUserName
+    if isinstance(msg, receive.TextMsg):
+        msg_content = msg.Content
+    elif isinstance(msg, receive.EventMsg):
+        msg_content = msg.Event
+    else:
+        msg_content = 'default'
     
-    wechat_reply = getattr(reply, type)
-    print(wechat_reply(
-        to_user, 
-        from_user, 
-        msg
-    ).format())
-    return wechat_reply(
+    # Initialize environment
+    ctx = Context(module, to_user)
+    msg_key = _message_key(msg)
+    claimed, hist, snap = ctx.load(msg_key)
+    if not claimed:
+        return _wait_reply(ctx, msg_key)
+    try:
+        wechat_reply = _answer(ctx, msg_type, msg_content, from_user, hist, snap)
+        if msg_key:
+            data = wechat_reply.format()
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            ctx.pipe.setex(msg_key, settings.MSG_CACHE_EXPIRE, data)
+            wechat_reply = reply.RawMsg(data)
+        ctx.flush()
+    except Exception:
+        if msg_key:
+            # 让微信的重试重新处理
+            ctx.redis_db.delete(msg_key)
+        raise
+    return wechat_reply
+
+def _answer(ctx, msg_type, msg_content, from_user, hist, snap):
+    to_user = ctx.to_user
+    dialog = _load_dialog(ctx, msg_type, msg_content, hist, snap)
+    result = _run(ctx, dialog, msg_type, msg_content, from_user)
+    if result is None:
+        return reply.Msg()
+    type, msg = result
+    
+    if isinstance(msg, reply.Prerendered):
+        wechat_reply = msg
+    else:
+        wechat_reply = getattr(reply, type)
+    wechat_reply = wechat_reply(
         to_user, 
         from_user, 
         msg
     )
-    
\ No newline at end of file
+    logger.debug('Reply to %s: %s', to_user, logs.Lazy(wechat_reply.format))
+    return wechat_reply
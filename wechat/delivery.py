@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+''' 通过客服消息接口主动发送回复
+
+DeliveryClient.send_batch(messages)发送一批消息，返回发送失败、可以重试的消息。
+WeChatClient调用微信的客服消息接口，api_base可以指向本地的桩服务器做测试。
+'''
+import json
+import logging
+import requests
+
+import settings
+import backends
+from . import reply
+
+logger = logging.getLogger('__main__.wechat.delivery')
+
+# access_token失效，需要重新获取
+TOKEN_ERRCODES = (40001, 40014, 42001)
+# 可以重试的错误：系统繁忙和access_token失效，其余（例如用户超过48小时未互动）重试也不会成功
+RETRY_ERRCODES = (-1,) + TOKEN_ERRCODES
+
+def to_message(to_user, type, msg):
+    ''' 把dialog的回复(type, msg)转换成客服消息
+    '''
+    if isinstance(msg, reply.Prerendered):
+        type, msg = msg.msg_type, msg.content
+    if type == 'TextMsg':
+        return {'touser': to_user, 'msgtype': 'text', 'text': {'content': msg}}
+    if type == 'NewsMsg':
+        return {'touser': to_user, 'msgtype': 'news', 'news': {'articles': [{
+            'title': article['title'],
+            'description': article['description'],
+            'url': article['url'],
+            'picurl': article.get('pic_url', reply.DEFAULT_PIC_URL),
+        } for article in msg]}}
+    if type == 'ImageMsg':
+        return {'touser': to_user, 'msgtype': 'image', 'image': {'media_id': msg}}
+    raise ValueError('Unsupported reply type: %s' % type)
+
+class DeliveryClient(object):
+    def send_batch(self, messages):
+        raise NotImplementedError
+
+class WeChatClient(DeliveryClient):
+    def __init__(self, api_base, appid, secret, timeout=5):
+        self.api_base = api_base.rstrip('/')
+        self.appid = appid
+        self.secret = secret
+        self.timeout = timeout
+        # 一批消息复用同一个HTTP连接
+        self.session = requests.Session()
+
+    def _fetch_token(self):
+        res = self.session.get('%s/cgi-bin/token' % self.api_base, params={
+            'grant_type': 'client_credential',
+            'appid': self.appid,
+            'secret': self.secret,
+        }, timeout=self.timeout).json()
+        if 'access_token' not in res:
+            raise Exception('Failed to get access_token: %s' % res)
+        # 多个进程共用同一个access_token，提前5分钟过期
+        expire = max(int(res.get('expires_in', 7200)) - 300, 60)
+        backends.redis_db.setex(settings.ACCESS_TOKEN_KEY, expire, res['access_token'])
+        return res['access_token']
+
+    def access_token(self, refresh=False):
+        if not refresh:
+            token = backends.redis_db.get(settings.ACCESS_TOKEN_KEY)
+            if token:
+                return token.decode('utf-8')
+        return self._fetch_token()
+
+    def _post(self, token, message):
+        return self.session.post(
+            '%s/cgi-bin/message/custom/send' % self.api_base,
+            params={'access_token': token},
+            data=json.dumps(message, ensure_ascii=False).encode('utf-8'),
+            timeout=self.timeout,
+        ).json()
+
+    def send_batch(self, messages):
+        failed = []
+        try:
+            token = self.access_token()
+        except Exception:
+            logger.exception('Delivery failed: no access_token')
+            return list(messages)
+        for message in messages:
+            try:
+                res = self._post(token, message)
+                if res.get('errcode') in TOKEN_ERRCODES:
+                    token = self.access_token(refresh=True)
+                    res = self._post(token, message)
+            except Exception:
+                logger.exception('Delivery to %s failed', message['touser'])
+                failed.append(message)
+                continue
+            if res.get('errcode', 0) != 0:
+                logger.error('Delivery to %s failed: %s', message['touser'], res)
+                if res.get('errcode') in RETRY_ERRCODES:
+                    failed.append(message)
+        return failed
+
+def make_client():
+    return WeChatClient(settings.WECHAT_API_BASE, settings.WECHAT_APPID, settings.WECHAT_SECRET)
@@ -1,28 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import json
-import re
 import settings
+from backends import redis_db
 import logging
-from redis import StrictRedis
-from pymongo import MongoClient
 from flask import url_for
 
 from . import reply, receive
+from .router import Router
 
-logger = logging.getLogger('__main__')
+logger = logging.getLogger('__main__.wechat.handler')
 
-local = settings.LOCAL_CONFIG
-redis_db = StrictRedis(
-    host=local['REDIS_HOST'], 
-    port=local['REDIS_PORT'], 
-    password=local['REDIS_PASSWORD'],
-    db=local['REDIS_DB']
-)
-def mongoCollection(cname):
-    mongo_client = MongoClient(local['MONGO_URI'])
-    mongo_db = mongo_client[local['MONGO_DATABASE']]
-    return mongo_db[cname]
 
 def _redis_replay(key, dialog):
     ''' Replay dialog based on redis history
@@ -53,7 +41,7 @@ def _redis_send(key, dialog, msg, expire=60):
     return dialog.send(msg)
     
 
-ROOT_ROUTER = {
+ROOT_ROUTER = Router({
     'text': [
         ('^[\?\？]$', 'show_help'),
         ('^[!！]$', 'get_status'),
@@ -66,20 +54,16 @@ ROOT_ROUTER = {
         # ('^unsubscribe$', deactive_user),
         ('.*', 'show_help'),
     ],
-}
+})
 
 def _new_dialog(msg_type, msg_content, to_user):
     hkey = settings.CONTEXT_KEY % to_user
     redis_db.delete(settings.CONTEXT_KEY % to_user)
     # 根据router重新选择并构造回复器
-    router = ROOT_ROUTER[msg_type]
-    for pattern, fname in router:
-        regex = re.compile(pattern)
-        if regex.match(msg_content):
-            dialog = getattr(DialogFactory, fname)(to_user)
-            break
-    else:
+    route = ROOT_ROUTER.route(msg_type, msg_content)
+    if route is None:
         raise Exception('Router not found')
+    dialog = getattr(DialogFactory, route.name)(to_user)
     # 初始化操作
     dialog.send(None)
     _redis_send(hkey, dialog, msg_content)
@@ -101,9 +85,9 @@ def answer(msg):
     to_user = msg.FromUserName
     from_user = msg.ToUserName
     if isinstance(msg, receive.TextMsg):
-        msg_content = msg.Content.decode('utf-8')
+        msg_content = msg.Content
     elif isinstance(msg, receive.EventMsg):
-        msg_content = msg.Event.decode('utf-8')
+        msg_content = msg.Event
     else:
         msg_content = 'default'
         
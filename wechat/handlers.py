@@ -2,26 +2,16 @@
 
 import re
 import settings
+import logs
+from backends import mongoCollection, redis_db
 import logging
-from redis import StrictRedis
-from pymongo import MongoClient
 from flask import url_for
 
 from . import reply, receive
+from .router import Router, compiled
 
-logger = logging.getLogger('__main__')
+logger = logging.getLogger('__main__.wechat.handlers')
 
-local = settings.LOCAL_CONFIG
-redis_db = StrictRedis(
-    host=local['REDIS_HOST'], 
-    port=local['REDIS_PORT'], 
-    password=local['REDIS_PASSWORD'],
-    db=local['REDIS_DB']
-)
-def mongoCollection(cname):
-    mongo_client = MongoClient(local['MONGO_URI'])
-    mongo_db = mongo_client[local['MONGO_DATABASE']]
-    return mongo_db[cname]
 
 def getHandler(msg):
     hkey = settings.CONTEXT_KEY % msg.FromUserName
@@ -44,24 +34,21 @@ class Handler(object):
         self.from_user = msg.ToUserName
         self.hkey = settings.CONTEXT_KEY % self.to_user
         if isinstance(msg, receive.TextMsg):
-            self.router_key = msg.Content.decode('utf-8')
+            self.router_key = msg.Content
         elif isinstance(msg, receive.EventMsg):
-            self.router_key = msg.Event.decode('utf-8')
+            self.router_key = msg.Event
         else:
             self.router_key = 'default'
     
     def reply(self):
-        router = self.router[self.msg_type]
-        for pattern, fname in router:
-            regex = re.match(pattern, self.router_key)
-            if regex:
-                func = getattr(self, fname)
-                reply_msg = func(regex)
-                break
+        route = compiled(self.router).route(self.msg_type, self.router_key)
+        if route is not None:
+            regex = route.regex.match(self.router_key)
+            reply_msg = getattr(self, route.name)(regex)
         else:
             regex = re.match('.*', self.router_key)
             reply_msg = self.default_reply(regex)
-        logger.debug(reply_msg.format())
+        logger.debug('Reply: %s', logs.Lazy(reply_msg.format))
         return reply_msg
             
     def default_reply(self, regex):
@@ -72,7 +59,7 @@ class Handler(object):
         )
 
 class RootHandler(Handler):
-    router = {
+    router = Router({
         'text': [
             ('^[\?\？]$', 'show_help'),
             ('^[!！]$', 'get_status'),
@@ -83,7 +70,7 @@ class RootHandler(Handler):
             ('^subscribe$', 'active_user'),
             ('^unsubscribe$', 'deactive_user'),
         ],
-    }
+    })
     
     def default_reply(self, regex):
         # Default: Search keyword
@@ -1,54 +1,89 @@
 # -*- coding: utf-8 -*-
 # filename: receive.py
+''' 解析微信推送的消息
+
+微信消息是固定的一层<xml>结构，常见类型直接用一次正则扫描取出全部字段，
+遇到嵌套元素、实体、未知消息类型等无法确定的情况时退回ElementTree。
+消息对象使用__slots__，Content/Event等字段都是已经解码的str。
+'''
+import re
 import xml.etree.ElementTree as ET
 import json
 
+# 一个字段：<Tag><![CDATA[...]]></Tag> 或者 <Tag>不含<和&的文本</Tag>
+# CDATA中不能有]]>：含有]]>的文本会被拆成多个CDATA段，这种情况交给ElementTree
+_FIELD = re.compile(r'\s*<(\w+)>(?:<!\[CDATA\[((?:(?!\]\]>).)*)\]\]>|([^<&]*))</\1>', re.S)
+
+def _scan(web_data):
+    ''' 单次扫描解析，无法处理时返回None
+    '''
+    try:
+        text = web_data.decode('utf-8') if isinstance(web_data, bytes) else web_data
+    except UnicodeDecodeError:
+        return None
+    text = text.strip()
+    if not text.startswith('<xml>') or not text.endswith('</xml>'):
+        return None
+    end = len(text) - len('</xml>')
+    pos = len('<xml>')
+    fields = {}
+    while True:
+        m = _FIELD.match(text, pos, end)
+        if m is None:
+            break
+        value = m.group(2) if m.group(2) is not None else m.group(3)
+        if '\r' in value:
+            # 和XML解析器一样统一换行符
+            value = value.replace('\r\n', '\n').replace('\r', '\n')
+        fields[m.group(1)] = value
+        pos = m.end()
+    if text[pos:end].strip():
+        return None
+    return fields
+
+def _parse_etree(web_data):
+    xmlData = ET.fromstring(web_data)
+    return {child.tag: child.text or '' for child in xmlData}
+
 def parse_xml(web_data):
     if len(web_data) == 0:
         return None
-    xmlData = ET.fromstring(web_data)
-    msg_type = xmlData.find('MsgType').text
-    if msg_type == 'text':
-        return TextMsg(xmlData)
-    elif msg_type == 'image':
-        return ImageMsg(xmlData)
-    elif msg_type == 'link':
-        return LinkMsg(xmlData)
-    elif msg_type == 'event':
-        return EventMsg(xmlData)
-    else:
-        return Msg(xmlData)
+    fields = _scan(web_data)
+    if fields is None or fields.get('MsgType') not in MSG_TYPES:
+        fields = _parse_etree(web_data)
+    return MSG_TYPES.get(fields.get('MsgType'), Msg)(fields)
 
 class Msg(object):
-    def __init__(self, xmlData):
-        self.ToUserName = xmlData.find('ToUserName').text
-        self.FromUserName = xmlData.find('FromUserName').text
-        self.CreateTime = xmlData.find('CreateTime').text
-        self.MsgType = xmlData.find('MsgType').text
-        
+    __slots__ = ('ToUserName', 'FromUserName', 'CreateTime', 'MsgType', 'MsgId')
+    FIELDS = __slots__
+
+    def __init__(self, fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+
     def __repr__(self):
-        value_dict = {k: str(v) for k, v in self.__dict__.items()}
+        value_dict = {k: str(getattr(self, k)) for k in self.FIELDS}
         return json.dumps(value_dict, indent=4)
 
-class EventMsg(object):
-    def __init__(self, xmlData):
-        Msg.__init__(self, xmlData)
-        self.Event = xmlData.find('Event').text.encode("utf-8")
-        
+class EventMsg(Msg):
+    __slots__ = ('Event', 'EventKey')
+    FIELDS = Msg.FIELDS + __slots__
+
 class TextMsg(Msg):
-    def __init__(self, xmlData):
-        Msg.__init__(self, xmlData)
-        self.Content = xmlData.find('Content').text.encode("utf-8")
+    __slots__ = ('Content',)
+    FIELDS = Msg.FIELDS + __slots__
 
 class ImageMsg(Msg):
-    def __init__(self, xmlData):
-        Msg.__init__(self, xmlData)
-        self.PicUrl = xmlData.find('PicUrl').text
-        self.MediaId = xmlData.find('MediaId').text
-        
+    __slots__ = ('PicUrl', 'MediaId')
+    FIELDS = Msg.FIELDS + __slots__
+
 class LinkMsg(Msg):
-    def __init__(self, xmlData):
-        Msg.__init__(self, xmlData)
-        self.Title = xmlData.find('Title').text
-        self.Description = xmlData.find('Description').text
-        self.Url = xmlData.find('Url').text
\ No newline at end of file
+    __slots__ = ('Title', 'Description', 'Url')
+    FIELDS = Msg.FIELDS + __slots__
+
+MSG_TYPES = {
+    'text': TextMsg,
+    'image': ImageMsg,
+    'link': LinkMsg,
+    'event': EventMsg,
+}
@@ -3,6 +3,8 @@
 import time
 import json
 
+DEFAULT_PIC_URL = 'http://okmokavp8.bkt.clouddn.com/images/Untitled%20picture.png'
+
 class Msg(object):
     def __init__(self):
         pass
@@ -12,12 +14,20 @@ class Msg(object):
     def format(self):
         return "success"
 
+class RawMsg(Msg):
+    ''' 已经序列化好的回复
+    '''
+    def __init__(self, data):
+        self.data = data
+    def format(self):
+        return self.data
+
 class TextMsg(Msg):
-    def __init__(self, toUserName, fromUserName, content):
+    def __init__(self, toUserName, fromUserName, content, createTime=None):
         self.__dict = dict()
         self.__dict['ToUserName'] = toUserName
         self.__dict['FromUserName'] = fromUserName
-        self.__dict['CreateTime'] = int(time.time())
+        self.__dict['CreateTime'] = createTime or int(time.time())
         self.__dict['Content'] = content
 
     def format(self):
@@ -40,11 +50,11 @@ class NewsMsg(Msg):
         'url': xxx,
     }
     '''
-    def __init__(self, toUserName, fromUserName, articles):
+    def __init__(self, toUserName, fromUserName, articles, createTime=None):
         self.__dict = dict()
         self.__dict['ToUserName'] = toUserName
         self.__dict['FromUserName'] = fromUserName
-        self.__dict['CreateTime'] = int(time.time())
+        self.__dict['CreateTime'] = createTime or int(time.time())
         self.__dict['ArticleCount'] = len(articles)
         self.__dict['Articles'] = ''
         self.articles = articles
@@ -58,11 +68,13 @@ class NewsMsg(Msg):
         <Url><![CDATA[%(url)s]]></Url>
         </item>
         """
-        for article in self.articles:
-            if 'pic_url' not in article:
-                article['pic_url'] = 'http://okmokavp8.bkt.clouddn.com/images/Untitled%20picture.png'
-            xml = XmlArticle % article
-            self.__dict['Articles'] += xml
+        # 不修改传入的article，同一组article会被多次回复
+        self.__dict['Articles'] = ''.join(XmlArticle % {
+            'title': article['title'],
+            'description': article['description'],
+            'pic_url': article.get('pic_url', DEFAULT_PIC_URL),
+            'url': article['url'],
+        } for article in self.articles)
             
         XmlForm = """
         <xml>
@@ -77,11 +89,11 @@ class NewsMsg(Msg):
         return XmlForm.format(**self.__dict)
         
 class ImageMsg(Msg):
-    def __init__(self, toUserName, fromUserName, mediaId):
+    def __init__(self, toUserName, fromUserName, mediaId, createTime=None):
         self.__dict = dict()
         self.__dict['ToUserName'] = toUserName
         self.__dict['FromUserName'] = fromUserName
-        self.__dict['CreateTime'] = int(time.time())
+        self.__dict['CreateTime'] = createTime or int(time.time())
         self.__dict['MediaId'] = mediaId
     def format(self):
         XmlForm = """
@@ -95,4 +107,51 @@ class ImageMsg(Msg):
         </Image>
         </xml>
         """
-        return XmlForm.format(**self.__dict)
\ No newline at end of file
+        return XmlForm.format(**self.__dict)
+
+# 预渲染时用来标记每次回复才确定的字段，XML中不允许出现\x00
+_MARK = '\x00'
+_PLACEHOLDERS = {
+    'ToUserName': _MARK + 'ToUserName' + _MARK,
+    'FromUserName': _MARK + 'FromUserName' + _MARK,
+    'CreateTime': _MARK + 'CreateTime' + _MARK,
+}
+
+class Prerendered(object):
+    ''' 预渲染的静态回复
+    消息内容只在创建时序列化一次，每次回复只填入ToUserName/FromUserName/CreateTime。
+    用法和其他回复类一样：Prerendered('TextMsg', content)(toUserName, fromUserName)
+    '''
+    def __init__(self, msg_type, content):
+        self.msg_type = msg_type
+        self.content = content
+        msg = globals()[msg_type](
+            _PLACEHOLDERS['ToUserName'], 
+            _PLACEHOLDERS['FromUserName'], 
+            content, 
+            createTime=_PLACEHOLDERS['CreateTime'],
+        )
+        # 拆开后奇数位置是字段名，偶数位置是固定的bytes
+        self.parts = msg.format().encode('utf-8').split(_MARK.encode('utf-8'))
+        self.fields = [part.decode('utf-8') for part in self.parts[1::2]]
+
+    def __call__(self, toUserName, fromUserName, msg=None):
+        return _Filled(self, {
+            'ToUserName': toUserName.encode('utf-8'),
+            'FromUserName': fromUserName.encode('utf-8'),
+            'CreateTime': str(int(time.time())).encode('utf-8'),
+        })
+
+class _Filled(Msg):
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+
+    def __repr__(self):
+        return self.format().decode('utf-8')
+
+    def format(self):
+        parts = list(self.template.parts)
+        for i, field in enumerate(self.template.fields):
+            parts[2 * i + 1] = self.values[field]
+        return b''.join(parts)
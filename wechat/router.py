@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+''' 消息路由
+
+ROUTER表的格式为 {msg_type: [(pattern, name), ...]}，按顺序取第一个match的规则。
+Router在创建时编译全部正则，并把'?'、'.'、'!!'这类固定命令展开成字符串字典，
+命中字典时不需要再逐个匹配正则。每条规则记录命中次数和匹配耗时，可以通过stats()读取。
+'''
+import re
+import time
+import itertools
+
+# 展开固定命令时最多生成的字符串数量，超过说明不是固定命令
+LITERAL_LIMIT = 64
+
+def _parse_class(body, i):
+    ''' 解析[...]，返回(可选字符列表, 结束位置)，无法展开时返回(None, None)
+    '''
+    chars = []
+    i += 1
+    while i < len(body):
+        c = body[i]
+        if c == ']' and chars:
+            return chars, i + 1
+        if c == '\\':
+            esc = body[i+1:i+2]
+            if not esc or esc.isalnum():
+                return None, None
+            chars.append(esc)
+            i += 2
+        elif c in '^-[':
+            return None, None
+        else:
+            chars.append(c)
+            i += 1
+    return None, None
+
+def _literals(pattern):
+    ''' 枚举pattern能匹配的固定字符串，带*和?的部分只取0次
+    只支持^和$之间由普通字符、转义字符、[...]和{n}组成的pattern，其余返回空集合。
+    结果只是快速路径的候选，最终对应哪条规则由Router按原来的顺序验证。
+    '''
+    if not pattern.startswith('^') or not pattern.endswith('$') or pattern.endswith('\\$'):
+        return set()
+    body = pattern[1:-1]
+    results = ['']
+    i = 0
+    while i < len(body):
+        c = body[i]
+        if c == '\\':
+            esc = body[i+1:i+2]
+            if not esc:
+                return set()
+            # \d \w 等字符类只能在*或?中出现
+            atom = None if esc.isalnum() else [esc]
+            i += 2
+        elif c == '[':
+            atom, i = _parse_class(body, i)
+            if i is None:
+                return set()
+        elif c == '.':
+            atom = None
+            i += 1
+        elif c in '()|*+?{}^$':
+            return set()
+        else:
+            atom = [c]
+            i += 1
+        quantifier = body[i:i+1]
+        if quantifier in ('*', '?'):
+            repeat = 0
+            i += 1
+        elif quantifier == '+':
+            repeat = 1
+            i += 1
+        elif quantifier == '{':
+            m = re.match(r'\{(\d+)\}', body[i:])
+            if not m:
+                return set()
+            repeat = int(m.group(1))
+            i += m.end()
+        else:
+            repeat = 1
+        if body[i:i+1] in ('?', '+') and quantifier in ('*', '?', '+', '{'):
+            return set()
+        if repeat and atom is None:
+            return set()
+        if repeat:
+            results = [r + ''.join(p) for r in results for p in itertools.product(atom, repeat=repeat)]
+        if len(results) > LITERAL_LIMIT:
+            return set()
+    return set(results)
+
+class Route(object):
+    def __init__(self, msg_type, pattern, name):
+        self.msg_type = msg_type
+        self.pattern = pattern
+        self.name = name
+        self.regex = re.compile(pattern)
+        self.hits = 0
+        self.exact_hits = 0
+        self.seconds = 0.0
+
+    def stats(self):
+        return {
+            'msg_type': self.msg_type,
+            'pattern': self.pattern,
+            'name': self.name,
+            'hits': self.hits,
+            'exact_hits': self.exact_hits,
+            'seconds': self.seconds,
+        }
+
+_routers = []
+
+class Router(object):
+    def __init__(self, table):
+        _routers.append(self)
+        self.table = table
+        self.routes = {}
+        self.exact = {}
+        for msg_type, rules in table.items():
+            routes = [Route(msg_type, pattern, name) for pattern, name in rules]
+            self.routes[msg_type] = routes
+            exact = {}
+            for route in routes:
+                for literal in _literals(route.pattern):
+                    # 前面的规则也可能匹配这个字符串，按原来的顺序确定归属
+                    if literal not in exact:
+                        first = self._scan(routes, literal)
+                        if first is not None:
+                            exact[literal] = first
+            self.exact[msg_type] = exact
+
+    def __contains__(self, msg_type):
+        return msg_type in self.routes
+
+    @staticmethod
+    def _scan(routes, key):
+        for route in routes:
+            if route.regex.match(key):
+                return route
+        return None
+
+    def route(self, msg_type, key):
+        ''' 返回第一条匹配的规则，没有匹配时返回None
+        '''
+        start = time.perf_counter()
+        route = self.exact[msg_type].get(key)
+        if route is not None:
+            route.exact_hits += 1
+        else:
+            route = self._scan(self.routes[msg_type], key)
+        if route is not None:
+            route.hits += 1
+            route.seconds += time.perf_counter() - start
+        return route
+
+    def stats(self):
+        return [route.stats() for routes in self.routes.values() for route in routes]
+
+_compiled = {}
+
+def compiled(table):
+    ''' 返回ROUTER表对应的Router，普通dict只在第一次使用时编译
+    '''
+    if isinstance(table, Router):
+        return table
+    router = _compiled.get(id(table))
+    if router is None or router.table is not table:
+        router = Router(table)
+        _compiled[id(table)] = router
+    return router
+
+def stats():
+    ''' 当前worker中所有Router的统计
+    '''
+    return [s for router in _routers for s in router.stats()]